@@ -0,0 +1,488 @@
+#!/usr/bin/python
+"""
+ Microbenchmarks for the hot paths of the solar module
+  Runs against an in-memory SQLite database and a TwoDimMemoryTarget (no
+  terminal needed), for every combination of --chunksize and --objects, and
+  reports ops/sec and per-call latency percentiles
+
+ Usage: solar-bench.py [--chunksize 9,21,63] [--objects 1,100,1000] [--ops 200]
+                       [--only NAME,...] [--output FILE.json] [--compare OLD.json]
+                       [--threshold PERCENT] [--trusted | --validation]
+
+  --output saves the results as JSON, --compare compares this run against a
+  previously saved one and exits with status 1 if anything got slower than
+  --threshold percent (default 10)
+
+  --trusted runs with InputValidation.trusted = True, --validation runs every
+  benchmark both ways and reports what the validation costs
+
+ Requirements:
+  * sqlite3			included with python 2.5+
+  * OpenSimplex 	pip install opensimplex
+  * NumPy           pip install numpy
+"""
+import json, platform, random, shutil, sys, tempfile, time, timeit
+import numpy as np
+import solar
+from solar import Colors
+from opensimplex import OpenSimplex
+
+# Terrain costs of the pathfinding benchmarks, water is slow and rock slower than land
+PATHCOSTS = {1: 6, 2: 1, 3: 3}
+# Where the pathfinding benchmarks go, (chunkX, chunkY, x, y)
+PATHGOAL = (4, 3, 0, 0)
+# Seconds between the steps of the crossing benchmarks
+IDLE = 0.002
+
+def makeworld(chunksize, objects):
+    "Returns (worldset, world, painter, target, moveables) for a new in-memory world"
+    STEPS.clear()
+    worldset = solar.TwoDimWorldSettings(
+        chunksize=chunksize,
+        markermap={1:'~', 2:'.', 3:'o'},
+        colormap={1:Colors.BRIGHT_BLUE, 2:Colors.DARK_GREEN, 3:Colors.DARK_GRAY},
+        width=2,
+        height=1)
+    storage = solar.TwoDimStorage(':memory:', codec=worldset.codec)
+    worldset.storage = storage
+    worldset.db = storage.db
+    worldset.c = storage.c
+    world = solar.TwoDimWorld(OpenSimplex(seed=worldset.seed), worldset)
+    world.loadchunk(0, 0)
+    painter = solar.TwoDimDrawing(worldset)
+    target = solar.TwoDimMemoryTarget(chunksize + 1, (chunksize + 1) * worldset.width)
+    # Scatter the objects over chunk 0,0 (relative coordinates)
+    rnd = random.Random(chunksize)
+    low = -int(chunksize / 2)
+    high = chunksize - 1 + low
+    moveables = []
+    for i in range(objects):
+        obj = solar.TwoDimMoveable(worldset, painter, target, x=rnd.randint(low, high), y=rnd.randint(low, high), objid=1)
+        obj.objid = storage.insertobject(obj.record()[1:], commit=False)
+        worldset.registry.update(obj.record())
+        moveables.append(obj)
+    storage.commit()
+    return (worldset, world, painter, target, moveables)
+
+def bench_gendata(worldset, world, painter, target, moveables, ops):
+    "Terrain generation only"
+    for i in range(ops):
+        yield lambda: world.gendata(i + 1000, 0)
+
+def bench_genchunk(worldset, world, painter, target, moveables, ops):
+    "Generation plus storing a new chunk"
+    for i in range(ops):
+        yield lambda: world.genchunk(i + 1000, 0)
+
+def bench_loadchunk_cold(worldset, world, painter, target, moveables, ops):
+    "Loading a 3x3 neighborhood that is in the database, but not cached"
+    world.loadrect(-1, -1, 1, 1)
+    for i in range(ops):
+        worldset.cache.clear()
+        yield lambda: world.loadchunk(0, 0)
+
+def bench_loadchunk_cold_regions(worldset, world, painter, target, moveables, ops):
+    "Loading a 3x3 neighborhood that is in region files (TwoDimRegionStorage), but not cached"
+    regiondir = tempfile.mkdtemp()
+    worldset.storage = solar.TwoDimRegionStorage(worldset.db, regiondir, codec=worldset.codec)
+    try:
+        world.loadrect(-1, -1, 1, 1)
+        for i in range(ops):
+            worldset.cache.clear()
+            yield lambda: world.loadchunk(0, 0)
+    finally:
+        shutil.rmtree(regiondir)
+
+def bench_loadchunk_cold_pristine(worldset, world, painter, target, moveables, ops):
+    "Loading a 3x3 neighborhood of a pristine world that isn't cached, which regenerates it"
+    worldset.pristine = True
+    for i in range(ops):
+        worldset.cache.clear()
+        yield lambda: world.loadchunk(1000, 0)
+
+def bench_loadchunk_warm(worldset, world, painter, target, moveables, ops):
+    "Loading a 3x3 neighborhood that is cached"
+    world.loadchunk(0, 0)
+    for i in range(ops):
+        yield lambda: world.loadchunk(0, 0)
+
+def bench_drawchunk(worldset, world, painter, target, moveables, ops):
+    "Drawing a whole chunk, alternating between two so the screen always changes"
+    world.loadchunk(0, 0)
+    for i in range(ops):
+        yield lambda: painter.drawchunk(0, i % 2, target)
+
+def bench_drawlocation(worldset, world, painter, target, moveables, ops):
+    "Drawing single locations"
+    painter.drawchunk(0, 0, target)
+    rnd = random.Random(0)
+    for i in range(ops):
+        x = rnd.randint(0, worldset.chunksize - 1)
+        y = rnd.randint(0, worldset.chunksize - 1)
+        yield lambda: painter.drawlocation(target, 0, 0, x, y)
+
+def bench_moveoffset(worldset, world, painter, target, moveables, ops):
+    "Moving an object one step (written to the database on every move)"
+    painter.drawchunk(0, 0, target)
+    obj = moveables[0]
+    for i in range(ops):
+        step = movestep(obj)
+        yield lambda: obj.moveoffset(0, step)
+
+def bench_moveoffset_writebehind(worldset, world, painter, target, moveables, ops):
+    "Moving an object one step, with write-behind batching"
+    painter.drawchunk(0, 0, target)
+    worldset.writebehind = solar.TwoDimWriteBehind(worldset)
+    obj = moveables[0]
+    for i in range(ops):
+        step = movestep(obj)
+        yield lambda: obj.moveoffset(0, step)
+    worldset.writebehind.flush()
+
+def bench_moveall(worldset, world, painter, target, moveables, ops):
+    "Moving every object one random step, one TwoDimMoveable at a time, with write-behind batching"
+    painter.drawchunk(0, 0, target)
+    worldset.writebehind = solar.TwoDimWriteBehind(worldset)
+    rnd = random.Random(ops)
+    def moveall():
+        for obj in moveables:
+            try:
+                obj.moveoffset(rnd.randint(-1, 1), rnd.randint(-1, 1))
+            except ValueError:
+                # Off the edge of the chunk
+                pass
+    for i in range(ops):
+        yield moveall
+    worldset.writebehind.flush()
+
+def bench_tick(worldset, world, painter, target, moveables, ops):
+    "Moving every object one random step in one TwoDimObjectArray.tick(), with write-behind batching"
+    painter.drawchunk(0, 0, target)
+    worldset.writebehind = solar.TwoDimWriteBehind(worldset)
+    drones = solar.TwoDimObjectArray(worldset, collide=False)
+    drones.addrecords(obj.record() for obj in moveables)
+    rnd = np.random.RandomState(ops)
+    def tick():
+        moved, cells = drones.tick(rnd.randint(-1, 2, len(drones)), rnd.randint(-1, 2, len(drones)))
+        painter.drawcells(target, cells, 0, 0)
+    for i in range(ops):
+        yield tick
+    worldset.writebehind.flush()
+
+def bench_tick_collide(worldset, world, painter, target, moveables, ops):
+    "Like tick, refusing moves into cells taken by another object"
+    painter.drawchunk(0, 0, target)
+    worldset.writebehind = solar.TwoDimWriteBehind(worldset)
+    drones = solar.TwoDimObjectArray(worldset)
+    drones.addrecords(obj.record() for obj in moveables)
+    rnd = np.random.RandomState(ops)
+    def tick():
+        moved, cells = drones.tick(rnd.randint(-1, 2, len(drones)), rnd.randint(-1, 2, len(drones)))
+        painter.drawcells(target, cells, 0, 0)
+    for i in range(ops):
+        yield tick
+    worldset.writebehind.flush()
+
+def bench_viewport_draw(worldset, world, painter, target, moveables, ops):
+    "Drawing a whole TwoDimViewport, alternating between two positions so the screen always changes"
+    view = solar.TwoDimViewport(world, painter, target, x=-worldset.chunksize // 2, y=-worldset.chunksize // 2)
+    view.draw()
+    for i in range(ops):
+        yield lambda: view.moveto(view.x, view.y + (view.cols if i % 2 else -view.cols))
+
+def bench_viewport_scroll(worldset, world, painter, target, moveables, ops):
+    "Scrolling a TwoDimViewport one cell at a time, across chunk borders"
+    view = solar.TwoDimViewport(world, painter, target, x=-worldset.chunksize // 2, y=-worldset.chunksize // 2)
+    view.draw()
+    steps = [(0, 1), (1, 0), (0, -1), (-1, 0)]
+    for i in range(ops):
+        # Walk a square that's bigger than a chunk
+        dx, dy = steps[(i // worldset.chunksize) % len(steps)]
+        yield lambda: view.scroll(dx, dy)
+
+def bench_overview_draw(worldset, world, painter, target, moveables, ops):
+    "Drawing one cell per chunk from a TwoDimOverview, for as many chunks as fit the window"
+    overview = solar.TwoDimOverview(world)
+    painter.drawoverview(target, overview, overview.maxlevel, 0, 0)
+    for i in range(ops):
+        yield lambda: painter.drawoverview(target, overview, overview.maxlevel, 0, i % 2)
+
+def bench_overview_draw_cold(worldset, world, painter, target, moveables, ops):
+    "Drawing one cell per chunk from a TwoDimOverview, reading it from the database every time"
+    overview = solar.TwoDimOverview(world)
+    painter.drawoverview(target, overview, overview.maxlevel, 0, 0)
+    for i in range(ops):
+        overview.cache.clear()
+        worldset.cache.clear()
+        yield lambda: painter.drawoverview(target, overview, overview.maxlevel, 0, i % 2)
+
+def bench_pathfind(worldset, world, painter, target, moveables, ops):
+    "Planning a route from each object in turn to a cell 4x3 chunks away, with the chunk graphs built"
+    pathfinder = solar.TwoDimPathfinder(world, costs=PATHCOSTS)
+    for obj in moveables:
+        pathfinder.findpath(obj.chunkX, obj.chunkY, obj.x, obj.y, *PATHGOAL)
+    for i in range(ops):
+        obj = moveables[i % len(moveables)]
+        yield lambda: pathfinder.findpath(obj.chunkX, obj.chunkY, obj.x, obj.y, *PATHGOAL)
+
+def bench_pathfind_cold(worldset, world, painter, target, moveables, ops):
+    "Planning a route to a cell 4x3 chunks away with nothing cached but the chunks"
+    pathfinder = solar.TwoDimPathfinder(world, costs=PATHCOSTS)
+    obj = moveables[0]
+    pathfinder.findpath(obj.chunkX, obj.chunkY, obj.x, obj.y, *PATHGOAL)
+    for i in range(ops):
+        pathfinder.clear()
+        yield lambda: pathfinder.findpath(obj.chunkX, obj.chunkY, obj.x, obj.y, *PATHGOAL)
+
+def bench_pathfollow(worldset, world, painter, target, moveables, ops):
+    "Taking the next step of a planned route (refining it a chunk at a time)"
+    pathfinder = solar.TwoDimPathfinder(world, costs=PATHCOSTS)
+    obj = moveables[0]
+    path = pathfinder.findpath(obj.chunkX, obj.chunkY, obj.x, obj.y, *PATHGOAL)
+    for i in range(ops):
+        if path.done():
+            path = pathfinder.findpath(obj.chunkX, obj.chunkY, obj.x, obj.y, *PATHGOAL)
+        yield path.step
+
+def bench_nearest(worldset, world, painter, target, moveables, ops):
+    "Finding the nearest water (class 1) cell within 3 chunks of each object in turn, with the chunks indexed"
+    index = solar.TwoDimResourceIndex(world)
+    size = worldset.chunksize
+    for obj in moveables:
+        index.nearest(1, obj.chunkX, obj.chunkY, obj.x, obj.y, 3 * size)
+    for i in range(ops):
+        obj = moveables[i % len(moveables)]
+        yield lambda: index.nearest(1, obj.chunkX, obj.chunkY, obj.x, obj.y, 3 * size)
+
+def bench_countradius(worldset, world, painter, target, moveables, ops):
+    "Counting the rock (class 3) cells within 2 chunks of a cell, with the chunks indexed"
+    index = solar.TwoDimResourceIndex(world)
+    radius = 2 * worldset.chunksize
+    index.countradius(3, 0, 0, 0, 0, radius)
+    for i in range(ops):
+        yield lambda: index.countradius(3, 0, 0, 0, 0, radius)
+
+def bench_crossing(worldset, world, painter, target, moveables, ops):
+    "Walking east through new chunks, loading each one as it's entered"
+    return walkeast(worldset, world, painter, target, moveables[0], ops)
+
+def bench_crossing_prefetch(worldset, world, painter, target, moveables, ops):
+    "Walking east through new chunks, with a TwoDimPrefetcher loading them ahead"
+    worldset.prefetcher = solar.TwoDimPrefetcher(world, distance=max(1, worldset.chunksize // 2))
+    worldset.prefetcher.watch(moveables[0])
+    return walkeast(worldset, world, painter, target, moveables[0], ops)
+
+def walkeast(worldset, world, painter, target, obj, ops):
+    """
+    Moves obj one step east per op. Objects can't cross chunks yet, so at the
+     edge it's put at the start of the next chunk by hand, like crossing would
+    Sleeps (untimed) for IDLE seconds between steps, like the game waiting for
+     the next key press, which is when the prefetcher gets to run
+    """
+    painter.drawchunk(obj.chunkX, obj.chunkY, target)
+    for i in range(ops):
+        time.sleep(IDLE)
+        absx, absy = obj.rel2abs(obj.x, obj.y)
+        if absy < worldset.chunksize - 1:
+            yield lambda: obj.moveoffset(0, 1)
+        else:
+            yield lambda: crosseast(worldset, world, obj)
+
+def crosseast(worldset, world, obj):
+    "Moves obj onto the western edge of the chunk to the east"
+    if worldset.prefetcher != False:
+        worldset.prefetcher.enter(obj.chunkX, obj.chunkY + 1)
+    else:
+        world.loadchunk(obj.chunkX, obj.chunkY + 1, loadneighbors=False)
+    obj.chunkY += 1
+    obj.y = -obj.yoffset
+    obj.write2db()
+
+# objid -> the step movestep() last returned
+STEPS = {}
+
+def movestep(obj):
+    "Returns the step that keeps obj walking back and forth across its chunk"
+    absx, absy = obj.rel2abs(obj.x, obj.y)
+    if absy >= obj.world.chunksize - 1:
+        STEPS[obj.objid] = -1
+    elif absy <= 0:
+        STEPS[obj.objid] = 1
+    return STEPS.get(obj.objid, 1)
+
+# (name, function, whether the object count matters to it)
+BENCHMARKS = [
+    ('gendata', bench_gendata, False),
+    ('genchunk', bench_genchunk, False),
+    ('loadchunk_cold', bench_loadchunk_cold, False),
+    ('loadchunk_cold_regions', bench_loadchunk_cold_regions, False),
+    ('loadchunk_cold_pristine', bench_loadchunk_cold_pristine, False),
+    ('loadchunk_warm', bench_loadchunk_warm, False),
+    ('drawchunk', bench_drawchunk, True),
+    ('drawlocation', bench_drawlocation, True),
+    ('moveoffset', bench_moveoffset, True),
+    ('moveoffset_writebehind', bench_moveoffset_writebehind, True),
+    ('moveall', bench_moveall, True),
+    ('tick', bench_tick, True),
+    ('tick_collide', bench_tick_collide, True),
+    ('viewport_draw', bench_viewport_draw, True),
+    ('viewport_scroll', bench_viewport_scroll, True),
+    ('overview_draw', bench_overview_draw, False),
+    ('overview_draw_cold', bench_overview_draw_cold, False),
+    ('pathfind', bench_pathfind, True),
+    ('pathfind_cold', bench_pathfind_cold, False),
+    ('pathfollow', bench_pathfollow, False),
+    ('nearest', bench_nearest, True),
+    ('countradius', bench_countradius, False),
+    ('crossing', bench_crossing, False),
+    ('crossing_prefetch', bench_crossing_prefetch, False),
+]
+
+def percentile(times, pct):
+    "Returns the pct percentile of the sorted list times"
+    return times[min(len(times) - 1, int(len(times) * pct / 100.0))]
+
+def run(name, func, chunksize, objects, ops, trusted=False):
+    "Runs one benchmark and returns its result dictionary"
+    solar.InputValidation.trusted = trusted
+    world = makeworld(chunksize, max(objects, 1))
+    timer = timeit.default_timer
+    times = []
+    for call in func(*(world + (ops,))):
+        start = timer()
+        call()
+        times.append(timer() - start)
+    solar.InputValidation.trusted = False
+    total = sum(times)
+    times.sort()
+    extra = {}
+    prefetcher = world[0].prefetcher
+    if prefetcher != False:
+        prefetcher.stop()
+        extra['prefetch'] = prefetcher.stats()
+    return dict(extra, **{'bench': name,
+            'chunksize': chunksize,
+            'objects': objects,
+            'trusted': trusted,
+            'ops': len(times),
+            'opspersec': len(times) / total if total > 0 else 0,
+            'mean': total / len(times),
+            'p50': percentile(times, 50),
+            'p90': percentile(times, 90),
+            'p99': percentile(times, 99),
+            'max': times[-1]})
+
+def resultkey(res):
+    "Returns the key that identifies the configuration of a result"
+    return (res['bench'], res['chunksize'], res['objects'], res.get('trusted', False))
+
+def compare(results, old, threshold):
+    "Prints the change against the old results, returns the number of regressions"
+    oldresults = {}
+    for res in old['results']:
+        oldresults[resultkey(res)] = res
+    regressions = 0
+    print("")
+    print("%-24s %6s %8s %12s %12s %8s" % ('bench', 'size', 'objects', 'old p50 us', 'new p50 us', 'change'))
+    for res in results:
+        prev = oldresults.get(resultkey(res))
+        if prev is None:
+            continue
+        change = (res['p50'] - prev['p50']) / prev['p50'] * 100 if prev['p50'] > 0 else 0
+        flag = ''
+        if change > threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print("%-24s %6d %8d %12.1f %12.1f %+7.1f%%%s" % (res['bench'], res['chunksize'], res['objects'],
+                                                        prev['p50'] * 1e6, res['p50'] * 1e6, change, flag))
+    return regressions
+
+def validationcost(results):
+    "Prints how much of each benchmark's time went to validation (strict minus trusted)"
+    trustedresults = {}
+    for res in results:
+        if res['trusted']:
+            trustedresults[resultkey(res)[:3]] = res
+    print("")
+    print("%-24s %6s %8s %12s %12s %12s %8s" % ('bench', 'size', 'objects', 'strict p50', 'trusted p50', 'validation', 'share'))
+    for res in results:
+        fast = trustedresults.get(resultkey(res)[:3])
+        if res['trusted'] or fast is None:
+            continue
+        cost = res['p50'] - fast['p50']
+        share = cost / res['p50'] * 100 if res['p50'] > 0 else 0
+        print("%-24s %6d %8d %12.1f %12.1f %12.1f %7.1f%%" % (res['bench'], res['chunksize'], res['objects'],
+                                                             res['p50'] * 1e6, fast['p50'] * 1e6, cost * 1e6, share))
+
+def main(args):
+    "Main program"
+    chunksizes = [9, 21, 63]
+    objectcounts = [1, 100, 1000]
+    ops = 200
+    only = False
+    output = False
+    oldfile = False
+    threshold = 10.0
+    modes = [False]
+    while len(args):
+        arg = args.pop(0)
+        if arg == '--chunksize':
+            chunksizes = [int(val) for val in args.pop(0).split(',')]
+        elif arg == '--objects':
+            objectcounts = [int(val) for val in args.pop(0).split(',')]
+        elif arg == '--ops':
+            ops = int(args.pop(0))
+        elif arg == '--only':
+            only = args.pop(0).split(',')
+        elif arg == '--output':
+            output = args.pop(0)
+        elif arg == '--compare':
+            oldfile = args.pop(0)
+        elif arg == '--threshold':
+            threshold = float(args.pop(0))
+        elif arg == '--trusted':
+            modes = [True]
+        elif arg == '--validation':
+            modes = [False, True]
+        else:
+            print(__doc__)
+            return 2
+
+    results = []
+    print("%-24s %6s %8s %7s %12s %10s %10s %10s" % ('bench', 'size', 'objects', 'trusted', 'ops/sec', 'p50 us', 'p90 us', 'p99 us'))
+    for name, func, usesobjects in BENCHMARKS:
+        if only != False and name not in only:
+            continue
+        for chunksize in chunksizes:
+            # Only sweep the object counts for the benchmarks they matter to
+            for objects in (objectcounts if usesobjects else [1]):
+                for trusted in modes:
+                    res = run(name, func, chunksize, objects, ops, trusted)
+                    results.append(res)
+                    print("%-24s %6d %8d %7s %12.1f %10.1f %10.1f %10.1f" % (name, chunksize, objects, 'yes' if trusted else 'no',
+                                                                             res['opspersec'], res['p50'] * 1e6,
+                                                                             res['p90'] * 1e6, res['p99'] * 1e6))
+                    if 'prefetch' in res:
+                        print("%-24s hit rate %.0f%%, %d waits for %.1f us" % ('', res['prefetch']['hitrate'] * 100,
+                                                                          res['prefetch']['waits'], res['prefetch']['waittime'] * 1e6))
+                    sys.stdout.flush()
+    if len(modes) > 1:
+        validationcost(results)
+
+    report = {'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'ops': ops},
+              'results': results}
+    if output != False:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        print("Results saved to " + output)
+    if oldfile != False:
+        with open(oldfile) as f:
+            old = json.load(f)
+        if compare(results, old, threshold) > 0:
+            return 1
+    return 0
+
+sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,47 @@
+#!/usr/bin/python
+"""
+ Upgrades an existing world database to the current schema, in place
+  (see solar.TwoDimStorage.upgrade()). This converts pickled TEXT chunk
+  records to the binary chunk format (see solar.TwoDimChunkCodec). Opening a
+  database with TwoDimStorage does the same, this just does it ahead of time
+  and gives the space used by the old records back to the filesystem
+
+ Usage: solar-migrate.py [database] [--compress LEVEL]
+  database defaults to solar.db
+
+ Requirements:
+  * pickle          included with python
+  * sqlite3			included with python 2.5+
+  * NumPy           pip install numpy
+"""
+import sqlite3, sys, time
+import solar
+
+DBFILE = "solar.db"
+
+def main(args):
+    "Main program"
+    dbfile = DBFILE
+    compress = False
+    while len(args):
+        arg = args.pop(0)
+        if arg == "--compress":
+            compress = int(args.pop(0))
+        else:
+            dbfile = arg
+
+    started = time.time()
+    db = sqlite3.connect(dbfile)
+    oldversion = db.execute("PRAGMA user_version").fetchone()[0]
+    storage = solar.TwoDimStorage(db, codec=solar.TwoDimChunkCodec(compress=compress))
+    newversion = storage.version()
+    if newversion == oldversion:
+        print(dbfile + " is already at schema version " + str(newversion))
+        return
+    # VACUUM can't run inside a transaction
+    db.isolation_level = None
+    db.execute("VACUUM")
+    db.close()
+    print("Upgraded " + dbfile + " from schema version " + str(oldversion) + " to " + str(newversion) + " in " + str(round(time.time() - started, 2)) + "s")
+
+main(sys.argv[1:])
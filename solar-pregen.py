@@ -0,0 +1,105 @@
+#!/usr/bin/python
+"""
+ Generates a rectangle of chunks ahead of time, before the world is opened
+  Blocks of chunks are generated in parallel by a pool of worker processes
+  and written by this one in large transactions (see solar.TwoDimPregenerator)
+  Chunks that are already in the database are skipped, so an interrupted run
+  can just be started again
+
+ Usage: solar-pregen.py minX,minY maxX,maxY [--db FILE] [--seed SEED]
+                        [--chunksize SIZE] [--processes N] [--blocksize N]
+                        [--batchsize N] [--compress LEVEL] [--no-overview]
+                        [--regions DIR]
+  --db defaults to solar.db, --seed and --chunksize must match the world
+  (defaults are those of solar-test.py)
+  --regions keeps the chunks in region files in DIR instead of the database
+  (see solar.TwoDimRegionStorage), --compress doesn't apply to them
+  The overview levels (see solar.TwoDimOverview) are built along with the
+  chunks, unless --no-overview is given
+
+ Requirements:
+  * sqlite3			included with python 2.5+
+  * OpenSimplex 	pip install opensimplex
+  * NumPy           pip install numpy
+"""
+import sys
+import solar
+
+DBFILE = "solar.db"
+SEED = 1234567890
+CHUNKSIZE = 21
+
+def showprogress(done, total, elapsed):
+    "Prints a progress line, overwriting the previous one"
+    rate = done / elapsed if elapsed > 0 else 0
+    percent = done * 100.0 / total if total > 0 else 100.0
+    sys.stdout.write("\r%d/%d chunks (%.1f%%) %.1f chunks/sec   " % (done, total, percent, rate))
+    sys.stdout.flush()
+
+def main(args):
+    "Main program"
+    dbfile = DBFILE
+    seed = SEED
+    chunksize = CHUNKSIZE
+    processes = False
+    blocksize = 8
+    batchsize = 1024
+    compress = False
+    overview = True
+    regiondir = False
+    corners = []
+    while len(args):
+        arg = args.pop(0)
+        if arg == "--db":
+            dbfile = args.pop(0)
+        elif arg == "--seed":
+            seed = int(args.pop(0))
+        elif arg == "--chunksize":
+            chunksize = int(args.pop(0))
+        elif arg == "--processes":
+            processes = int(args.pop(0))
+        elif arg == "--blocksize":
+            blocksize = int(args.pop(0))
+        elif arg == "--batchsize":
+            batchsize = int(args.pop(0))
+        elif arg == "--compress":
+            compress = int(args.pop(0))
+        elif arg == "--no-overview":
+            overview = False
+        elif arg == "--regions":
+            regiondir = args.pop(0)
+        else:
+            corners.append([int(val) for val in arg.split(',')])
+    if len(corners) != 2 or len(corners[0]) != 2 or len(corners[1]) != 2:
+        print(__doc__)
+        return 2
+    minX, maxX = sorted([corners[0][0], corners[1][0]])
+    minY, maxY = sorted([corners[0][1], corners[1][1]])
+
+    worldset = solar.TwoDimWorldSettings(seed=seed, chunksize=chunksize, markermap={1:'#'}, colormap={1:solar.Colors.DARK_GREEN}, width=1, height=1, chunkcompress=compress)
+    if regiondir == False:
+        storage = solar.TwoDimStorage(dbfile, codec=worldset.codec)
+    else:
+        storage = solar.TwoDimRegionStorage(dbfile, regiondir, codec=worldset.codec)
+    worldset.storage = storage
+    worldset.db = storage.db
+    worldset.c = storage.c
+    if overview:
+        # Registers itself as a chunk listener
+        solar.TwoDimOverview(solar.TwoDimWorld(solar.OpenSimplex(seed=seed), worldset))
+    pregen = solar.TwoDimPregenerator(worldset, processes=processes, blocksize=blocksize, batchsize=batchsize)
+    print("Generating chunks " + str(minX) + "," + str(minY) + " to " + str(maxX) + "," + str(maxY) + " in " + dbfile + " with " + str(pregen.processes) + " processes")
+    try:
+        stats = pregen.run(minX, minY, maxX, maxY, progress=showprogress)
+    except KeyboardInterrupt:
+        print("")
+        print("Interrupted, run again to carry on where this left off")
+        return 1
+    finally:
+        storage.close()
+    print("")
+    print("Generated " + str(stats['generated']) + " chunks (" + str(stats['skipped']) + " already existed) in " + str(round(stats['elapsed'], 2)) + "s, " + str(round(stats['rate'], 1)) + " chunks/sec")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
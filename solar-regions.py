@@ -0,0 +1,98 @@
+#!/usr/bin/python
+"""
+ Converts the chunks of a world between the database and region files
+  (see solar.TwoDimRegionStorage). Objects and the overview always stay in
+  the database, only the chunks move
+
+ Usage: solar-regions.py to-regions DIR [--db FILE] [--regionsize N] [--delete]
+        solar-regions.py to-db DIR [--db FILE] [--compress LEVEL] [--delete]
+  to-regions copies the chunks of the database into region files in DIR,
+  to-db copies the chunks of the region files in DIR into the database
+  --db defaults to solar.db, --regionsize (chunks per side of a region file)
+  to 32. --delete removes the chunks from where they came from afterwards
+  Chunks that are already at the destination are replaced
+
+ Requirements:
+  * sqlite3			included with python 2.5+
+  * NumPy           pip install numpy
+"""
+import os, sys, time
+import solar
+
+DBFILE = "solar.db"
+REGIONSIZE = 32
+# Chunks written per transaction
+BATCHSIZE = 1024
+
+def convert(src, dst, codec):
+    "Copies every chunk of storage src to storage dst, returns the number of chunks copied"
+    count = 0
+    batch = []
+    for x, y, data in src.allchunks():
+        batch.append((x, y, codec.encode(codec.decode(data))))
+        if len(batch) >= BATCHSIZE:
+            dst.putchunks(batch, commit=False)
+            dst.commit()
+            count += len(batch)
+            batch = []
+            sys.stdout.write("\r%d chunks   " % count)
+            sys.stdout.flush()
+    dst.putchunks(batch, commit=False)
+    dst.commit()
+    count += len(batch)
+    sys.stdout.write("\r%d chunks   \n" % count)
+    return count
+
+def main(args):
+    "Main program"
+    dbfile = DBFILE
+    regionsize = REGIONSIZE
+    compress = False
+    delete = False
+    positional = []
+    while len(args):
+        arg = args.pop(0)
+        if arg == "--db":
+            dbfile = args.pop(0)
+        elif arg == "--regionsize":
+            regionsize = int(args.pop(0))
+        elif arg == "--compress":
+            compress = int(args.pop(0))
+        elif arg == "--delete":
+            delete = True
+        else:
+            positional.append(arg)
+    if len(positional) != 2 or positional[0] not in ("to-regions", "to-db"):
+        print(__doc__)
+        return 2
+    direction, regiondir = positional
+
+    started = time.time()
+    codec = solar.TwoDimChunkCodec(compress=compress)
+    # Each on a connection of its own, so closing one doesn't trip over the other's statements
+    storage = solar.TwoDimStorage(dbfile, codec=codec)
+    regions = solar.TwoDimRegionStorage(dbfile, regiondir, codec=codec, regionsize=regionsize)
+    if direction == "to-regions":
+        count = convert(storage, regions, codec)
+        regions.close()
+        if delete:
+            storage.db.execute("DELETE FROM chunks")
+            storage.db.commit()
+            # VACUUM can't run inside a transaction
+            storage.db.isolation_level = None
+            storage.db.execute("VACUUM")
+        storage.close()
+    else:
+        count = convert(regions, storage, codec)
+        storage.close()
+        if delete:
+            paths = [region.path for region in regions.regions.values()]
+            regions.regions = {}
+            for path in paths:
+                os.remove(path)
+        regions.close()
+    print("Copied " + str(count) + " chunks " + direction + " in " + str(round(time.time() - started, 2)) + "s")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -7,14 +7,35 @@
   * sqlite3			included with python 2.5+
   * time            included with python
   * OpenSimplex 	pip install opensimplex
+  * NumPy           pip install numpy
 
-  TL;DR: Python 2.5+, pip install opensimplex
+  TL;DR: Python 2.5+, pip install opensimplex numpy
 """
-import curses, random, solar, sqlite3, pickle, time
+import curses, random, solar, time
 from solar import Colors
 from opensimplex import OpenSimplex
 
 DBFILE = "solar.db"
+# Set to a directory to keep the chunks in region files there instead of in
+#  DBFILE (see solar.TwoDimRegionStorage and solar-regions.py)
+REGIONDIR = False
+# Set to True to only store the cells that are changed, and generate the
+#  rest of the terrain again whenever it's needed (see solar.TwoDimWorldSettings)
+PRISTINE = False
+# How long (seconds) object moves may wait before being written to the database
+WRITEINTERVAL = 1.0
+# Start loading the next chunk when the selected object is this many cells from the edge
+PREFETCHDISTANCE = 3
+# Frames per second. Input is read, moves are made and the screen is updated once per frame
+FPS = 30
+# How often (seconds) the profiling overlay is redrawn while profiling (P) is on
+OVERLAYINTERVAL = 0.5
+# S saves the profile as STATSFILE.json, STATSFILE.csv and STATSFILE.prof (for pstats)
+STATSFILE = "solar-stats"
+# Number of objects that can be selected with the number keys
+SELECTABLE = 9
+# Movement keys, and the offset each one moves the selected object
+MOVES = {'KEY_LEFT': (0, -1), 'KEY_UP': (-1, 0), 'KEY_RIGHT': (0, 1), 'KEY_DOWN': (1, 0)}
 
 worldset = solar.TwoDimWorldSettings(
     chunksize=21,
@@ -24,7 +45,8 @@ worldset = solar.TwoDimWorldSettings(
     markermap={1:'~', 2:'.', 3:'o'},
     colormap={1:Colors.BRIGHT_BLUE, 2:Colors.DARK_GREEN, 3:Colors.DARK_GRAY},
     width=2,
-    height=1)
+    height=1,
+    pristine=PRISTINE)
 
 ## DEBUG?
 SHOWDEBUG = True
@@ -71,25 +93,16 @@ def main(stdscr):
     # Seed the random number generator
     random.seed()
 
-    # Connect to the database
-    db = sqlite3.connect(DBFILE)
-    c = db.cursor()
+    # Connect to the database, creating or upgrading the tables as needed
+    if REGIONDIR == False:
+        storage = solar.TwoDimStorage(DBFILE, codec=worldset.codec)
+    else:
+        storage = solar.TwoDimRegionStorage(DBFILE, REGIONDIR, codec=worldset.codec)
+    db = storage.db
+    c = storage.c
     worldset.db = db
     worldset.c = c
-
-    # Set up the database
-    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name='chunks'")
-    tables = c.fetchall()
-    if len(tables) < 1:
-        # debug("Creating chunks table")
-        c.execute('''CREATE TABLE IF NOT EXISTS chunks
-    			     (x INTEGER, y INTEGER, data TEXT)''')
-    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name='objects'")
-    tables = c.fetchall()
-    if len(tables) < 1:
-        # debug("Creating objects table")
-        c.execute('''CREATE TABLE IF NOT EXISTS objects
-    			     (x INTEGER, y INTEGER, chunkX INTEGER, chunkY INTEGER, icon TEXT, width INTEGER, height INTEGER, color INTEGER)''')
+    worldset.storage = storage
 
     # Set up the world
     smp = OpenSimplex(seed=worldset.seed)
@@ -104,85 +117,140 @@ def main(stdscr):
     chunk = solar.TwoDimChunk(dataset, worldset, chunkX, chunkY)
     painter = solar.TwoDimDrawing(worldset)
 
-    # Create the player
+    # Load the objects that can be selected (1-9), the rest are read a chunk
+    #  at a time when they need drawing, however many there are
     objects = []
-    c.execute("SELECT rowid,* FROM objects")
-    records = c.fetchall()
-    if len(records) < 1:
+    for obj in painter.moveables(storage.iterobjects(batchsize=SELECTABLE), terrwin):
+        objects.append(obj)
+        if len(objects) >= SELECTABLE:
+            break
+    if len(objects) < 1:
+        # Create the player
         # chunkX/Y and x/y all default to 0,0. All the other defaults are sane too
         objects.append(solar.TwoDimMoveable(worldset, painter, terrwin, objid=1))
         # debug("Object " + objects[-1].icon + " created at " + str(objects[-1].x) + "," + str(objects[-1].y))
-        c.execute("INSERT INTO objects (x, y, chunkX, chunkY, icon, width, height, color) VALUES (" + str(objects[-1].x) + "," + str(objects[-1].y) + ","  + str(objects[-1].chunkX) + "," + str(objects[-1].chunkY) + "," + "'" + str(objects[-1].icon) + "'" + "," + str(objects[-1].width) + "," + str(objects[-1].height) + "," + str(objects[-1].color) + ")")
-        db.commit()
+        objects[-1].objid = storage.insertobject(objects[-1].record()[1:])
+        worldset.registry.update(objects[-1].record())
         # debug("Object " + objects[-1].icon + " written to the database")
 
         objects.append(solar.TwoDimMoveable(worldset, painter, terrwin, icon='%', objid=1))
         # debug("Object " + objects[-1].icon + " created at " + str(objects[-1].x) + "," + str(objects[-1].y))
-        c.execute("INSERT INTO objects (x, y, chunkX, chunkY, icon, width, height, color) VALUES (" + str(objects[-1].x) + "," + str(objects[-1].y) + "," + str(objects[-1].chunkX) + "," + str(objects[-1].chunkY) + "," + "'" + str(objects[-1].icon) + "'" + "," + str(objects[-1].width) + "," + str(objects[-1].height) + "," + str(objects[-1].color) + ")")
-        db.commit()
+        objects[-1].objid = storage.insertobject(objects[-1].record()[1:])
+        worldset.registry.update(objects[-1].record())
         # debug("Object " + objects[-1].icon + " written to the database")
 
         objects.append(solar.TwoDimMoveable(worldset, painter, terrwin, icon='&', color=Colors.BRIGHT_CYAN, x=5, y=5, objid=1))
         # debug("Object " + objects[-1].icon + " created at " + str(objects[-1].x) + "," + str(objects[-1].y))
-        c.execute("INSERT INTO objects (x, y, chunkX, chunkY, icon, width, height, color) VALUES (" + str(objects[-1].x) + "," + str(objects[-1].y) + "," + str(objects[-1].chunkX) + "," + str(objects[-1].chunkY) + "," + "'" + str(objects[-1].icon) + "'" + "," + str(objects[-1].width) + "," + str(objects[-1].height) + "," + str(objects[-1].color) + ")")
-        db.commit()
+        objects[-1].objid = storage.insertobject(objects[-1].record()[1:])
+        worldset.registry.update(objects[-1].record())
         # debug("Object " + objects[-1].icon + " written to the database")
-    else:
-        for rec in records:
-            objects.append(painter.db2moveable(rec, painter, terrwin, chunkX, chunkY))
 
     painter.drawchunk(chunkX, chunkY, terrwin, drawobjs=True)
 
-    curobj = 0
-    debug("Waiting for user input, Q to quit")
-    # Process user key presses
-    keypress = ""
-    while keypress.upper() != "E" and keypress.upper() != "Q":  # E, Q - Quit
-        keypress = stdscr.getkey()
-        if keypress == "KEY_LEFT":
-            try:
-                objects[curobj].moveoffset(0,-1)
-            except ValueError as e:
-                debug("Player at maximum western edge of chunk")
-        elif keypress == "KEY_UP":
-            try:
-                objects[curobj].moveoffset(-1,0)
-            except ValueError as e:
-                debug("Player at maximum northern edge of chunk")
-        elif keypress == "KEY_RIGHT":
-            try:
-                objects[curobj].moveoffset(0,1)
-            except ValueError as e:
-                debug("Player at maximum eastern edge of chunk")
-        elif keypress == "KEY_DOWN":
-            try:
-                objects[curobj].moveoffset(1,0)
-            except ValueError as e:
-                debug("Player at maximum southern edge of chunk")
-        elif keypress.upper() == "E" or keypress.upper() == "Q":
-            # Do nothing, loop will exit
-            # Of course in Python you can't do NOTHING, there has to be an indented
-            #  block below an elif:, so we just assign keypress to itself so we do
-            #  SOMETHING that equates to NOTHING
-            keypress = keypress
-        elif is_str_int(keypress):
-            # If the key pressed was a number (1-9), select an object
-            if int(keypress) > 0 and int(keypress) < 10:
-                # Make sure the selected object exists
-                if int(keypress) <= len(objects):
-                    # Select it
-                    curobj = int(keypress) - 1
-                    debug("Object " + objects[curobj].icon + " selected")
+    # Batch object writes, at most WRITEINTERVAL seconds of movement is lost if we crash
+    writer = solar.TwoDimWriteBehind(worldset, interval=WRITEINTERVAL)
+    worldset.writebehind = writer
+    # Never wait for a key, the frame loop below does its own waiting
+    stdscr.nodelay(True)
+
+    # Load the chunks next to the selected object while we wait for input
+    prefetcher = solar.TwoDimPrefetcher(world, distance=PREFETCHDISTANCE)
+    worldset.prefetcher = prefetcher
+
+    try:
+        curobj = 0
+        prefetcher.watch(objects[curobj])
+        debug("Waiting for user input, Q to quit, P to profile, S to save the profile")
+        stats = worldset.stats
+        running = True
+        nextframe = time.time()
+        nextoverlay = nextframe
+        while running:
+            # Process every key pressed since the last frame, adding up the
+            #  moves of each object so that key repeat can't build up a backlog
+            moves = {}
+            while running:
+                try:
+                    keypress = stdscr.getkey()
+                except curses.error:
+                    # No more input
+                    break
+                if keypress in MOVES:
+                    offsetX, offsetY = moves.get(curobj, (0, 0))
+                    moves[curobj] = (offsetX + MOVES[keypress][0], offsetY + MOVES[keypress][1])
+                elif keypress.upper() == "E" or keypress.upper() == "Q":  # E, Q - Quit
+                    running = False
+                elif keypress.upper() == "P":
+                    # Toggle profiling, shown in place of the debug messages
+                    stats.enabled = not stats.enabled
+                    if stats.enabled:
+                        stats.reset()
+                        nextoverlay = time.time()
+                    else:
+                        debug("Profiling off")
+                elif keypress.upper() == "S":
+                    stats.savejson(STATSFILE + ".json")
+                    stats.savecsv(STATSFILE + ".csv")
+                    stats.saveprofile(STATSFILE + ".prof")
+                    debug("Profile saved to " + STATSFILE + ".json/.csv/.prof")
+                elif is_str_int(keypress):
+                    # If the key pressed was a number (1-9), select an object
+                    if int(keypress) > 0 and int(keypress) < 10:
+                        # Make sure the selected object exists
+                        if int(keypress) <= len(objects):
+                            # Select it
+                            curobj = int(keypress) - 1
+                            prefetcher.unwatch()
+                            prefetcher.watch(objects[curobj])
+                            debug("Object " + objects[curobj].icon + " selected")
+                        else:
+                            debug("Invalid selection, object " + str(keypress))
+                    else:
+                        debug("Invalid selection, object " + str(keypress))
                 else:
-                    debug("Invalid selection, object " + str(keypress))
+                    debug("Unknown key pressed: " + str(keypress))
+            # Make one move per object, and show them all at once
+            for index in sorted(moves):
+                moveobject(objects[index], moves[index][0], moves[index][1])
+            painter.present(terrwin)
+            # Write out any moves that have waited long enough
+            writer.poll()
+            # Store and cache whatever the prefetcher has finished
+            prefetcher.collect()
+            if stats.enabled and SHOWDEBUG and time.time() >= nextoverlay:
+                stats.show(debugwin)
+                nextoverlay = time.time() + OVERLAYINTERVAL
+            # Wait for the next frame, without trying to catch up if we fell behind
+            nextframe += 1.0 / FPS
+            delay = nextframe - time.time()
+            if delay > 0:
+                time.sleep(delay)
             else:
-                debug("Invalid selection, object " + str(keypress))
-        else:
-            debug("Unknown key pressed: " + str(keypress))
+                nextframe = time.time()
+    finally:
+        prefetcher.stop()
+        # Never lose the moves that haven't been written yet
+        writer.flush()
+    stats = prefetcher.stats()
+    debug("Prefetched " + str(stats['requested']) + " chunks, hit rate " + str(int(stats['hitrate'] * 100)) + "%, waited " + str(round(stats['waittime'], 3)) + "s")
 
     debug("User requested quit")
-    db.commit()
-    db.close()
+    storage.commit()
+    storage.close()
+
+def moveobject(obj, offsetX, offsetY):
+    "Moves obj by offsetX,offsetY (without presenting it), stopping at the edges of the chunk"
+    size = obj.world.chunksize
+    absx, absy = obj.rel2abs_unchecked(obj.x + offsetX, obj.y + offsetY)
+    if absx < 0:
+        debug("Player at maximum northern edge of chunk")
+    elif absx > size - 1:
+        debug("Player at maximum southern edge of chunk")
+    if absy < 0:
+        debug("Player at maximum western edge of chunk")
+    elif absy > size - 1:
+        debug("Player at maximum eastern edge of chunk")
+    obj.moveabsolute(min(max(absx, 0), size - 1), min(max(absy, 0), size - 1), refresh=False)
 
 def debug(text):
     if SHOWDEBUG:
@@ -6,8 +6,9 @@
   * random			included with python
   * sqlite3			included with python 2.5+
   * OpenSimplex 	pip install opensimplex
+  * NumPy           pip install numpy
 
-  TL;DR: Python 2.5+, pip install opensimplex
+  TL;DR: Python 2.5+, pip install opensimplex numpy
 
  A NOTE ABOUT COORDINATES:
   You will find four types of coordnates used here:
@@ -23,7 +24,14 @@
         Useful for taking small steps (+/-1)
 """
 
-import curses, pickle, sqlite3, time, random
+import curses, heapq, json, marshal, mmap, multiprocessing, os, pickle, sqlite3, struct, threading, time, random, zlib
+from collections import OrderedDict, deque, namedtuple
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+import numpy as np
 from opensimplex import OpenSimplex
 
 class Colors:
@@ -47,7 +55,24 @@ class Colors:
     BRIGHT_BLACK = 15
     DARK_GRAY = 15
 
-class InputValidation:
+class InputValidation(object):
+    # No per-instance __dict__ needed here, so that subclasses can use __slots__
+    __slots__ = ()
+    # Validation policy. Public entry points (constructors, move*(), draw*())
+    #  validate their arguments, and then call *_unchecked() methods which
+    #  trust them. With trusted == True (for everything, e.g.
+    #  InputValidation.trusted = True) the drawing and movement entry points
+    #  skip their validation too. Constructors are always checked, as are the
+    #  edges of the chunk when moving
+    trusted = False
+
+    # str(type()) of a curses window, for Python 2 and Python 3
+    CURSESWINDOW = ("<type '_curses.curses window'>", "<class '_curses.window'>")
+
+    def iscurseswin(self, val):
+        "Returns True if val is a curses window"
+        return str(type(val)) in self.CURSESWINDOW
+
     def validate_int(self, val, name, minval=False, maxval=False):
         """
         Ensure a value is an integer and within the valid range (if specified)
@@ -104,6 +129,18 @@ class InputValidation:
                 raise ValueError(str(name) + " len() > " + str(maxcount) + " (" + str(len(val)) + ")")
         return val
 
+    def validate_array(self, val, name, shape=False):
+        """
+        Ensure a value is a numpy array and has the specified shape (if specified)
+         Returns the validated array or throws an exception
+        """
+        if not isinstance(val, np.ndarray):
+            raise TypeError(str(name) + " is not type ndarray (" + str(type(val)).split("'")[1] + ")")
+        if type(shape) == type(()):
+            if val.shape != shape:
+                raise ValueError(str(name) + " shape != " + str(shape) + " (" + str(val.shape) + ")")
+        return val
+
     def validate_tup(self, val, name, mincount=False, maxcount=False):
         """
         Ensure that a value is a tuple and the count of enties is within the
@@ -120,20 +157,22 @@ class InputValidation:
 
     def validate_win(self, win, name, falseok=False):
         """
-        Ensure that a value is a curses window,
+        Ensure that a value is a curses window or a TwoDimRenderTarget,
          or optionally evaluates to False (falseok=True)
         """
         if falseok and win == False:
             return win
-        if str(type(win)) != "<type '_curses.curses window'>":
-            raise TypeError(str(name) + " is not a Curses window (" + str(type(val)).split("'")[1] + ")")
+        if isinstance(win, TwoDimRenderTarget):
+            return win
+        if not self.iscurseswin(win):
+            raise TypeError(str(name) + " is not a Curses window (" + str(type(win)).split("'")[1] + ")")
         return win
 
     def validate_smp(self, val, name):
         """
         Ensure that a value is an OpenSimplex object
         """
-        if str(type(val)) != "<class 'opensimplex.opensimplex.OpenSimplex'>":
+        if not isinstance(val, OpenSimplex):
             raise TypeError(str(name) + " is not an OpenSimplex object (" + str(type(val)).split("'")[1] + ")")
         return val
 
@@ -141,20 +180,15 @@ class InputValidation:
         """
         Ensure that a value is a TwoDimWorldSettings object
         """
-        if str(type(val)) != "<type 'instance'>":
-            raise TypeError(str(name) + " is not a TwoDimWorldSettings object (" + str(type(val)).split("'")[1] + ")")
-        else:
-            if str(type(val)).split("'")[1] == "instance" and val.__class__.__name__ == "TwoDimWorldSettings":
-                return val
-            else:
-                raise TypeError(str(name) + " is not a TwoDimWorldSettings object (" + str(type(val)).split("'")[1] + " " + val.__class__.__name__ +  ")")
+        if not isinstance(val, TwoDimWorldSettings):
+            raise TypeError(str(name) + " is not a TwoDimWorldSettings object (" + val.__class__.__name__ +  ")")
         return val
 
     def validate_db(self, val, name):
         """
         Ensure that a value is a sqlite3 Connection OR that it's a bool (disabled)
         """
-        if str(type(val)) != "<type 'sqlite3.Connection'>" and type(val) != type(bool()):
+        if not isinstance(val, sqlite3.Connection) and type(val) != type(bool()):
             raise TypeError(str(name) + " is not a sqlite3 Connection (" + str(type(val)).split("'")[1] + ")")
         return val
 
@@ -162,11 +196,12 @@ class InputValidation:
         """
         Ensures a value is a sqlite3 db cursor OR that it's a bool (disabled)
         """
-        if str(type(val)) != "<type 'sqlite3.Cursor'>" and type(val) != type(bool()):
+        if not isinstance(val, sqlite3.Cursor) and type(val) != type(bool()):
             raise TypeError(str(name) + " is not a sqlite3 Cursor (" + str(type(val)).split("'")[1] + ")")
         return val
 
 class TwoDimCommon(InputValidation):
+    __slots__ = ()
     # self.xoffset = int(worldset.chunksize / 2)
     # self.yoffset = int(worldset.chunksize / 2)
 
@@ -180,7 +215,7 @@ class TwoDimCommon(InputValidation):
          a newline. Only adds text if 'self.world.debugwin' is a curses window
         """
         # Check and see if we have a curses window
-        if str(type(self.world.debugwin)) == "<type '_curses.curses window'>":
+        if self.iscurseswin(self.world.debugwin):
             # Add the text to the window, along with a newline
             self.world.debugwin.addstr(str(text) + "\n")
             # Refresh the window to update the screen
@@ -194,9 +229,11 @@ class TwoDimCommon(InputValidation):
         """
         # self.debug("abs2rel(" + str(x) + "," + str(y) + ") = " + str(x-self.xoffset) + "," + str(y-self.yoffset) + " (" + str(getattr(self, 'chunksize', self.world.chunksize)) + ")")
         x, y = self.validate_abs(x, y)
-        x = x - self.xoffset
-        y = y - self.yoffset
-        return (x, y)
+        return self.abs2rel_unchecked(x, y)
+
+    def abs2rel_unchecked(self, x, y):
+        "abs2rel() for coordinates that are already known to be valid"
+        return (x - self.xoffset, y - self.yoffset)
 
     def rel2abs(self, x, y):
         """
@@ -206,9 +243,11 @@ class TwoDimCommon(InputValidation):
         """
         # self.debug("rel2abs(" + str(x) + "," + str(y) + ") = " + str(x+getattr(self, 'xoffset', 0)) + "," + str(y+getattr(self, 'yoffset', 0)) + " (" + str(getattr(self, 'chunksize', self.world.chunksize)) + ")")
         x, y = self.validate_rel(x, y)
-        x = x + self.xoffset
-        y = y + self.yoffset
-        return (x, y)
+        return self.rel2abs_unchecked(x, y)
+
+    def rel2abs_unchecked(self, x, y):
+        "rel2abs() for coordinates that are already known to be valid"
+        return (x + self.xoffset, y + self.yoffset)
 
     def rel2screen(self, x, y):
         """
@@ -221,6 +260,10 @@ class TwoDimCommon(InputValidation):
         x, y = self.abs2screen(x, y)
         return (x, y)
 
+    def rel2screen_unchecked(self, x, y):
+        "rel2screen() for coordinates that are already known to be valid"
+        return ((x + self.xoffset) * self.world.height, (y + self.yoffset) * self.world.width)
+
     def abs2screen(self, x, y):
         """
         Returns a tuple of (x,y) where x and y are adjusted
@@ -229,9 +272,11 @@ class TwoDimCommon(InputValidation):
         """
         x = self.validate_int(x, 'x', 0, self.world.chunksize)
         y = self.validate_int(y, 'y', 0, self.world.chunksize)
-        x = x * self.world.height
-        y = y * self.world.width
-        return (x, y)
+        return self.abs2screen_unchecked(x, y)
+
+    def abs2screen_unchecked(self, x, y):
+        "abs2screen() for coordinates that are already known to be valid"
+        return (x * self.world.height, y * self.world.width)
 
     def screen2abs(self, x, y):
         """
@@ -267,6 +312,10 @@ class TwoDimCommon(InputValidation):
         #  so as long as they pass  the integer test, they are good ot go
         return (x, y)
 
+    def inchunk(self, x, y):
+        "Returns True if the ABSOLUTE coordinates x,y are inside the chunk"
+        return x >= 0 and y >= 0 and x < self.world.chunksize and y < self.world.chunksize
+
     def validate_abs(self, x, y):
         """
         Ensures that a set of x,y coordinates are valid ABSOLUTE coordinates
@@ -287,6 +336,141 @@ class TwoDimCommon(InputValidation):
             raise ValueError("y > " + str(self.world.chunksize - 1) + " (" + str(y) + ")")
         return (x, y)
 
+    def fetchchunk(self, chunkX, chunkY):
+        """
+        Returns the TwoDimChunk for chunkX,chunkY from the chunk cache, loading
+         it from the database on a cache miss. Returns None if the chunk is in
+         neither, unless the world is pristine (see TwoDimWorldSettings), then
+         it is generated again
+        """
+        chunk = self.world.cache.get(chunkX, chunkY)
+        if chunk is not None:
+            return chunk
+        if self.world.prefetcher != False:
+            chunk = self.world.prefetcher.claim(chunkX, chunkY)
+            if chunk is not None:
+                return chunk
+        stats = self.world.stats
+        start = stats.begin()
+        data = self.world.storage.getchunk(chunkX, chunkY)
+        stats.add('sql', start)
+        if data is None:
+            if self.world.pristine and self.world.generator != False:
+                return self.world.generator.regenerate(chunkX, chunkY)
+            return None
+        start = stats.begin()
+        dataset = self.unpackchunk(data)
+        stats.add('decode', start)
+        dataset = self.applydeltas(chunkX, chunkY, dataset)
+        return self.world.cache.put(TwoDimChunk(dataset, self.world, chunkX, chunkY))
+
+    def applydeltas(self, chunkX, chunkY, dataset, deltas=False):
+        """
+        Returns dataset with the changed cells of chunk chunkX,chunkY (see
+         TwoDimWorld.setcells()) written over it, as a copy if there are any
+         deltas is the list of (x, y, value), read from the database if False
+        """
+        if deltas == False:
+            storage = self.world.storage
+            if not storage.hasdeltas:
+                return dataset
+            stats = self.world.stats
+            start = stats.begin()
+            deltas = storage.getdeltas(chunkX, chunkY)
+            stats.add('sql', start)
+        if len(deltas) < 1:
+            return dataset
+        # Stored chunks can be read-only views of their region file
+        dataset = np.array(dataset)
+        for x, y, value in deltas:
+            dataset[x, y] = value
+        return dataset
+
+    def objectsinrect(self, minX, minY, maxX, maxY, batchsize=256):
+        """
+        Yields the TwoDimObjectRecord of every object in the chunks from
+         minX,minY to maxX,maxY (inclusive), in no particular order
+         The records are streamed from the database batchsize at a time, so
+         memory use doesn't depend on how many objects there are. Moves that
+         are waiting in the TwoDimWriteBehind are taken into account
+        """
+        minX = self.validate_int(minX, 'minX')
+        minY = self.validate_int(minY, 'minY')
+        maxX = self.validate_int(maxX, 'maxX', minval=minX)
+        maxY = self.validate_int(maxY, 'maxY', minval=minY)
+        batchsize = self.validate_int(batchsize, 'batchsize', minval=1)
+        dirty = {}
+        if self.world.writebehind != False:
+            dirty = self.world.writebehind.dirty
+        for rec in self.world.storage.rectobjects(minX, minY, maxX, maxY, batchsize):
+            if rec[0] not in dirty:
+                yield rec
+        # A flush while we were reading would have made these stale
+        for rec in list(dirty.values()):
+            if minX <= rec[3] <= maxX and minY <= rec[4] <= maxY:
+                yield tuple.__new__(TwoDimObjectRecord, rec)
+
+    def objectsinchunk(self, chunkX, chunkY, batchsize=256):
+        "Yields the TwoDimObjectRecord of every object in chunk chunkX,chunkY, see objectsinrect()"
+        return self.objectsinrect(chunkX, chunkY, chunkX, chunkY, batchsize)
+
+    def objectsnear(self, chunkX, chunkY, x, y, radius, batchsize=256):
+        """
+        Yields the TwoDimObjectRecord of every object within radius cells of
+         relative x,y of chunk chunkX,chunkY, including those in other chunks
+         Only the chunks the circle touches are read, see objectsinrect()
+        """
+        x, y = self.validate_rel(x, y)
+        radius = self.validate_int(radius, 'radius', minval=0)
+        size = self.world.chunksize
+        offset = int(size / 2)
+        # World coordinates of the center
+        centerX = chunkX * size + x + offset
+        centerY = chunkY * size + y + offset
+        limit = radius * radius
+        for rec in self.objectsinrect((centerX - radius) // size, (centerY - radius) // size,
+                                      (centerX + radius) // size, (centerY + radius) // size, batchsize):
+            dx = rec[3] * size + rec[1] + offset - centerX
+            dy = rec[4] * size + rec[2] + offset - centerY
+            if dx * dx + dy * dy <= limit:
+                yield rec
+
+    def chunkschanged(self, chunks):
+        """
+        Passes the list of TwoDimChunks chunks, which have just been generated
+         or replaced, to the chunkchanged() method of every object in
+         TwoDimWorldSettings.chunklisteners. This is done before the
+         transaction that stores the chunks is committed
+        """
+        for listener in self.world.chunklisteners:
+            listener.chunkchanged(chunks)
+
+    def unpackchunk(self, data):
+        """
+        Returns the chunk dataset array from the data column of a chunk record
+        """
+        return self.world.codec.decode(data)
+
+    def terrainclasses(self, dataset):
+        """
+        Returns an array of the terrain class of every cell in dataset
+         (see TwoDimDrawing.getval()), limited to 0 - len(markermap)+1
+        """
+        # Same arithmetic as getval(), done in double precision like getval() does
+        terrval = np.asarray(dataset, dtype=np.float64) + 1
+        terrval *= .5
+        offset = 1.0 / len(self.world.markermap)
+        ret = (terrval / offset).astype(np.int64) + 1
+        return np.clip(ret, 0, len(self.world.markermap) + 1).astype(np.uint8)
+
+    def getappearance(self, icon, width, height, color):
+        """
+        Returns the interned (icon, width, height, color) appearance record,
+         shared by every object in the world that looks the same
+        """
+        appearance = (icon, width, height, color)
+        return self.world.appearances.setdefault(appearance, appearance)
+
     def db2object(self, record, chunkX, chunkY):
         """
         Returns a TwoDimObject from a previously unpickled db record
@@ -320,6 +504,1088 @@ class TwoDimCommon(InputValidation):
                                 height=self.validate_int(record[7], 'height', minval=0, maxval=self.world.chunksize),
                                 color=self.validate_int(record[8], 'color'))
 
+class TwoDimChunkCache(InputValidation):
+    def __init__(self, maxchunks=64, maxbytes=False):
+        """
+        Least-recently-used cache of TwoDimChunk objects, keyed by chunkX,chunkY
+         Holds at most maxchunks chunks and/or maxbytes bytes of chunk data,
+         either limit may be False (unlimited), but not both
+        """
+        if maxchunks != False:
+            maxchunks = self.validate_int(maxchunks, 'maxchunks', minval=1)
+        if maxbytes != False:
+            maxbytes = self.validate_int(maxbytes, 'maxbytes', minval=1)
+        if maxchunks == False and maxbytes == False:
+            raise ValueError("maxchunks and maxbytes can not both be unlimited")
+        self.maxchunks = maxchunks
+        self.maxbytes = maxbytes
+        self.chunks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def __contains__(self, key):
+        "Checks for a chunk without counting it as a hit or a miss"
+        return key in self.chunks
+
+    def get(self, chunkX, chunkY):
+        "Returns the cached TwoDimChunk for chunkX,chunkY, or None if it isn't cached"
+        key = (chunkX, chunkY)
+        chunk = self.chunks.pop(key, None)
+        if chunk is None:
+            self.misses += 1
+            return None
+        # Re-insert it to mark it as the most recently used
+        self.chunks[key] = chunk
+        self.hits += 1
+        return chunk
+
+    def put(self, chunk):
+        "Adds (or replaces) a TwoDimChunk, evicting the least recently used chunks if needed"
+        self.invalidate(chunk.chunkX, chunk.chunkY)
+        self.chunks[(chunk.chunkX, chunk.chunkY)] = chunk
+        self.nbytes += chunk.size()
+        self.evict()
+        return chunk
+
+    def invalidate(self, chunkX, chunkY):
+        "Removes chunkX,chunkY from the cache, if it is there"
+        chunk = self.chunks.pop((chunkX, chunkY), None)
+        if chunk is not None:
+            self.nbytes -= chunk.size()
+
+    def clear(self):
+        "Removes everything from the cache"
+        self.chunks.clear()
+        self.nbytes = 0
+
+    def evict(self):
+        "Drops least recently used chunks until the cache is within its limits"
+        # Always keep the most recently added chunk, even if it alone is over the limit
+        while len(self.chunks) > 1:
+            if self.maxchunks != False and len(self.chunks) > self.maxchunks:
+                pass
+            elif self.maxbytes != False and self.nbytes > self.maxbytes:
+                pass
+            else:
+                break
+            key, chunk = self.chunks.popitem(last=False)
+            self.nbytes -= chunk.size()
+            self.evictions += 1
+
+    def stats(self):
+        "Returns a dictionary of the cache counters"
+        return {'chunks': len(self.chunks),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+class TwoDimChunkCodec(InputValidation):
+    # Binary chunk format, stored in the chunks.data BLOB column:
+    #  magic (4s), version (B), dtype (B), flags (B), padding, rows (H), cols (H)
+    #  followed by rows x cols values of the given dtype, zlib compressed if
+    #  FLAG_ZLIB is set
+    MAGIC = b'SWCK'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBBBxHH')
+    DTYPES = {1: '<f4', 2: '<f8'}
+    FLAG_ZLIB = 1
+
+    def __init__(self, dtype=1, compress=False):
+        """
+        Encodes/decodes chunk datasets to/from the binary chunk format
+         dtype is a key of DTYPES, compress is False or a zlib level (1-9)
+        """
+        if dtype not in self.DTYPES:
+            raise ValueError("dtype not in " + str(sorted(self.DTYPES.keys())) + " (" + str(dtype) + ")")
+        self.dtype = dtype
+        if compress != False:
+            compress = self.validate_int(compress, 'compress', minval=1, maxval=9)
+        self.compress = compress
+
+    def prepare(self, dataset):
+        "Returns dataset converted to the values that encode() will store"
+        return np.asarray(dataset, dtype=np.dtype(self.DTYPES[self.dtype]).newbyteorder('='))
+
+    def isbinary(self, data):
+        "Returns True if data is in the binary chunk format (rather than a legacy pickle)"
+        if type(data) == type(u''):
+            # Legacy records were stored as TEXT
+            return False
+        return bytes(data[:len(self.MAGIC)]) == self.MAGIC
+
+    def encode(self, dataset):
+        "Returns the binary chunk record for dataset"
+        dataset = np.asarray(dataset)
+        rows, cols = dataset.shape
+        payload = dataset.astype(self.DTYPES[self.dtype]).tobytes()
+        flags = 0
+        if self.compress != False:
+            payload = zlib.compress(payload, self.compress)
+            flags |= self.FLAG_ZLIB
+        return self.HEADER.pack(self.MAGIC, self.VERSION, self.dtype, flags, rows, cols) + payload
+
+    def decode(self, data):
+        """
+        Returns the dataset array from a chunk record
+         Uncompressed records are decoded in place without copying. Legacy
+         (pickled list) records are still understood, see solar-migrate.py
+         Arrays (from TwoDimRegionStorage) are already decoded
+        """
+        if isinstance(data, np.ndarray):
+            return data
+        if not self.isbinary(data):
+            if type(data) == type(u''):
+                data = data.encode('latin-1')
+            return np.asarray(pickle.loads(data), dtype=np.float64)
+        magic, version, dtype, flags, rows, cols = self.HEADER.unpack_from(data)
+        if version > self.VERSION:
+            raise ValueError("Chunk format version " + str(version) + " is newer than " + str(self.VERSION))
+        if dtype not in self.DTYPES:
+            raise ValueError("Unknown chunk dtype " + str(dtype))
+        if flags & self.FLAG_ZLIB:
+            return np.frombuffer(zlib.decompress(data[self.HEADER.size:]), dtype=self.DTYPES[dtype]).reshape(rows, cols)
+        return np.frombuffer(data, dtype=self.DTYPES[dtype], count=rows * cols, offset=self.HEADER.size).reshape(rows, cols)
+
+# An object record, as stored in the objects table. It is still a tuple, so
+#  it can be used anywhere a plain record can
+TwoDimObjectRecord = namedtuple('TwoDimObjectRecord', 'objid x y chunkX chunkY icon width height color')
+
+class TwoDimStorage(InputValidation):
+    # PRAGMA user_version of a database created/upgraded by this class
+    #  version 0 is the unversioned schema solar-test.py used to create
+    SCHEMA_VERSION = 3
+    SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    # All statements are parameterized so sqlite3 can reuse them from its statement cache
+    SQL_GETCHUNK = "SELECT data FROM chunks WHERE x=? AND y=?"
+    SQL_COUNTCHUNK = "SELECT COUNT(*) FROM chunks WHERE x=? AND y=?"
+    SQL_GETCHUNKRECT = "SELECT x, y, data FROM chunks WHERE x BETWEEN ? AND ? AND y BETWEEN ? AND ?"
+    SQL_ALLCHUNKS = "SELECT x, y, data FROM chunks"
+    SQL_CHUNKKEYSRECT = "SELECT x, y FROM chunks WHERE x BETWEEN ? AND ? AND y BETWEEN ? AND ?"
+    SQL_PUTCHUNK = "INSERT OR REPLACE INTO chunks (x, y, data) VALUES (?, ?, ?)"
+    SQL_ADDCHUNK = "INSERT OR IGNORE INTO chunks (x, y, data) VALUES (?, ?, ?)"
+    SQL_GETOVERVIEWRECT = "SELECT x, y, data FROM overview WHERE level=? AND x BETWEEN ? AND ? AND y BETWEEN ? AND ?"
+    SQL_PUTOVERVIEW = "INSERT OR REPLACE INTO overview (level, x, y, data) VALUES (?, ?, ?, ?)"
+    SQL_HASDELTAS = "SELECT 1 FROM deltas LIMIT 1"
+    SQL_GETDELTAS = "SELECT cellx, celly, value FROM deltas WHERE x=? AND y=?"
+    SQL_GETDELTASRECT = "SELECT x, y, cellx, celly, value FROM deltas WHERE x BETWEEN ? AND ? AND y BETWEEN ? AND ?"
+    SQL_PUTDELTA = "INSERT OR REPLACE INTO deltas (x, y, cellx, celly, value) VALUES (?, ?, ?, ?, ?)"
+    SQL_CLEARDELTAS = "DELETE FROM deltas WHERE x=? AND y=?"
+    SQL_COUNTDELTAS = "SELECT COUNT(*) FROM deltas"
+    SQL_ALLOBJECTS = "SELECT rowid,* FROM objects"
+    SQL_ITEROBJECTS = "SELECT rowid,* FROM objects ORDER BY rowid"
+    SQL_RECTOBJECTS = "SELECT rowid,* FROM objects WHERE chunkX BETWEEN ? AND ? AND chunkY BETWEEN ? AND ?"
+    SQL_CHUNKOBJECTS = "SELECT rowid,* FROM objects WHERE chunkX=? AND chunkY=?"
+    SQL_CELLOBJECTS = "SELECT rowid,* FROM objects WHERE chunkX=? AND chunkY=? AND x=? AND y=?"
+    SQL_OBJECTEXISTS = "SELECT rowid FROM objects WHERE rowid=?"
+    SQL_UPDATEOBJECT = "UPDATE objects SET x=?, y=?, chunkX=?, chunkY=?, icon=?, width=?, height=?, color=? WHERE rowid=?"
+    SQL_INSERTOBJECT = "INSERT INTO objects (x, y, chunkX, chunkY, icon, width, height, color) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    SQL_INSERTOBJECTID = "INSERT INTO objects (rowid, x, y, chunkX, chunkY, icon, width, height, color) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    SQL_SAVEOBJECT = "INSERT OR REPLACE INTO objects (rowid, x, y, chunkX, chunkY, icon, width, height, color) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, db, codec=False, wal=True, synchronous='NORMAL', cachedstatements=128):
+        """
+        The SQLite storage layer for a world
+         db is a filename (or ':memory:') or an open sqlite3 Connection. The
+         schema is created, or upgraded from an older version, automatically
+         codec is the TwoDimChunkCodec used to convert old chunk records
+        """
+        if type(db) == type(str()) or type(db) == type(u''):
+            db = sqlite3.connect(db, cached_statements=self.validate_int(cachedstatements, 'cachedstatements', minval=1))
+        self.db = db
+        self.c = db.cursor()
+        if codec == False:
+            codec = TwoDimChunkCodec()
+        self.codec = codec
+        synchronous = self.validate_str(synchronous, 'synchronous').upper()
+        if synchronous not in self.SYNCHRONOUS:
+            raise ValueError("synchronous not in " + str(self.SYNCHRONOUS) + " (" + synchronous + ")")
+        if wal:
+            self.c.execute("PRAGMA journal_mode=WAL")
+        self.c.execute("PRAGMA synchronous=" + synchronous)
+        self.upgrade()
+        # For reader(), which is called from other threads and can't use self.db
+        self.path = self.filename()
+        # Saves looking for changed cells in worlds that have none, see putdeltas()
+        #  (fetchall() so the cursor isn't left in the middle of the query)
+        self.c.execute(self.SQL_HASDELTAS)
+        self.hasdeltas = len(self.c.fetchall()) > 0
+
+    def version(self):
+        "Returns the schema version of the database"
+        self.c.execute("PRAGMA user_version")
+        return self.c.fetchall()[0][0]
+
+    def hastable(self, name):
+        "Returns True if the table exists"
+        self.c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
+        return len(self.c.fetchall()) > 0
+
+    def upgrade(self):
+        """
+        Creates the schema, or upgrades it one version at a time to SCHEMA_VERSION
+         Each step runs in its own transaction
+        """
+        version = self.version()
+        if version > self.SCHEMA_VERSION:
+            raise ValueError("Database schema version " + str(version) + " is newer than " + str(self.SCHEMA_VERSION))
+        # Manage the transactions ourselves, as some sqlite3 versions commit before DDL statements
+        isolation = self.db.isolation_level
+        self.db.isolation_level = None
+        try:
+            while version < self.SCHEMA_VERSION:
+                self.c.execute("BEGIN")
+                try:
+                    getattr(self, 'upgrade' + str(version + 1))()
+                    version += 1
+                    self.c.execute("PRAGMA user_version=" + str(version))
+                    self.c.execute("COMMIT")
+                except:
+                    self.c.execute("ROLLBACK")
+                    raise
+        finally:
+            self.db.isolation_level = isolation
+
+    def upgrade1(self):
+        """
+        Version 0 -> 1: (x, y) primary key on chunks with data stored as BLOBs
+         in the binary chunk format, and a (chunkX, chunkY, x, y) index on objects
+        """
+        self.c.execute("CREATE TABLE chunks_new (x INTEGER NOT NULL, y INTEGER NOT NULL, data BLOB, PRIMARY KEY (x, y))")
+        if self.hastable('chunks'):
+            # Unkeyed tables may hold more than one record per chunk, the newest wins
+            w = self.db.cursor()
+            for x, y, data in self.c.execute("SELECT x, y, data FROM chunks ORDER BY rowid"):
+                if not self.codec.isbinary(data):
+                    data = self.codec.encode(self.codec.decode(data))
+                w.execute("INSERT OR REPLACE INTO chunks_new (x, y, data) VALUES (?, ?, ?)", (x, y, sqlite3.Binary(data)))
+            self.c.execute("DROP TABLE chunks")
+        self.c.execute("ALTER TABLE chunks_new RENAME TO chunks")
+        # Object ids are the rowids, so the objects table is kept as it is
+        self.c.execute('''CREATE TABLE IF NOT EXISTS objects
+                          (x INTEGER, y INTEGER, chunkX INTEGER, chunkY INTEGER, icon TEXT, width INTEGER, height INTEGER, color INTEGER)''')
+        self.c.execute("CREATE INDEX IF NOT EXISTS objects_location ON objects (chunkX, chunkY, x, y)")
+
+    def upgrade2(self):
+        """
+        Version 1 -> 2: overview table of downsampled terrain classes, see
+         TwoDimOverview. Filled in as chunks are generated, or when first used
+        """
+        self.c.execute("CREATE TABLE overview (level INTEGER NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL, data BLOB, PRIMARY KEY (level, x, y))")
+
+    def upgrade3(self):
+        """
+        Version 2 -> 3: deltas table of the cells changed by TwoDimWorld.setcells(),
+         the new value of absolute cell cellx,celly of chunk x,y
+        """
+        self.c.execute("CREATE TABLE deltas (x INTEGER NOT NULL, y INTEGER NOT NULL, cellx INTEGER NOT NULL, celly INTEGER NOT NULL, value REAL, PRIMARY KEY (x, y, cellx, celly))")
+
+    def commit(self):
+        "Commits the current transaction"
+        self.db.commit()
+
+    def getchunk(self, chunkX, chunkY):
+        "Returns the data of chunk chunkX,chunkY, or None if it isn't in the database"
+        self.c.execute(self.SQL_GETCHUNK, (chunkX, chunkY))
+        record = self.c.fetchone()
+        if record is None:
+            return None
+        return record[0]
+
+    def countchunks(self, chunkX, chunkY):
+        "Returns the number of chunks in the database for chunkX,chunkY"
+        self.c.execute(self.SQL_COUNTCHUNK, (chunkX, chunkY))
+        return self.c.fetchone()[0]
+
+    def getchunkrect(self, minX, minY, maxX, maxY):
+        "Returns a list of (x, y, data) for every chunk from minX,minY to maxX,maxY (inclusive)"
+        self.c.execute(self.SQL_GETCHUNKRECT, (minX, maxX, minY, maxY))
+        return self.c.fetchall()
+
+    def allchunks(self, batchsize=1024):
+        "Yields (x, y, data) for every chunk in the database, reading batchsize at a time"
+        c = self.db.cursor()
+        c.execute(self.SQL_ALLCHUNKS)
+        while True:
+            rows = c.fetchmany(batchsize)
+            if len(rows) < 1:
+                break
+            for row in rows:
+                yield row
+
+    def chunkkeysrect(self, minX, minY, maxX, maxY):
+        "Returns a set of (x, y) for every chunk in the database from minX,minY to maxX,maxY (inclusive)"
+        self.c.execute(self.SQL_CHUNKKEYSRECT, (minX, maxX, minY, maxY))
+        return set(self.c.fetchall())
+
+    def putchunks(self, records, commit=True):
+        "Adds or replaces the chunks in records, a list of (x, y, data), in one transaction"
+        self.c.executemany(self.SQL_PUTCHUNK, [(x, y, sqlite3.Binary(data)) for x, y, data in records])
+        if commit:
+            self.db.commit()
+
+    def putchunk(self, chunkX, chunkY, data, commit=True):
+        "Adds or replaces a single chunk"
+        self.putchunks([(chunkX, chunkY, data)], commit)
+
+    def addchunks(self, records, commit=True):
+        """
+        Adds the chunks in records, a list of (x, y, data), in one transaction
+         Chunks that are already in the database are left alone, and returned
+         as a list of (x, y)
+        """
+        existing = []
+        for x, y, data in records:
+            self.c.execute(self.SQL_ADDCHUNK, (x, y, sqlite3.Binary(data)))
+            if self.c.rowcount < 1:
+                existing.append((x, y))
+        if commit:
+            self.db.commit()
+        return existing
+
+    def getoverviewrect(self, level, minX, minY, maxX, maxY):
+        "Returns a list of (x, y, data) for the overview level of every chunk from minX,minY to maxX,maxY (inclusive)"
+        self.c.execute(self.SQL_GETOVERVIEWRECT, (level, minX, maxX, minY, maxY))
+        return self.c.fetchall()
+
+    def putoverviews(self, records, commit=True):
+        "Adds or replaces the overview levels in records, a list of (level, x, y, data)"
+        self.c.executemany(self.SQL_PUTOVERVIEW, [(level, x, y, sqlite3.Binary(data)) for level, x, y, data in records])
+        if commit:
+            self.db.commit()
+
+    def getdeltas(self, chunkX, chunkY):
+        "Returns a list of (x, y, value) for every changed cell of chunk chunkX,chunkY"
+        if not self.hasdeltas:
+            return []
+        self.c.execute(self.SQL_GETDELTAS, (chunkX, chunkY))
+        return self.c.fetchall()
+
+    def getdeltasrect(self, minX, minY, maxX, maxY):
+        """
+        Returns a dictionary of {(chunkX, chunkY): [(x, y, value), ...]} for the
+         changed cells of every chunk from minX,minY to maxX,maxY (inclusive)
+        """
+        ret = {}
+        if not self.hasdeltas:
+            return ret
+        self.c.execute(self.SQL_GETDELTASRECT, (minX, maxX, minY, maxY))
+        for chunkX, chunkY, x, y, value in self.c.fetchall():
+            ret.setdefault((chunkX, chunkY), []).append((x, y, value))
+        return ret
+
+    def putdeltas(self, records, commit=True):
+        "Adds or replaces the changed cells in records, a list of (chunkX, chunkY, x, y, value)"
+        self.c.executemany(self.SQL_PUTDELTA, [tuple(record) for record in records])
+        if len(records):
+            self.hasdeltas = True
+        if commit:
+            self.db.commit()
+
+    def cleardeltas(self, chunkX, chunkY, commit=True):
+        "Forgets every changed cell of chunk chunkX,chunkY"
+        if self.hasdeltas:
+            self.c.execute(self.SQL_CLEARDELTAS, (chunkX, chunkY))
+        if commit:
+            self.db.commit()
+
+    def countdeltas(self):
+        "Returns the number of changed cells in the database"
+        self.c.execute(self.SQL_COUNTDELTAS)
+        return self.c.fetchone()[0]
+
+    def filename(self):
+        "Returns the filename of the database, or '' for an in-memory database"
+        for row in self.db.execute("PRAGMA database_list"):
+            if row[1] == 'main':
+                return row[2] or ''
+        return ''
+
+    def shareable(self):
+        "Returns True if reader() can read the same chunks from another thread"
+        return self.path != ''
+
+    def reader(self):
+        """
+        Returns a new storage object on the same chunks, for reading them from
+         another thread (a sqlite3 connection belongs to the thread that made
+         it). Needs shareable() == True. close() it when done
+        """
+        return TwoDimStorage(self.path, codec=self.codec, wal=False)
+
+    def close(self):
+        "Closes the database"
+        self.db.close()
+
+    def allobjects(self):
+        "Returns a list of every object record, (rowid, x, y, chunkX, chunkY, icon, width, height, color)"
+        self.c.execute(self.SQL_ALLOBJECTS)
+        return self.c.fetchall()
+
+    def streamobjects(self, sql, params=(), batchsize=256):
+        """
+        Yields the object records selected by sql as TwoDimObjectRecords,
+         reading batchsize at a time on a cursor of their own
+        """
+        c = self.db.cursor()
+        c.execute(sql, params)
+        try:
+            while True:
+                rows = c.fetchmany(batchsize)
+                if len(rows) < 1:
+                    break
+                for row in rows:
+                    yield tuple.__new__(TwoDimObjectRecord, row)
+        finally:
+            c.close()
+
+    def iterobjects(self, batchsize=256):
+        "Yields the record of every object in objid order, see streamobjects()"
+        return self.streamobjects(self.SQL_ITEROBJECTS, (), batchsize)
+
+    def rectobjects(self, minX, minY, maxX, maxY, batchsize=256):
+        "Yields the records of the objects in the chunks from minX,minY to maxX,maxY (inclusive), see streamobjects()"
+        return self.streamobjects(self.SQL_RECTOBJECTS, (minX, maxX, minY, maxY), batchsize)
+
+    def chunkobjects(self, chunkX, chunkY):
+        "Returns a list of the records of the objects in chunk chunkX,chunkY"
+        self.c.execute(self.SQL_CHUNKOBJECTS, (chunkX, chunkY))
+        return self.c.fetchall()
+
+    def cellobjects(self, chunkX, chunkY, x, y):
+        "Returns a list of the records of the objects at relative x,y in chunk chunkX,chunkY"
+        self.c.execute(self.SQL_CELLOBJECTS, (chunkX, chunkY, x, y))
+        return self.c.fetchall()
+
+    def insertobject(self, values, commit=True):
+        """
+        Adds an object, values is (x, y, chunkX, chunkY, icon, width, height, color)
+         Returns the new object id (rowid)
+        """
+        self.c.execute(self.SQL_INSERTOBJECT, tuple(values))
+        if commit:
+            self.db.commit()
+        return self.c.lastrowid
+
+    def saveobject(self, record, commit=True):
+        """
+        Updates (or adds, if it doesn't exist) an object from its record,
+         (rowid, x, y, chunkX, chunkY, icon, width, height, color)
+        """
+        self.c.execute(self.SQL_OBJECTEXISTS, (record[0],))
+        if self.c.fetchone() is None:
+            self.c.execute(self.SQL_INSERTOBJECTID, tuple(record))
+        else:
+            self.c.execute(self.SQL_UPDATEOBJECT, tuple(record[1:]) + (record[0],))
+        if commit:
+            self.db.commit()
+
+    def saveobjects(self, records, commit=True):
+        "Updates (or adds) the objects from a list of records, in one transaction"
+        self.c.executemany(self.SQL_SAVEOBJECT, [tuple(record) for record in records])
+        if commit:
+            self.db.commit()
+
+class TwoDimRegionFile(InputValidation):
+    # Region file format, all little-endian:
+    #  magic (4s), version (B), dtype (B), padding, regionsize (H), chunksize (H), slots (I)
+    #  then a regionsize x regionsize table of uint32 slot numbers (0 = no chunk,
+    #  row x is chunks x * regionsize ... x * regionsize + regionsize - 1)
+    #  then the slots, from DATA_ALIGN aligned offsets, each chunksize x chunksize
+    #  values of the dtype (see TwoDimChunkCodec.DTYPES), padded to DATA_ALIGN
+    MAGIC = b'SWRG'
+    VERSION = 1
+    HEADER = struct.Struct('<4sBBxxHHI')
+    DATA_ALIGN = 8
+
+    def __init__(self, path, regionsize=32, chunksize=False, dtype=1):
+        """
+        A region file of regionsize x regionsize chunks, accessed through mmap
+         An existing file is opened (its own header wins over the arguments),
+         otherwise it is created, which needs chunksize
+        """
+        self.path = path
+        if not os.path.exists(path):
+            if chunksize == False:
+                raise ValueError("chunksize is needed to create " + str(path))
+            self.create(regionsize, chunksize, dtype)
+        self.map()
+        magic, version, dtype, regionsize, chunksize, slots = self.HEADER.unpack_from(self.mm)
+        if magic != self.MAGIC:
+            raise ValueError(str(path) + " is not a region file")
+        if version > self.VERSION:
+            raise ValueError("Region format version " + str(version) + " is newer than " + str(self.VERSION))
+        if dtype not in TwoDimChunkCodec.DTYPES:
+            raise ValueError("Unknown chunk dtype " + str(dtype))
+        self.dtype = dtype
+        self.regionsize = regionsize
+        self.chunksize = chunksize
+        self.slots = slots
+        self.values = np.dtype(TwoDimChunkCodec.DTYPES[dtype])
+        self.data = self.align(self.HEADER.size + 4 * regionsize * regionsize)
+        self.slotbytes = self.align(chunksize * chunksize * self.values.itemsize)
+        self.maptable()
+        self.dirty = False
+
+    def align(self, offset):
+        "Returns offset rounded up to DATA_ALIGN"
+        return (offset + self.DATA_ALIGN - 1) // self.DATA_ALIGN * self.DATA_ALIGN
+
+    def create(self, regionsize, chunksize, dtype):
+        "Writes a new, empty region file"
+        f = open(self.path, 'wb')
+        try:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, dtype, regionsize, chunksize, 0))
+            f.write(b'\0' * (self.align(self.HEADER.size + 4 * regionsize * regionsize) - self.HEADER.size))
+        finally:
+            f.close()
+
+    def map(self):
+        """
+        Maps the whole file. A previous mapping is left to the arrays still
+         using it, it shows the same pages
+        """
+        f = open(self.path, 'r+b')
+        try:
+            self.mm = mmap.mmap(f.fileno(), 0)
+        finally:
+            f.close()
+
+    def maptable(self):
+        """
+        Makes self.table a view of the slot table, and self.slotdata (and its
+         read-only twin self.slotview) a capacity x chunksize x chunksize view
+         of every slot that fits the mapping
+        """
+        count = self.regionsize * self.regionsize
+        self.table = np.frombuffer(self.mm, dtype='<u4', count=count, offset=self.HEADER.size).reshape(self.regionsize, self.regionsize)
+        self.capacity = max(0, (len(self.mm) - self.data) // self.slotbytes)
+        size = self.chunksize
+        self.slotdata = np.ndarray((self.capacity, size, size), dtype=self.values, buffer=self.mm, offset=self.data,
+                                   strides=(self.slotbytes, size * self.values.itemsize, self.values.itemsize))
+        self.slotview = self.slotdata.view()
+        self.slotview.flags.writeable = False
+
+    def view(self, slot):
+        "Returns a chunksize x chunksize array of the values in slot (1 and up), straight from the mapping"
+        if slot > self.capacity:
+            # Another TwoDimRegionFile on the same file added slots since we mapped it
+            self.map()
+            self.maptable()
+        return self.slotdata[slot - 1]
+
+    def has(self, x, y):
+        "Returns True if chunk x,y (within the region) is in the file"
+        return self.table[x, y] != 0
+
+    def get(self, x, y):
+        """
+        Returns the read-only array of chunk x,y (within the region), or None
+         The array is a view of the file, nothing is copied
+        """
+        slot = int(self.table[x, y])
+        if slot == 0:
+            return None
+        if slot > self.capacity:
+            self.view(slot)
+        return self.slotview[slot - 1]
+
+    def put(self, x, y, dataset):
+        """
+        Writes the chunk x,y (within the region), in place if it's already in
+         the file (arrays from get() show the new values)
+        """
+        dataset = np.asarray(dataset)
+        if dataset.shape != (self.chunksize, self.chunksize):
+            raise ValueError("dataset shape != " + str((self.chunksize, self.chunksize)) + " (" + str(dataset.shape) + ")")
+        slot = int(self.table[x, y])
+        if slot == 0:
+            slot = self.slots + 1
+            self.reserve(slot)
+        self.view(slot)[...] = dataset
+        if self.table[x, y] == 0:
+            # Only publish the slot once it holds the chunk
+            self.slots = slot
+            self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.VERSION, self.dtype, self.regionsize, self.chunksize, self.slots)
+            self.table[x, y] = slot
+        self.dirty = True
+
+    def reserve(self, slots):
+        "Grows the file (by doubling) until it has room for slots slots"
+        need = self.data + slots * self.slotbytes
+        if need <= len(self.mm):
+            return
+        size = max(need, self.data + 2 * (len(self.mm) - self.data), self.data + 16 * self.slotbytes)
+        f = open(self.path, 'r+b')
+        try:
+            f.truncate(size)
+        finally:
+            f.close()
+        self.map()
+        self.maptable()
+
+    def keys(self, minX=0, minY=0, maxX=False, maxY=False):
+        "Returns a list of (x, y) (within the region) of the chunks in the file, limited to minX,minY to maxX,maxY (inclusive)"
+        if maxX == False:
+            maxX = self.regionsize - 1
+        if maxY == False:
+            maxY = self.regionsize - 1
+        xs, ys = np.nonzero(self.table[minX:maxX + 1, minY:maxY + 1])
+        return list(zip((xs + minX).tolist(), (ys + minY).tolist()))
+
+    def flush(self):
+        "Writes the changes to disk"
+        if self.dirty:
+            self.mm.flush()
+            self.dirty = False
+
+class TwoDimRegionStorage(TwoDimStorage):
+    def __init__(self, db, regiondir, codec=False, regionsize=32, **kwargs):
+        """
+        TwoDimStorage that keeps the chunks in region files in regiondir rather
+         than in the database, see TwoDimRegionFile. Objects and the overview
+         stay in the database. Use it in place of a TwoDimStorage
+        Chunks are read straight from the mapped files: getchunk() and
+         getchunkrect() return (read-only) arrays instead of chunk records,
+         which TwoDimChunkCodec.decode() passes through, so reading a chunk
+         copies nothing. Values are stored as codec.dtype, uncompressed
+        regionsize only applies to a new regiondir, an existing one keeps the
+         region size its files were made with
+        """
+        TwoDimStorage.__init__(self, db, codec, **kwargs)
+        self.regiondir = self.validate_str(regiondir, 'regiondir', blank=False)
+        self.regionsize = self.validate_int(regionsize, 'regionsize', minval=1, maxval=65535)
+        if not os.path.isdir(regiondir):
+            os.makedirs(regiondir)
+        # (regionX, regionY) -> TwoDimRegionFile
+        self.regions = {}
+        for regionX, regionY in self.regionkeys():
+            self.regionsize = TwoDimRegionFile(self.regionpath(regionX, regionY)).regionsize
+            break
+
+    def regionpath(self, regionX, regionY):
+        "Returns the path of region file regionX,regionY"
+        return os.path.join(self.regiondir, "r." + str(regionX) + "." + str(regionY) + ".swr")
+
+    def regionkeys(self):
+        "Returns a sorted list of (regionX, regionY) of every region file in regiondir"
+        ret = []
+        for name in os.listdir(self.regiondir):
+            parts = name.split('.')
+            if len(parts) == 4 and parts[0] == 'r' and parts[3] == 'swr':
+                ret.append((int(parts[1]), int(parts[2])))
+        ret.sort()
+        return ret
+
+    def region(self, regionX, regionY, chunksize=False):
+        "Returns the TwoDimRegionFile regionX,regionY, creating it if chunksize is given, otherwise None if there isn't one"
+        key = (regionX, regionY)
+        region = self.regions.get(key)
+        if region is None:
+            path = self.regionpath(regionX, regionY)
+            if chunksize == False and not os.path.exists(path):
+                return None
+            region = TwoDimRegionFile(path, self.regionsize, chunksize, self.codec.dtype)
+            if region.regionsize != self.regionsize:
+                raise ValueError(path + " has " + str(region.regionsize) + " chunks per side, not " + str(self.regionsize))
+            self.regions[key] = region
+        return region
+
+    def getchunk(self, chunkX, chunkY):
+        "Returns the array of chunk chunkX,chunkY, or None if it isn't stored"
+        regionX, x = divmod(chunkX, self.regionsize)
+        regionY, y = divmod(chunkY, self.regionsize)
+        region = self.region(regionX, regionY)
+        if region is None:
+            return None
+        return region.get(x, y)
+
+    def countchunks(self, chunkX, chunkY):
+        "Returns the number of chunks stored for chunkX,chunkY"
+        regionX, x = divmod(chunkX, self.regionsize)
+        regionY, y = divmod(chunkY, self.regionsize)
+        region = self.region(regionX, regionY)
+        if region is None or not region.has(x, y):
+            return 0
+        return 1
+
+    def regionsrect(self, minX, minY, maxX, maxY):
+        """
+        Yields (region, baseX, baseY, keys) for every region file with chunks
+         from minX,minY to maxX,maxY (inclusive), keys being the (x, y) of
+         those chunks within the region and baseX,baseY the first chunk of it
+        """
+        size = self.regionsize
+        for regionX in range(minX // size, maxX // size + 1):
+            for regionY in range(minY // size, maxY // size + 1):
+                region = self.region(regionX, regionY)
+                if region is None:
+                    continue
+                baseX = regionX * size
+                baseY = regionY * size
+                keys = region.keys(max(minX - baseX, 0), max(minY - baseY, 0), min(maxX - baseX, size - 1), min(maxY - baseY, size - 1))
+                yield (region, baseX, baseY, keys)
+
+    def chunkkeysrect(self, minX, minY, maxX, maxY):
+        "Returns a list of (x, y) of every stored chunk from minX,minY to maxX,maxY (inclusive)"
+        ret = []
+        for region, baseX, baseY, keys in self.regionsrect(minX, minY, maxX, maxY):
+            ret.extend((baseX + x, baseY + y) for x, y in keys)
+        return ret
+
+    def getchunkrect(self, minX, minY, maxX, maxY):
+        "Returns a list of (x, y, array) for every stored chunk from minX,minY to maxX,maxY (inclusive)"
+        ret = []
+        for region, baseX, baseY, keys in self.regionsrect(minX, minY, maxX, maxY):
+            ret.extend((baseX + x, baseY + y, region.get(x, y)) for x, y in keys)
+        return ret
+
+    def allchunks(self, batchsize=1024):
+        "Yields (x, y, array) for every stored chunk"
+        for regionX, regionY in self.regionkeys():
+            region = self.region(regionX, regionY)
+            for x, y in region.keys():
+                yield (regionX * self.regionsize + x, regionY * self.regionsize + y, region.get(x, y))
+
+    def putdataset(self, chunkX, chunkY, dataset):
+        "Writes the array dataset as chunk chunkX,chunkY"
+        regionX, x = divmod(chunkX, self.regionsize)
+        regionY, y = divmod(chunkY, self.regionsize)
+        self.region(regionX, regionY, dataset.shape[0]).put(x, y, dataset)
+
+    def putchunks(self, records, commit=True):
+        "Adds or replaces the chunks in records, a list of (x, y, data) with data a chunk record or array"
+        for x, y, data in records:
+            self.putdataset(x, y, self.codec.decode(data))
+        if commit:
+            self.commit()
+
+    def putchunk(self, chunkX, chunkY, data, commit=True):
+        "Adds or replaces a chunk, data is a chunk record or array"
+        self.putchunks([(chunkX, chunkY, data)], commit)
+
+    def addchunks(self, records, commit=True):
+        """
+        Adds the chunks in records, a list of (x, y, data). Chunks that are
+         already stored are left alone, and returned as a list of (x, y)
+        """
+        existing = []
+        for x, y, data in records:
+            if self.countchunks(x, y) > 0:
+                existing.append((x, y))
+            else:
+                self.putdataset(x, y, self.codec.decode(data))
+        if commit:
+            self.commit()
+        return existing
+
+    def commit(self):
+        "Writes the changed region files to disk and commits the current transaction"
+        for region in self.regions.values():
+            region.flush()
+        self.db.commit()
+
+    def shareable(self):
+        "Returns True, the region files can always be read from another thread"
+        return True
+
+    def reader(self):
+        """
+        Returns a new TwoDimRegionStorage on the same region files (and
+         database, if it isn't in memory) for reading them from another thread
+        """
+        return TwoDimRegionStorage(self.path or ':memory:', self.regiondir, self.codec, self.regionsize, wal=False)
+
+    def close(self):
+        """
+        Writes the changed region files to disk and closes the database. The
+         mappings stay open while arrays from them are in use
+        """
+        for region in self.regions.values():
+            region.flush()
+        self.regions = {}
+        self.db.close()
+
+class TwoDimObjectRegistry(InputValidation):
+    def __init__(self, worldsettings):
+        """
+        In-memory spatial index of object records, (objid, x, y, chunkX, chunkY, icon, width, height, color)
+         Chunks are indexed by cell the first time they are needed, after that
+         the registry (not the database) is the authority on where objects are
+        """
+        self.world = worldsettings
+        # (chunkX, chunkY) -> {(x, y): [record, ...]} for every indexed chunk
+        self.chunks = {}
+        # objid -> record, for every object the registry knows about
+        self.objects = {}
+        # (chunkX, chunkY) -> {objid: record} for objects that moved into chunks that aren't indexed yet
+        self.pending = {}
+
+    def loadchunk(self, chunkX, chunkY):
+        "Returns the {(x, y): [record, ...]} index of chunkX,chunkY, indexing it if needed"
+        key = (chunkX, chunkY)
+        cells = self.chunks.get(key)
+        if cells is not None:
+            return cells
+        cells = {}
+        self.chunks[key] = cells
+        pending = self.pending.pop(key, {})
+        stats = self.world.stats
+        start = stats.begin()
+        records = self.world.storage.chunkobjects(chunkX, chunkY)
+        stats.add('sql', start)
+        for rec in records:
+            # The database may be behind us, in which case our copy wins
+            rec = self.objects.get(rec[0], rec)
+            if (rec[3], rec[4]) == key and rec[0] not in pending:
+                self.addrecord(cells, rec)
+        for rec in pending.values():
+            self.addrecord(cells, rec)
+        return cells
+
+    def addrecord(self, cells, rec):
+        "Adds rec to the cell index cells, keeping each cell in objid order"
+        self.objects[rec[0]] = rec
+        cell = cells.setdefault((rec[1], rec[2]), [])
+        cell.append(rec)
+        if len(cell) > 1 and cell[-2][0] > rec[0]:
+            cell.sort()
+
+    def chunkobjects(self, chunkX, chunkY):
+        "Returns a list of the records of the objects in chunk chunkX,chunkY, in objid order"
+        ret = []
+        for cell in self.loadchunk(chunkX, chunkY).values():
+            ret.extend(cell)
+        ret.sort()
+        return ret
+
+    def cellobjects(self, chunkX, chunkY, x, y):
+        "Returns a list of the records of the objects at relative x,y in chunk chunkX,chunkY"
+        return list(self.loadchunk(chunkX, chunkY).get((x, y), ()))
+
+    def remove(self, objid):
+        "Removes object objid from the index, returns its old record (or None)"
+        rec = self.objects.pop(objid, None)
+        if rec is None:
+            return None
+        key = (rec[3], rec[4])
+        cells = self.chunks.get(key)
+        if cells is None:
+            self.pending.get(key, {}).pop(objid, None)
+            return rec
+        cell = cells.get((rec[1], rec[2]), [])
+        for i in range(len(cell)):
+            if cell[i][0] == objid:
+                del cell[i]
+                break
+        if len(cell) < 1:
+            cells.pop((rec[1], rec[2]), None)
+        return rec
+
+    def update(self, record):
+        "Adds or moves an object, record is its (new) record"
+        record = tuple(record)
+        self.remove(record[0])
+        key = (record[3], record[4])
+        cells = self.chunks.get(key)
+        if cells is None:
+            # Index it once the chunk is needed
+            self.objects[record[0]] = record
+            self.pending.setdefault(key, {})[record[0]] = record
+        else:
+            self.addrecord(cells, record)
+
+class TwoDimWriteBehind(InputValidation):
+    def __init__(self, worldsettings, interval=1.0, maxdirty=64):
+        """
+        Batches object writes, see TwoDimMoveable.write2db()
+         Dirty objects are written in a single transaction once the oldest
+         has waited interval seconds, or maxdirty objects are dirty. poll()
+         needs to be called regularly (e.g. from the input loop) and flush()
+         on shutdown, so at most interval seconds of movement can be lost
+        """
+        self.world = worldsettings
+        if type(interval) == type(int()):
+            interval = float(interval)
+        if type(interval) != type(float()) or interval < 0:
+            raise ValueError("interval is not a positive number (" + str(interval) + ")")
+        self.interval = interval
+        self.maxdirty = self.validate_int(maxdirty, 'maxdirty', minval=1)
+        # objid -> newest record
+        self.dirty = {}
+        # When the oldest dirty record was marked
+        self.since = 0
+        self.flushes = 0
+        self.written = 0
+
+    def mark(self, record):
+        "Marks an object dirty, record is its newest record"
+        if len(self.dirty) < 1:
+            self.since = time.time()
+        self.dirty[record[0]] = tuple(record)
+        self.poll()
+
+    def markmany(self, records):
+        "Marks several objects dirty at once, records is a list of their newest records"
+        if len(records) < 1:
+            return
+        if len(self.dirty) < 1:
+            self.since = time.time()
+        for record in records:
+            self.dirty[record[0]] = tuple(record)
+        self.poll()
+
+    def poll(self):
+        "Flushes the dirty objects if the interval has passed or there are too many of them"
+        if len(self.dirty) < 1:
+            return
+        if len(self.dirty) >= self.maxdirty or time.time() - self.since >= self.interval:
+            self.flush()
+
+    def flush(self):
+        "Writes every dirty object to the database, in one transaction"
+        if len(self.dirty) < 1:
+            return
+        stats = self.world.stats
+        start = stats.begin()
+        self.world.storage.saveobjects(self.dirty.values())
+        stats.add('commit', start)
+        self.written += len(self.dirty)
+        self.flushes += 1
+        self.dirty = {}
+
+class TwoDimStats(InputValidation):
+    # The phases timed by the solar classes, in display order
+    PHASES = ('sql', 'decode', 'noise', 'draw', 'refresh', 'commit', 'move', 'path')
+
+    def __init__(self, enabled=False, samples=1024):
+        """
+        Call counts and timings of the hot paths, by phase (see PHASES)
+         Every TwoDimWorldSettings has one, in TwoDimWorldSettings.stats
+         Nothing is recorded until enabled == True, and while it's False the
+         only cost is the call of begin() and add() at each timed call
+        Only calls on the thread that created the stats are recorded, the
+         prefetcher's generation in the background isn't
+        Timings are inclusive: a draw that has to load its chunk counts as
+         both 'draw' and 'sql'. Percentiles are of the last samples calls of
+         each phase, counts and totals are of every call since reset()
+        """
+        self.enabled = enabled
+        self.samples = self.validate_int(samples, 'samples', minval=1)
+        self.clock = getattr(time, 'perf_counter', time.time)
+        self.thread = threading.current_thread()
+        self.reset()
+
+    def reset(self):
+        "Forgets everything recorded so far"
+        # phase -> [count, total seconds, max seconds, deque of recent seconds]
+        self.phases = {}
+        self.since = time.time()
+
+    def begin(self):
+        """
+        Returns the start of a call to pass to add(), or None if it shouldn't
+         be recorded (not enabled, or not on the thread that created the stats)
+        """
+        if not self.enabled or threading.current_thread() is not self.thread:
+            return None
+        return self.clock()
+
+    def add(self, phase, start):
+        "Records a call of phase that began when begin() returned start, unless that was None"
+        if start is None:
+            return
+        elapsed = self.clock() - start
+        entry = self.phases.get(phase)
+        if entry is None:
+            entry = [0, 0.0, 0.0, deque(maxlen=self.samples)]
+            self.phases[phase] = entry
+        entry[0] += 1
+        entry[1] += elapsed
+        if elapsed > entry[2]:
+            entry[2] = elapsed
+        entry[3].append(elapsed)
+
+    def summary(self):
+        """
+        Returns a list of dictionaries, one per phase that has been recorded:
+         phase, count, total, mean, p50, p90, p99 and max (in seconds)
+        """
+        ret = []
+        order = list(self.PHASES) + sorted(phase for phase in self.phases if phase not in self.PHASES)
+        for phase in order:
+            entry = self.phases.get(phase)
+            if entry is None:
+                continue
+            count, total, longest, recent = entry
+            recent = sorted(recent)
+            ret.append({'phase': phase,
+                        'count': count,
+                        'total': total,
+                        'mean': total / count,
+                        'p50': recent[min(len(recent) - 1, len(recent) * 50 // 100)],
+                        'p90': recent[min(len(recent) - 1, len(recent) * 90 // 100)],
+                        'p99': recent[min(len(recent) - 1, len(recent) * 99 // 100)],
+                        'max': longest})
+        return ret
+
+    def lines(self):
+        "Returns the summary() as a list of lines of text, times in microseconds"
+        ret = ["%-8s %8s %9s %8s %8s %8s %9s" % ('phase', 'count', 'total ms', 'p50 us', 'p90 us', 'p99 us', 'max us')]
+        for row in self.summary():
+            ret.append("%-8s %8d %9.1f %8.1f %8.1f %8.1f %9.1f" % (row['phase'], row['count'], row['total'] * 1e3,
+                                                                row['p50'] * 1e6, row['p90'] * 1e6, row['p99'] * 1e6, row['max'] * 1e6))
+        return ret
+
+    def show(self, win):
+        "Draws lines() over the contents of curses window win"
+        if not self.iscurseswin(win):
+            return
+        h, w = win.getmaxyx()
+        win.erase()
+        for line, text in enumerate(self.lines()[:h]):
+            win.addstr(line, 0, text[:w - 1])
+        win.refresh()
+
+    def savejson(self, path):
+        "Writes the summary() to path as JSON"
+        f = open(path, 'w')
+        try:
+            json.dump({'since': self.since, 'time': time.time(), 'phases': self.summary()}, f, indent=1)
+        finally:
+            f.close()
+
+    def savecsv(self, path):
+        "Writes the summary() to path as CSV, one line per phase"
+        columns = ('phase', 'count', 'total', 'mean', 'p50', 'p90', 'p99', 'max')
+        f = open(path, 'w')
+        try:
+            f.write(','.join(columns) + "\n")
+            for row in self.summary():
+                f.write(','.join(str(row[column]) for column in columns) + "\n")
+        finally:
+            f.close()
+
+    def saveprofile(self, path):
+        """
+        Writes the phases to path in the format of cProfile's dump_stats(),
+         one pseudo-function per phase, so pstats/snakeviz etc. can read it
+        """
+        stats = {}
+        for row in self.summary():
+            stats[('solar.py', 0, row['phase'])] = (row['count'], row['count'], row['total'], row['total'], {})
+        f = open(path, 'wb')
+        try:
+            marshal.dump(stats, f)
+        finally:
+            f.close()
+
 class TwoDimWorldSettings(InputValidation):
     def __init__(self,
         seed=1234567890,
@@ -333,8 +1599,18 @@ class TwoDimWorldSettings(InputValidation):
         height=1,
         debugwin=False,
         db=False,
-        c=False):
-        "Stores the settings for a two-dimensional world"
+        c=False,
+        storage=False,
+        cachechunks=64,
+        cachebytes=False,
+        chunkcompress=False,
+        pristine=False):
+        """
+        Stores the settings for a two-dimensional world
+         A pristine world never stores the chunks it generates, they are
+         generated again whenever they aren't cached, only the cells changed by
+         TwoDimWorld.setcells() are kept in the database
+        """
         # Validate and store the settings
         # Validate debugwin first so that everything else can access it
         self.debugwin = self.validate_win(debugwin, 'debugwin', falseok=True)
@@ -346,22 +1622,187 @@ class TwoDimWorldSettings(InputValidation):
         self.colormap = self.validate_dict(colormap, 'colormap', mincount=1)
         self.width = self.validate_int(width, 'width', minval=1, maxval=chunksize)
         self.height = self.validate_int(height, 'height', minval=1, maxval=chunksize)
-        # TODO: Update all the db stuff to use self.db and self.c
         self.db = self.validate_db(db, 'db')
         self.c = self.validate_dbcur(c, 'c')
+        # All database access goes through the TwoDimStorage
+        self.storage = storage
+        # Where every object is, see TwoDimMoveable.write2db()
+        self.registry = TwoDimObjectRegistry(self)
+        # Set to a TwoDimWriteBehind to batch object writes
+        self.writebehind = False
+        # Set to a TwoDimPrefetcher to load chunks ahead of the objects it watches
+        self.prefetcher = False
+        # Only store changed cells, see TwoDimWorld.regenerate()
+        self.pristine = pristine == True
+        # The TwoDimWorld that regenerates the chunks of a pristine world, set by TwoDimWorld
+        self.generator = False
+        # Hot path instrumentation, set stats.enabled = True to record
+        self.stats = TwoDimStats()
+        # Interned object appearances, see TwoDimCommon.getappearance()
+        self.appearances = {}
+        # Objects with a chunkchanged(chunks) method, see TwoDimCommon.chunkschanged()
+        self.chunklisteners = []
+        # Markers (already width characters wide) and colors, indexed by terrain class
+        #  each TwoDimRenderer turns colorlut into its own attributes
+        self.markerlut = []
+        self.colorlut = []
+        for terr in range(len(self.markermap) + 2):
+            self.markerlut.append(self.markermap.get(terr, self.defmarker) * self.width)
+            self.colorlut.append(self.colormap.get(terr, self.defcolor))
+        # Chunks shared by everything using these settings (TwoDimWorld, TwoDimDrawing, etc)
+        self.cache = TwoDimChunkCache(maxchunks=cachechunks, maxbytes=cachebytes)
+        # Encodes/decodes the binary chunk format stored in chunks.data
+        self.codec = TwoDimChunkCodec(compress=chunkcompress)
+
+class TwoDimNoise(InputValidation):
+    # OpenSimplex 2D constants, these MUST match the opensimplex package
+    STRETCH = -0.211324865405187    # (1/Math.sqrt(2+1)-1)/2
+    SQUISH = 0.366025403784439      # (Math.sqrt(2+1)-1)/2
+    NORM = 47
+    GRADIENTS = np.array([ 5,  2,  2,  5,
+                          -5,  2, -2,  5,
+                           5, -2,  2, -5,
+                          -5, -2, -2, -5], dtype=np.int64)
+
+    def __init__(self, simplexobj):
+        """
+        Generates OpenSimplex 2D noise for whole grids of coordinates at once
+         Uses the permutation table of simplexobj, so the values are identical
+         to calling simplexobj.noise2d(x, y) for every cell
+        """
+        self.smp = simplexobj
+        perm = getattr(simplexobj, '_perm', None)
+        if perm is None:
+            # Not an OpenSimplex we know the internals of, fall back to per-cell noise
+            self.perm = None
+        else:
+            self.perm = np.asarray(perm, dtype=np.int64)
+
+    def noise2d(self, x, y):
+        "Returns the noise value at x,y from the underlying OpenSimplex object"
+        # opensimplex < 0.4 calls it noise2d(), newer versions call it noise2()
+        if hasattr(self.smp, 'noise2d'):
+            return self.smp.noise2d(x=x, y=y)
+        return self.smp.noise2(x, y)
+
+    def grid(self, xs, ys):
+        """
+        Returns an array of shape (len(xs), len(ys)) where [i][j] is the noise
+         value at xs[i],ys[j]
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        if self.perm is None:
+            ret = np.empty((xs.size, ys.size), dtype=np.float64)
+            for i in range(xs.size):
+                for j in range(ys.size):
+                    ret[i, j] = self.noise2d(float(xs[i]), float(ys[j]))
+            return ret
+        x, y = np.meshgrid(xs, ys, indexing='ij')
+        return self.noise(x, y)
+
+    def extrapolate(self, xsb, ysb, dx, dy):
+        "Returns the gradient contribution of the lattice points xsb,ysb"
+        index = self.perm[(self.perm[xsb & 0xFF] + ysb) & 0xFF] & 0x0E
+        return self.GRADIENTS[index] * dx + self.GRADIENTS[index + 1] * dy
+
+    def contribution(self, value, xsb, ysb, dx, dy):
+        "Adds the contribution of the lattice points xsb,ysb to value (in place)"
+        attn = 2 - dx * dx - dy * dy
+        mask = attn > 0
+        if mask.any():
+            attn = attn[mask]
+            attn *= attn
+            value[mask] += attn * attn * self.extrapolate(xsb[mask], ysb[mask], dx[mask], dy[mask])
+
+    def noise(self, x, y):
+        """
+        Returns the noise values for the arrays of coordinates x,y
+         This is the opensimplex noise2d() algorithm with every branch turned
+         into a mask, so that the whole array is computed in one pass
+        """
+        # Place input coordinates onto grid
+        stretch_offset = (x + y) * self.STRETCH
+        xs = x + stretch_offset
+        ys = y + stretch_offset
+        # Floor to get grid coordinates of rhombus (stretched square) super-cell origin
+        xsb = np.floor(xs).astype(np.int64)
+        ysb = np.floor(ys).astype(np.int64)
+        # Skew out to get actual coordinates of rhombus origin
+        squish_offset = (xsb + ysb) * self.SQUISH
+        xb = xsb + squish_offset
+        yb = ysb + squish_offset
+        # Compute grid coordinates relative to rhombus origin
+        xins = xs - xsb
+        yins = ys - ysb
+        in_sum = xins + yins
+        # Positions relative to origin point
+        dx0 = x - xb
+        dy0 = y - yb
+
+        value = np.zeros(x.shape, dtype=np.float64)
+        # Contribution (1,0)
+        self.contribution(value, xsb + 1, ysb + 0, dx0 - 1 - self.SQUISH, dy0 - 0 - self.SQUISH)
+        # Contribution (0,1)
+        self.contribution(value, xsb + 0, ysb + 1, dx0 - 0 - self.SQUISH, dy0 - 1 - self.SQUISH)
+
+        # Which triangle (2-Simplex) we're in, and which vertices are closest
+        lower = in_sum <= 1
+        zins = np.where(lower, 1 - in_sum, 2 - in_sum)
+        near0 = np.where(lower, (zins > xins) | (zins > yins), (zins < xins) | (zins < yins))
+        xgty = xins > yins
+        squish2 = 2 * self.SQUISH
+
+        # Extra vertex, inside the triangle at (0,0)
+        xsv_ext = np.where(near0, np.where(xgty, xsb + 1, xsb - 1), xsb + 1)
+        ysv_ext = np.where(near0, np.where(xgty, ysb - 1, ysb + 1), ysb + 1)
+        dx_ext = np.where(near0, np.where(xgty, dx0 - 1, dx0 + 1), dx0 - 1 - squish2)
+        dy_ext = np.where(near0, np.where(xgty, dy0 + 1, dy0 - 1), dy0 - 1 - squish2)
+        # Extra vertex, inside the triangle at (1,1)
+        upper = ~lower
+        xsv_ext[upper] = np.where(near0, np.where(xgty, xsb + 2, xsb + 0), xsb)[upper]
+        ysv_ext[upper] = np.where(near0, np.where(xgty, ysb + 0, ysb + 2), ysb)[upper]
+        dx_ext[upper] = np.where(near0, np.where(xgty, dx0 - 2 - squish2, dx0 + 0 - squish2), dx0)[upper]
+        dy_ext[upper] = np.where(near0, np.where(xgty, dy0 + 0 - squish2, dy0 - 2 - squish2), dy0)[upper]
+        # Inside the triangle at (1,1) the base vertex is (1,1) rather than (0,0)
+        xsb = np.where(upper, xsb + 1, xsb)
+        ysb = np.where(upper, ysb + 1, ysb)
+        dx0 = np.where(upper, dx0 - 1 - squish2, dx0)
+        dy0 = np.where(upper, dy0 - 1 - squish2, dy0)
+
+        # Contribution (0,0) or (1,1)
+        self.contribution(value, xsb, ysb, dx0, dy0)
+        # Extra vertex
+        self.contribution(value, xsv_ext, ysv_ext, dx_ext, dy_ext)
+        return value / self.NORM
 
 class TwoDimWorld(TwoDimCommon):
     def __init__(self, simplexobj, worldsettings):
         # Set this before we do ANYTHING so that if possible we have a debug window
         self.smp = self.validate_smp(simplexobj, 'simplexobj')
         self.world = self.validate_worldset(worldsettings, 'worldsettings')
+        self.noise = TwoDimNoise(self.smp)
+        if self.world.generator == False:
+            self.world.generator = self
 
     def genchunk(self, chunkX, chunkY, replace=False):
         """
         Generates a new chunk, adds it to the database, and returns the chunk data
+         replace == True also forgets the changed cells of the chunk
+        A pristine world doesn't store it, see regenerate()
         """
-        dataset = []
-
+        # A cached chunk is already in the database
+        if replace == False and (chunkX, chunkY) in self.world.cache:
+            return self.loadchunk(chunkX, chunkY, loadneighbors=False)
+        if self.world.pristine:
+            if replace:
+                self.world.storage.cleardeltas(chunkX, chunkY)
+                self.world.cache.invalidate(chunkX, chunkY)
+            chunk = self.fetchchunk(chunkX, chunkY)
+            if replace:
+                self.chunkschanged([chunk])
+                self.world.storage.commit()
+            return chunk.dataset
         # Check and see if this chunk is already in the database
         count = self.chunksindb(chunkX, chunkY)
         if count > 0 and replace == False:
@@ -370,28 +1811,111 @@ class TwoDimWorld(TwoDimCommon):
         # EITHER count == 0 OR replace == True, so we need to generate a new chunk
         # Generate the dataset
         # self.debug("Generating new chunk data for " + str(chunkX) + ", " + str(chunkY))
-        i = 0
-        for x in range(chunkX * self.world.chunksize, (chunkX * self.world.chunksize) + self.world.chunksize):
-            dataset.append([])
-            for y in range(chunkX * self.world.chunksize, (chunkX * self.world.chunksize) + self.world.chunksize):
-                dataset[i].append(self.smp.noise2d(x=x,y=y))
-            i += 1
-
-        if count > 0 and replace == True:
-            self.world.c.execute("DELETE FROM chunks WHERE x=" + str(chunkX) + " and y=" + str(chunkY))
-            self.world.db.commit()
-        if count == 0 or replace == True:
-            self.world.c.execute("INSERT INTO chunks (x, y, data) VALUES (" + str(chunkX) +  ", " + str(chunkY) + ", " + "'" + pickle.dumps(dataset) + "'" + ")")
-            self.world.db.commit()
+        dataset = self.world.codec.prepare(self.gendata(chunkX, chunkY))
+
+        # Adds the chunk, or replaces the existing one
+        stats = self.world.stats
+        start = stats.begin()
+        self.world.storage.putchunk(chunkX, chunkY, self.world.codec.encode(dataset), commit=False)
+        if replace:
+            self.world.storage.cleardeltas(chunkX, chunkY, commit=False)
+        stats.add('sql', start)
+        dataset = self.applydeltas(chunkX, chunkY, dataset)
+        # Write through to the cache, replacing any stale copy of the chunk
+        chunk = self.world.cache.put(TwoDimChunk(dataset, self.world, chunkX, chunkY))
+        self.chunkschanged([chunk])
+        start = stats.begin()
+        self.world.storage.commit()
+        stats.add('commit', start)
         return dataset
 
-    def chunksindb(self, chunkX, chunkY):
+    def regenerate(self, chunkX, chunkY):
         """
-        Returns the number of chunks in the database for chunkX,chunkY
+        Generates chunkX,chunkY again, with its changed cells, and caches it
+         without storing it. Returns the TwoDimChunk. Used by pristine worlds,
+         whose unchanged terrain only exists in the cache
         """
-        self.world.c.execute("SELECT * FROM chunks WHERE x=" + str(chunkX) + " and y=" + str(chunkY))
-        records = self.world.c.fetchall()
-        return len(records)
+        dataset = self.world.codec.prepare(self.gendata(chunkX, chunkY))
+        dataset = self.applydeltas(chunkX, chunkY, dataset)
+        return self.world.cache.put(TwoDimChunk(dataset, self.world, chunkX, chunkY))
+
+    def setcell(self, chunkX, chunkY, x, y, value):
+        "Changes the terrain value of absolute cell x,y of chunk chunkX,chunkY, see setcells()"
+        return self.setcells([(chunkX, chunkY, x, y, value)])
+
+    def setcells(self, cells):
+        """
+        Changes the terrain value of cells, a list of (chunkX, chunkY, x, y, value)
+         with x,y ABSOLUTE. Only the changed cells are stored, in one transaction,
+         on top of whatever the chunk was generated (or stored) as
+         The chunks are replaced in the cache and passed to chunkschanged()
+         Returns the list of changed TwoDimChunks
+        """
+        cells = self.validate_list(cells, 'cells')
+        bychunk = {}
+        for chunkX, chunkY, x, y, value in cells:
+            chunkX = self.validate_int(chunkX, 'chunkX')
+            chunkY = self.validate_int(chunkY, 'chunkY')
+            x, y = self.validate_abs(x, y)
+            if type(value) not in (type(int()), type(float())):
+                raise TypeError("value is not an int or float (" + str(type(value)) + ")")
+            bychunk.setdefault((chunkX, chunkY), []).append((x, y, float(value)))
+        records = []
+        chunks = []
+        for (chunkX, chunkY), changes in bychunk.items():
+            dataset = self.applydeltas(chunkX, chunkY, self.loadchunk(chunkX, chunkY, loadneighbors=False), changes)
+            chunks.append(self.world.cache.put(TwoDimChunk(dataset, self.world, chunkX, chunkY)))
+            records.extend([(chunkX, chunkY, x, y, value) for x, y, value in changes])
+        stats = self.world.stats
+        start = stats.begin()
+        self.world.storage.putdeltas(records, commit=False)
+        stats.add('sql', start)
+        self.chunkschanged(chunks)
+        start = stats.begin()
+        self.world.storage.commit()
+        stats.add('commit', start)
+        return chunks
+
+    def gendata(self, chunkX, chunkY):
+        """
+        Returns newly generated terrain data for chunkX,chunkY as a
+         chunksize x chunksize array, without touching the database
+        """
+        return self.gendatablock(chunkX, chunkY)[(chunkX, chunkY)]
+
+    def gendatablock(self, chunkX, chunkY, countX=1, countY=1):
+        """
+        Generates the terrain data for a block of countX x countY chunks,
+         starting at chunkX,chunkY, in a single pass
+         Returns a dictionary of {(chunkX, chunkY): dataset}
+        """
+        chunkX = self.validate_int(chunkX, 'chunkX')
+        chunkY = self.validate_int(chunkY, 'chunkY')
+        countX = self.validate_int(countX, 'countX', minval=1)
+        countY = self.validate_int(countY, 'countY', minval=1)
+        size = self.world.chunksize
+        xs = np.arange(chunkX * size, (chunkX + countX) * size)
+        ys = np.arange(chunkY * size, (chunkY + countY) * size)
+        stats = self.world.stats
+        start = stats.begin()
+        block = self.noise.grid(xs, ys)
+        stats.add('noise', start)
+        ret = {}
+        for i in range(countX):
+            for j in range(countY):
+                # Copy so that each chunk owns its data rather than a view of the block
+                ret[(chunkX + i, chunkY + j)] = block[i * size:(i + 1) * size, j * size:(j + 1) * size].copy()
+        return ret
+
+    def chunksindb(self, chunkX, chunkY):
+        """
+        Returns the number of chunks in the database for chunkX,chunkY
+        """
+        stats = self.world.stats
+        start = stats.begin()
+        ret = self.world.storage.countchunks(chunkX, chunkY)
+        stats.add('sql', start)
+        return ret
 
     def loadchunk(self, chunkX, chunkY, loadneighbors=True):
         """
@@ -402,40 +1926,1644 @@ class TwoDimWorld(TwoDimCommon):
         """
         # self.debug("LOADCHUNK(" + str(chunkX) + ", " + str(chunkY) + ")")
         if loadneighbors:
-            # load  the neighboring chunks, x/y -1, 0, +1 -- but range() skips the last value so we do +2
-            for x in range(chunkX - 1, chunkX + 2):
-                for y in range(chunkY - 1, chunkY + 2):
-                    # attempt to load  the chunk so that any that don't exist are created
-                    dataset = self.loadchunk(x, y, loadneighbors=False)
-
-        self.world.c.execute("SELECT * FROM chunks WHERE x=" + str(chunkX) + " and y=" + str(chunkY))
-        records = self.world.c.fetchall()
-        if len(records) < 1:
+            # load the neighboring chunks, x/y -1, 0, +1, generating any that don't exist
+            return self.loadrect(chunkX - 1, chunkY - 1, chunkX + 1, chunkY + 1)[(chunkX, chunkY)]
+
+        chunk = self.fetchchunk(chunkX, chunkY)
+        if chunk is None:
             dataset = self.genchunk(chunkX, chunkY)
         else:
-            dataset = pickle.loads(records[0][2])
+            dataset = chunk.dataset
         return dataset
 
+    def loadrect(self, minX, minY, maxX, maxY):
+        """
+        Loads every chunk from minX,minY to maxX,maxY (inclusive) and returns
+         a dictionary of {(chunkX, chunkY): dataset}
+        Chunks that aren't cached are read with a single query, and any that
+         don't exist are generated together and added in a single transaction
+         (a pristine world only caches them)
+        """
+        minX = self.validate_int(minX, 'minX')
+        minY = self.validate_int(minY, 'minY')
+        maxX = self.validate_int(maxX, 'maxX', minval=minX)
+        maxY = self.validate_int(maxY, 'maxY', minval=minY)
+        ret = {}
+        missing = []
+        for x in range(minX, maxX + 1):
+            for y in range(minY, maxY + 1):
+                chunk = self.world.cache.get(x, y)
+                if chunk is None and self.world.prefetcher != False:
+                    # Don't load a chunk the prefetcher is already working on
+                    chunk = self.world.prefetcher.claim(x, y)
+                if chunk is None:
+                    missing.append((x, y))
+                else:
+                    ret[(x, y)] = chunk.dataset
+        if len(missing) < 1:
+            return ret
+
+        # Read everything that's in the database, limited to the area that wasn't cached
+        xs = [key[0] for key in missing]
+        ys = [key[1] for key in missing]
+        stats = self.world.stats
+        start = stats.begin()
+        records = self.world.storage.getchunkrect(min(xs), min(ys), max(xs), max(ys))
+        deltas = self.world.storage.getdeltasrect(min(xs), min(ys), max(xs), max(ys))
+        stats.add('sql', start)
+        for x, y, data in records:
+            if (x, y) not in ret:
+                start = stats.begin()
+                dataset = self.unpackchunk(data)
+                stats.add('decode', start)
+                dataset = self.applydeltas(x, y, dataset, deltas.get((x, y), []))
+                chunk = self.world.cache.put(TwoDimChunk(dataset, self.world, x, y))
+                ret[(x, y)] = chunk.dataset
+        missing = [key for key in missing if key not in ret]
+        if len(missing) < 1:
+            return ret
+
+        # Generate whatever is left in one pass, and store it in one transaction
+        xs = [key[0] for key in missing]
+        ys = [key[1] for key in missing]
+        block = self.gendatablock(min(xs), min(ys), max(xs) - min(xs) + 1, max(ys) - min(ys) + 1)
+        records = []
+        chunks = []
+        for x, y in missing:
+            dataset = self.world.codec.prepare(block[(x, y)])
+            records.append((x, y, self.world.codec.encode(dataset)))
+            dataset = self.applydeltas(x, y, dataset, deltas.get((x, y), []))
+            chunks.append(self.world.cache.put(TwoDimChunk(dataset, self.world, x, y)))
+            ret[(x, y)] = dataset
+        if self.world.pristine:
+            return ret
+        start = stats.begin()
+        self.world.storage.putchunks(records, commit=False)
+        stats.add('sql', start)
+        self.chunkschanged(chunks)
+        start = stats.begin()
+        self.world.storage.commit()
+        stats.add('commit', start)
+        return ret
+
+# The TwoDimWorld of each pregeneration worker process, by (seed, chunksize)
+pregenworlds = {}
+
+def pregenblock(job):
+    """
+    Generates one block of chunks for TwoDimPregenerator, in a worker process
+     job is (seed, chunksize, dtype, compress, chunkX, chunkY, countX, countY, skip)
+     Returns a list of (x, y, data) in the binary chunk format, leaving out
+     the chunks in skip
+    """
+    seed, chunksize, dtype, compress, chunkX, chunkY, countX, countY, skip = job
+    # Each process builds its own OpenSimplex (and noise tables) once per seed
+    world = pregenworlds.get((seed, chunksize))
+    if world is None:
+        worldset = TwoDimWorldSettings(seed=seed, chunksize=chunksize, markermap={1:'#'}, colormap={1:Colors.DARK_GREEN}, width=1, height=1)
+        world = TwoDimWorld(OpenSimplex(seed=seed), worldset)
+        pregenworlds[(seed, chunksize)] = world
+    codec = TwoDimChunkCodec(dtype=dtype, compress=compress)
+    records = []
+    for key, dataset in world.gendatablock(chunkX, chunkY, countX, countY).items():
+        if key not in skip:
+            records.append((key[0], key[1], codec.encode(dataset)))
+    return records
+
+class TwoDimPregenerator(TwoDimCommon):
+    def __init__(self, worldsettings, processes=False, blocksize=8, batchsize=1024):
+        """
+        Generates large areas of the world ahead of time, in parallel
+         worldsettings supplies the seed, chunksize, codec and storage
+         processes is the number of worker processes (False for one per CPU,
+         1 generates in this process), blocksize is the width and height of
+         the blocks of chunks handed to each worker, and batchsize the number
+         of chunks written per transaction
+        """
+        self.world = self.validate_worldset(worldsettings, 'worldsettings')
+        if self.world.pristine:
+            raise ValueError("A pristine world doesn't store the chunks it generates")
+        if processes == False:
+            processes = multiprocessing.cpu_count()
+        self.processes = self.validate_int(processes, 'processes', minval=1)
+        self.blocksize = self.validate_int(blocksize, 'blocksize', minval=1)
+        self.batchsize = self.validate_int(batchsize, 'batchsize', minval=1)
+
+    def jobs(self, minX, minY, maxX, maxY, existing):
+        "Returns the list of jobs for pregenblock(), leaving out blocks that are already complete"
+        world = self.world
+        ret = []
+        for chunkX in range(minX, maxX + 1, self.blocksize):
+            for chunkY in range(minY, maxY + 1, self.blocksize):
+                countX = min(self.blocksize, maxX + 1 - chunkX)
+                countY = min(self.blocksize, maxY + 1 - chunkY)
+                skip = set()
+                for x in range(chunkX, chunkX + countX):
+                    for y in range(chunkY, chunkY + countY):
+                        if (x, y) in existing:
+                            skip.add((x, y))
+                if len(skip) < countX * countY:
+                    ret.append((world.seed, world.chunksize, world.codec.dtype, world.codec.compress,
+                                chunkX, chunkY, countX, countY, skip))
+        return ret
+
+    def run(self, minX, minY, maxX, maxY, progress=False):
+        """
+        Generates every chunk from minX,minY to maxX,maxY (inclusive) that isn't
+         already in the database, so an interrupted run can simply be repeated
+         progress is called as progress(done, total, elapsed) after every block
+         Returns a dictionary of statistics
+        """
+        minX = self.validate_int(minX, 'minX')
+        minY = self.validate_int(minY, 'minY')
+        maxX = self.validate_int(maxX, 'maxX', minval=minX)
+        maxY = self.validate_int(maxY, 'maxY', minval=minY)
+        storage = self.world.storage
+        started = time.time()
+        existing = storage.chunkkeysrect(minX, minY, maxX, maxY)
+        jobs = self.jobs(minX, minY, maxX, maxY, existing)
+        total = (maxX - minX + 1) * (maxY - minY + 1) - len(existing)
+        done = 0
+        pending = 0
+        pool = False
+        if self.processes > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(self.processes, len(jobs)))
+            results = pool.imap_unordered(pregenblock, jobs)
+        else:
+            results = (pregenblock(job) for job in jobs)
+        try:
+            # This process is the only writer, committing every batchsize chunks
+            for records in results:
+                storage.putchunks(records, commit=False)
+                if len(self.world.chunklisteners):
+                    self.chunkschanged([TwoDimChunk(self.unpackchunk(data), self.world, x, y) for x, y, data in records])
+                done += len(records)
+                pending += len(records)
+                if pending >= self.batchsize:
+                    storage.commit()
+                    pending = 0
+                if progress != False:
+                    progress(done, total, time.time() - started)
+            if pool != False:
+                pool.close()
+        finally:
+            if pool != False:
+                pool.terminate()
+                pool.join()
+            # Every chunk written so far is complete, so keep them even if interrupted
+            storage.commit()
+        elapsed = time.time() - started
+        return {'generated': done,
+                'skipped': len(existing),
+                'elapsed': elapsed,
+                'rate': done / elapsed if elapsed > 0 else 0}
+
+class TwoDimPrefetcher(TwoDimCommon):
+    def __init__(self, world, distance=2):
+        """
+        Loads (or generates) the chunks next to the objects it watches on a
+         worker thread, once they get within distance cells of the edge of
+         their chunk, so that entering the next chunk only reads from memory
+         world is the TwoDimWorld to generate chunks with
+        The worker thread reads the chunks through its own reader (see
+         TwoDimStorage.reader(), an in-memory database can't be shared, so then
+         it is checked in this thread) and never writes to them, generated chunks are stored and
+         cached by collect(), in the thread that owns the database
+        """
+        self.worldobj = world
+        self.world = self.validate_worldset(world.world, 'world.world')
+        self.distance = self.validate_int(distance, 'distance', minval=1, maxval=self.world.chunksize)
+        self.shared = self.world.storage.shareable()
+        # objid of every watched object, and its last absolute position
+        self.watched = {}
+        # (chunkX, chunkY) of every chunk requested and not collected yet
+        self.pending = set()
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.thread = False
+        # Statistics, see stats()
+        self.requested = 0
+        self.loaded = 0
+        self.generated = 0
+        self.hits = 0
+        self.waits = 0
+        self.misses = 0
+        self.waittime = 0.0
+        self.maxwait = 0.0
+
+    def watch(self, obj):
+        "Starts prefetching for TwoDimMoveable obj, and returns it"
+        self.watched[obj.objid] = False
+        self.moved(obj)
+        return obj
+
+    def unwatch(self, obj=False):
+        "Stops prefetching for TwoDimMoveable obj, or for every object if obj == False"
+        if obj == False:
+            self.watched = {}
+        else:
+            self.watched.pop(obj.objid, None)
+
+    def moved(self, obj):
+        """
+        Called by TwoDimMoveable whenever obj has moved. Requests the
+         neighboring chunks obj is within distance of and not heading away from
+        """
+        self.collect()
+        if obj.objid not in self.watched:
+            return
+        absx, absy = obj.rel2abs_unchecked(obj.x, obj.y)
+        last = self.watched[obj.objid]
+        self.watched[obj.objid] = (absx, absy)
+        if last == False:
+            last = (absx, absy)
+        for sideX in self.sides(absx, absx - last[0]):
+            for sideY in self.sides(absy, absy - last[1]):
+                if sideX != 0 or sideY != 0:
+                    self.request(obj.chunkX + sideX, obj.chunkY + sideY)
+
+    def sides(self, pos, step):
+        "Returns the neighbors (-1, 0, 1) along one axis that pos is close to and not moving away from"
+        ret = [0]
+        if pos < self.distance and step <= 0:
+            ret.append(-1)
+        if pos >= self.world.chunksize - self.distance and step >= 0:
+            ret.append(1)
+        return ret
+
+    def request(self, chunkX, chunkY):
+        "Queues chunkX,chunkY to be loaded or generated, unless it's already in memory or queued"
+        key = (chunkX, chunkY)
+        if key in self.pending or key in self.world.cache:
+            return
+        if not self.shared:
+            # The worker can't read an in-memory database, so check it here
+            data = self.world.storage.getchunk(chunkX, chunkY)
+            if data is not None:
+                dataset = self.applydeltas(chunkX, chunkY, self.unpackchunk(data))
+                self.world.cache.put(TwoDimChunk(dataset, self.world, chunkX, chunkY))
+                return
+        if self.thread == False:
+            self.thread = threading.Thread(target=self.worker, name='TwoDimPrefetcher')
+            self.thread.daemon = True
+            self.thread.start()
+        self.pending.add(key)
+        self.requested += 1
+        self.jobs.put(key)
+
+    def worker(self):
+        "The worker thread, answers jobs with (key, chunk, generated, exception) until it gets None"
+        reader = False
+        if self.shared:
+            reader = self.world.storage.reader()
+        try:
+            while True:
+                key = self.jobs.get()
+                if key is None:
+                    break
+                try:
+                    data = None
+                    if reader != False:
+                        data = reader.getchunk(key[0], key[1])
+                    if data is not None:
+                        dataset = self.unpackchunk(data)
+                    else:
+                        dataset = self.world.codec.prepare(self.worldobj.gendata(key[0], key[1]))
+                    self.results.put((key, TwoDimChunk(dataset, self.world, key[0], key[1]), data is None, None))
+                except Exception as e:
+                    self.results.put((key, None, False, e))
+        finally:
+            if reader != False:
+                reader.close()
+
+    def collect(self, block=False):
+        """
+        Moves finished chunks into the cache, storing the generated ones in the
+         database in one transaction (unless the world is pristine). Changed
+         cells are applied here, as the worker can't read them
+         Waits for at least one if block == True
+         Returns the number of chunks collected
+        """
+        generated = []
+        count = 0
+        while len(self.pending):
+            try:
+                key, chunk, new, error = self.results.get(block and count == 0)
+            except queue.Empty:
+                break
+            count += 1
+            self.pending.discard(key)
+            if error is not None:
+                # Leave it to be loaded the usual way
+                self.debug("Prefetching chunk " + str(key) + " failed: " + str(error))
+                continue
+            if key in self.world.cache:
+                # Something else loaded it in the meantime
+                continue
+            if new:
+                self.generated += 1
+                if self.world.pristine:
+                    self.world.cache.put(self.withdeltas(chunk))
+                else:
+                    generated.append(chunk)
+            else:
+                self.loaded += 1
+                self.world.cache.put(self.withdeltas(chunk))
+        if len(generated):
+            existing = self.world.storage.addchunks([(chunk.chunkX, chunk.chunkY, self.world.codec.encode(chunk.dataset))
+                                                     for chunk in generated], commit=False)
+            added = [self.withdeltas(chunk) for chunk in generated if (chunk.chunkX, chunk.chunkY) not in existing]
+            for chunk in added:
+                self.world.cache.put(chunk)
+            self.chunkschanged(added)
+            self.world.storage.commit()
+        return count
+
+    def withdeltas(self, chunk):
+        "Returns chunk, or a new TwoDimChunk if it has changed cells, see applydeltas()"
+        dataset = self.applydeltas(chunk.chunkX, chunk.chunkY, chunk.dataset)
+        if dataset is chunk.dataset:
+            return chunk
+        return TwoDimChunk(dataset, self.world, chunk.chunkX, chunk.chunkY)
+
+    def claim(self, chunkX, chunkY):
+        """
+        Returns the TwoDimChunk for chunkX,chunkY if it has been prefetched,
+         waiting for it if it's still being loaded. Returns None if it wasn't
+         requested
+        """
+        key = (chunkX, chunkY)
+        if key not in self.pending:
+            return None
+        started = time.time()
+        while key in self.pending:
+            self.collect(block=True)
+        waited = time.time() - started
+        self.waits += 1
+        self.waittime += waited
+        self.maxwait = max(self.maxwait, waited)
+        return self.world.cache.get(chunkX, chunkY)
+
+    def enter(self, chunkX, chunkY):
+        """
+        Returns the dataset for chunkX,chunkY, for an object that is about to
+         enter it, and counts whether it was already in memory
+        """
+        self.collect()
+        chunk = self.world.cache.get(chunkX, chunkY)
+        if chunk is not None:
+            self.hits += 1
+            return chunk.dataset
+        chunk = self.claim(chunkX, chunkY)
+        if chunk is not None:
+            return chunk.dataset
+        self.misses += 1
+        return self.worldobj.loadchunk(chunkX, chunkY, loadneighbors=False)
+
+    def stop(self):
+        "Stops the worker thread, once it has finished the chunks already requested, and stores them"
+        if self.thread != False:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = False
+        self.collect()
+        self.pending = set()
+
+    def stats(self):
+        "Returns a dictionary of the prefetch statistics, hitrate is hits / chunks entered"
+        entered = self.hits + self.waits + self.misses
+        return {'requested': self.requested,
+                'loaded': self.loaded,
+                'generated': self.generated,
+                'pending': len(self.pending),
+                'hits': self.hits,
+                'waits': self.waits,
+                'misses': self.misses,
+                'hitrate': float(self.hits) / entered if entered > 0 else 0.0,
+                'waittime': self.waittime,
+                'maxwait': self.maxwait}
+
 class TwoDimChunk(TwoDimCommon):
     def __init__(self, dataset, world, chunkX=0, chunkY=0):
         "A two-dimensional chunk of the game world"
         self.world = world
         # Validate and set dataset
-        self.dataset = self.validate_list(dataset, 'dataset', mincount=self.world.chunksize, maxcount=self.world.chunksize)
-        self.dataset[0] = self.validate_list(dataset[0], 'dataset', mincount=self.world.chunksize, maxcount=self.world.chunksize)
+        self.dataset = self.validate_array(dataset, 'dataset', shape=(self.world.chunksize, self.world.chunksize))
         # Validate and set chunkX
         self.chunkX = self.validate_int(chunkX, 'chunkX')
         # Validate and set chunkY
         self.chunkY = self.validate_int(chunkY, 'chunkY')
+        # The terrain class of every cell, so drawing doesn't have to work it out
+        self.classes = self.terrainclasses(self.dataset)
+
+    def size(self):
+        "Returns the number of bytes of chunk data held in memory"
+        return self.dataset.nbytes + self.classes.nbytes
+
+class TwoDimOverview(TwoDimCommon):
+    def __init__(self, world, maxentries=16384):
+        """
+        Pyramid of downsampled terrain, for drawing large areas zoomed out
+         Level 0 is the terrain classes of the chunks themselves, each level
+         after that halves the size (rounding up), the cell being the most
+         common terrain class of the 2x2 cells below it, until the last level
+         (maxlevel) has a single cell per chunk
+        Levels 1 and up are stored in the overview table, built whenever a
+         chunk is generated or replaced (see TwoDimCommon.chunkschanged()), or
+         on first use for chunks that were stored before there was an overview
+         Up to maxentries levels of chunks are cached
+        world is the TwoDimWorld, for generating missing chunks
+        """
+        self.worldobj = world
+        self.world = self.validate_worldset(world.world, 'world.world')
+        self.maxentries = self.validate_int(maxentries, 'maxentries', minval=1)
+        self.nclasses = len(self.world.markermap) + 2
+        # Size of a chunk at every level
+        self.sizes = [self.world.chunksize]
+        while self.sizes[-1] > 1:
+            self.sizes.append((self.sizes[-1] + 1) // 2)
+        self.maxlevel = len(self.sizes) - 1
+        # (level, chunkX, chunkY) -> array of terrain classes, least recently used first
+        self.cache = OrderedDict()
+        self.world.chunklisteners.append(self)
+
+    def build(self, classes):
+        """
+        Returns a list of the arrays for levels 1 to maxlevel of the chunks
+         with the terrain classes classes, an array of shape (chunks, chunksize,
+         chunksize), so each array is (chunks, size, size)
+         The count of every class is summed 2x2 at a time, so every level is
+         exact rather than the most common of the most common
+        """
+        nclasses = self.nclasses
+        count = classes.shape[0]
+        counts = (classes[np.newaxis] == np.arange(nclasses, dtype=classes.dtype).reshape(nclasses, 1, 1, 1)).astype(np.int32)
+        ret = []
+        for size in self.sizes[1:]:
+            rows = counts.shape[2]
+            if rows % 2:
+                counts = np.pad(counts, ((0, 0), (0, 0), (0, 1), (0, 1)), 'constant')
+            counts = counts.reshape(nclasses, count, size, 2, size, 2).sum(axis=(3, 5))
+            # Ties go to the lowest class
+            ret.append(counts.argmax(axis=0).astype(np.uint8))
+        return ret
+
+    def chunkchanged(self, chunks):
+        "Rebuilds and stores the levels of the TwoDimChunks in chunks, see TwoDimCommon.chunkschanged()"
+        if len(chunks) < 1:
+            return
+        self.store(chunks)
+
+    def store(self, chunks):
+        """
+        Builds, caches and stores the levels of the TwoDimChunks in chunks
+        Returns the list build() does, so callers don't depend on the cache
+         still holding every level afterwards
+        """
+        records = []
+        levels = self.build(np.array([chunk.classes for chunk in chunks]))
+        for level, classes in enumerate(levels, 1):
+            for i, chunk in enumerate(chunks):
+                self.put(level, chunk.chunkX, chunk.chunkY, classes[i])
+                records.append((level, chunk.chunkX, chunk.chunkY, classes[i].tobytes()))
+        self.world.storage.putoverviews(records, commit=False)
+        return levels
+
+    def put(self, level, chunkX, chunkY, classes):
+        "Caches the classes of chunkX,chunkY at level"
+        key = (level, chunkX, chunkY)
+        self.cache.pop(key, None)
+        self.cache[key] = classes
+        while len(self.cache) > self.maxentries:
+            self.cache.popitem(last=False)
+
+    def get(self, level, chunkX, chunkY):
+        "Returns the array of terrain classes of chunkX,chunkY at level"
+        return self.getrect(level, chunkX, chunkY, chunkX, chunkY)
+
+    def getrect(self, level, minX, minY, maxX, maxY):
+        """
+        Returns a single array of the terrain classes at level of every chunk
+         from minX,minY to maxX,maxY (inclusive), chunkX along the first axis
+        Whatever isn't cached is read with one query, and only chunks without
+         an overview are loaded (or generated)
+        """
+        level = self.validate_int(level, 'level', minval=0, maxval=self.maxlevel)
+        minX = self.validate_int(minX, 'minX')
+        minY = self.validate_int(minY, 'minY')
+        maxX = self.validate_int(maxX, 'maxX', minval=minX)
+        maxY = self.validate_int(maxY, 'maxY', minval=minY)
+        size = self.sizes[level]
+        ret = np.empty(((maxX - minX + 1) * size, (maxY - minY + 1) * size), dtype=np.uint8)
+        if level == 0:
+            # That's just the chunks
+            self.worldobj.loadrect(minX, minY, maxX, maxY)
+            for x in range(minX, maxX + 1):
+                for y in range(minY, maxY + 1):
+                    ret[(x - minX) * size:(x - minX + 1) * size, (y - minY) * size:(y - minY + 1) * size] = self.fetchchunk(x, y).classes
+            return ret
+        found = {}
+        missing = []
+        for x in range(minX, maxX + 1):
+            for y in range(minY, maxY + 1):
+                classes = self.cache.pop((level, x, y), None)
+                if classes is None:
+                    missing.append((x, y))
+                else:
+                    self.cache[(level, x, y)] = classes
+                    found[(x, y)] = classes
+        if len(missing):
+            xs = [key[0] for key in missing]
+            ys = [key[1] for key in missing]
+            for x, y, data in self.world.storage.getoverviewrect(level, min(xs), min(ys), max(xs), max(ys)):
+                if (x, y) not in found:
+                    classes = np.frombuffer(data, dtype=np.uint8).reshape(size, size)
+                    self.put(level, x, y, classes)
+                    found[(x, y)] = classes
+            missing = [key for key in missing if key not in found]
+        if len(missing):
+            # Generating chunks builds their overview, older chunks need theirs built
+            xs = [key[0] for key in missing]
+            ys = [key[1] for key in missing]
+            self.worldobj.loadrect(min(xs), min(ys), max(xs), max(ys))
+            chunks = []
+            for x, y in missing:
+                classes = self.cache.get((level, x, y))
+                if classes is None:
+                    chunks.append(self.fetchchunk(x, y))
+                else:
+                    found[(x, y)] = classes
+            if len(chunks):
+                # Large areas evict entries from the cache, take the results directly
+                levels = self.store(chunks)
+                self.world.storage.commit()
+                for i, chunk in enumerate(chunks):
+                    found[(chunk.chunkX, chunk.chunkY)] = levels[level - 1][i]
+        for (x, y), classes in found.items():
+            ret[(x - minX) * size:(x - minX + 1) * size, (y - minY) * size:(y - minY + 1) * size] = classes
+        return ret
+
+def shiftlines(lines, count, blank):
+    """
+    Returns the list lines moved up by count (down if negative), with copies
+     of blank in the places that are left open
+    """
+    if count >= len(lines) or -count >= len(lines):
+        return [list(blank) for line in lines]
+    if count >= 0:
+        return lines[count:] + [list(blank) for line in range(count)]
+    return [list(blank) for line in range(-count)] + lines[:count]
+
+def shiftcols(line, count, blank):
+    "Returns the list line moved left by count (right if negative), filled with blank"
+    if count >= len(line) or -count >= len(line):
+        return [blank] * len(line)
+    if count >= 0:
+        return line[count:] + [blank] * count
+    return [blank] * -count + line[:count]
+
+class TwoDimPathfinder(TwoDimCommon):
+    def __init__(self, world, costs=False, spacing=5, maxchunks=256, maxtables=1024, margin=2, maxnodes=20000):
+        """
+        Hierarchical (HPA*) pathfinding over the terrain, for moves of one cell
+         along either axis
+         costs is a dictionary of {terrain class: cost of entering a cell of
+         that class} (see TwoDimDrawing.getval()), the classes that aren't in
+         it (or are False) can't be entered. False makes every class cost 1
+        Every chunk is a cluster: each passable stretch of a chunk border gets
+         a transition at either end and every spacing cells in between (or one
+         in the middle if it is shorter than spacing), and the cost of getting
+         from a transition to the others of its chunk is worked out once,
+         giving a small graph per chunk. Fewer transitions make smaller graphs,
+         but paths that are further from the cheapest. findpath() searches
+         those graphs, and the TwoDimPath it returns is refined into cells one
+         chunk at a time as it is followed
+        The cost grids, borders and graphs of up to maxchunks chunks are
+         cached, along with the ways from the last maxtables starts and goals
+         to the transitions of their chunk (so drones heading for the same
+         place share them). A changed chunk (see TwoDimCommon.chunkschanged())
+         only drops its own graph and those of the neighbors whose shared
+         border changed
+        Searches stay within margin chunks of the start and goal, and give up
+         after maxnodes graph nodes
+        world is the TwoDimWorld, for loading (or generating) chunks
+        """
+        self.worldobj = world
+        self.world = self.validate_worldset(world.world, 'world.world')
+        self.xoffset = int(self.world.chunksize / 2)
+        self.yoffset = int(self.world.chunksize / 2)
+        nclasses = len(self.world.markermap) + 2
+        if costs == False:
+            costs = dict((terr, 1) for terr in range(nclasses))
+        costs = self.validate_dict(costs, 'costs', mincount=1)
+        # The cost of entering a cell of every terrain class, None if it can't be entered
+        self.costlut = []
+        for terr in range(nclasses):
+            cost = costs.get(terr, False)
+            if cost is False:
+                cost = None
+            elif type(cost) not in (type(int()), type(float())) or cost <= 0:
+                raise ValueError("Cost of terrain class " + str(terr) + " is not a positive number (" + str(cost) + ")")
+            self.costlut.append(cost)
+        passable = [cost for cost in self.costlut if cost is not None]
+        if len(passable) < 1:
+            raise ValueError("No terrain class can be entered")
+        self.mincost = min(passable)
+        self.spacing = self.validate_int(spacing, 'spacing', minval=1)
+        self.maxchunks = self.validate_int(maxchunks, 'maxchunks', minval=1)
+        self.maxtables = self.validate_int(maxtables, 'maxtables', minval=1)
+        self.margin = self.validate_int(margin, 'margin', minval=0)
+        self.maxnodes = self.validate_int(maxnodes, 'maxnodes', minval=1)
+        # The grid indexes next to every grid index
+        self.adjacent = self.makeadjacent(self.world.chunksize)
+        # (chunkX, chunkY) -> list of the cost of every cell, x * chunksize + y
+        self.grids = OrderedDict()
+        # (chunkX, chunkY, axis) -> list of (nodeA, nodeB, costA, costB), the
+        #  transitions between chunkX,chunkY and the next chunk along axis (0 = x)
+        self.borders = OrderedDict()
+        # (chunkX, chunkY) -> {node: [(node, cost), ...]}, nodes being world cells (x, y)
+        self.graphs = OrderedDict()
+        # (chunkX, chunkY, index, reverse) -> (links of the graph it came from, {node: cost}), see transitions()
+        self.tables = OrderedDict()
+        # Statistics
+        self.built = 0
+        self.dropped = 0
+        self.world.chunklisteners.append(self)
+
+    def remember(self, cache, key, value, limit):
+        "Adds key to the least recently used cache, dropping the oldest entries past limit"
+        cache.pop(key, None)
+        cache[key] = value
+        while len(cache) > limit:
+            cache.popitem(last=False)
+        return value
+
+    def recall(self, cache, key):
+        "Returns key from the least recently used cache, or None"
+        value = cache.pop(key, None)
+        if value is not None:
+            cache[key] = value
+        return value
+
+    def cellindex(self, cell):
+        "Returns the index in its chunk's cost grid of world cell (x, y)"
+        size = self.world.chunksize
+        return (cell[0] % size) * size + cell[1] % size
+
+    def cellchunk(self, cell):
+        "Returns the (chunkX, chunkY) of world cell (x, y)"
+        size = self.world.chunksize
+        return (cell[0] // size, cell[1] // size)
+
+    def cell2rel(self, cell):
+        "Returns world cell (x, y) as (chunkX, chunkY, x, y), x,y RELATIVE"
+        size = self.world.chunksize
+        return (cell[0] // size, cell[1] // size, cell[0] % size - self.xoffset, cell[1] % size - self.yoffset)
+
+    def makegrid(self, classes):
+        "Returns the cost grid for an array of terrain classes"
+        lut = self.costlut
+        return [lut[terr] for terr in classes.ravel().tolist()]
+
+    def grid(self, chunkX, chunkY):
+        "Returns the cost grid of chunkX,chunkY, loading (or generating) the chunk if needed"
+        key = (chunkX, chunkY)
+        grid = self.recall(self.grids, key)
+        if grid is None:
+            chunk = self.fetchchunk(chunkX, chunkY)
+            if chunk is None:
+                self.worldobj.loadchunk(chunkX, chunkY, loadneighbors=False)
+                chunk = self.fetchchunk(chunkX, chunkY)
+            grid = self.remember(self.grids, key, self.makegrid(chunk.classes), self.maxchunks)
+        return grid
+
+    def makeborder(self, chunkX, chunkY, axis, grid, nextgrid):
+        "Returns the transitions of the border of chunkX,chunkY along axis, see border()"
+        size = self.world.chunksize
+        baseX = chunkX * size
+        baseY = chunkY * size
+        ret = []
+        run = []
+        for i in range(size + 1):
+            if i < size:
+                if axis == 0:
+                    a, b = (size - 1) * size + i, i
+                else:
+                    a, b = i * size + size - 1, i * size
+                if grid[a] is not None and nextgrid[b] is not None:
+                    run.append((i, grid[a], nextgrid[b]))
+                    continue
+            if len(run) < 1:
+                continue
+            if len(run) < self.spacing:
+                picks = [run[len(run) // 2]]
+            else:
+                picks = run[::self.spacing]
+                if (len(run) - 1) % self.spacing:
+                    picks.append(run[-1])
+            for i, costA, costB in picks:
+                if axis == 0:
+                    ret.append(((baseX + size - 1, baseY + i), (baseX + size, baseY + i), costA, costB))
+                else:
+                    ret.append(((baseX + i, baseY + size - 1), (baseX + i, baseY + size), costA, costB))
+            run = []
+        return ret
+
+    def border(self, chunkX, chunkY, axis):
+        """
+        Returns the transitions between chunkX,chunkY and the next chunk along
+         axis (0 = x, 1 = y), a list of (nodeA, nodeB, costA, costB): the world
+         cells on either side, and the cost of entering each of them
+        """
+        key = (chunkX, chunkY, axis)
+        border = self.recall(self.borders, key)
+        if border is None:
+            if axis == 0:
+                nextgrid = self.grid(chunkX + 1, chunkY)
+            else:
+                nextgrid = self.grid(chunkX, chunkY + 1)
+            border = self.makeborder(chunkX, chunkY, axis, self.grid(chunkX, chunkY), nextgrid)
+            self.remember(self.borders, key, border, self.maxchunks * 2)
+        return border
+
+    def makeadjacent(self, size):
+        "Returns a list of the indexes of the cells next to every cell of a size x size grid"
+        ret = []
+        for cell in range(size * size):
+            x, y = divmod(cell, size)
+            cells = []
+            if x > 0:
+                cells.append(cell - size)
+            if x < size - 1:
+                cells.append(cell + size)
+            if y > 0:
+                cells.append(cell - 1)
+            if y < size - 1:
+                cells.append(cell + 1)
+            ret.append(tuple(cells))
+        return ret
+
+    def dijkstra(self, grid, sources, targets=False, reverse=False):
+        """
+        Returns {index: cost} of the cheapest way from the cells sources to
+         the cells of the cost grid grid, stopping once every cell in targets
+         (if given) is reached. With reverse == True it's the cost of the way
+         from each cell to sources instead
+        """
+        adjacent = self.adjacent
+        heappush = heapq.heappush
+        heappop = heapq.heappop
+        dist = {}
+        heap = [(0, cell) for cell in sources]
+        remaining = False
+        if targets != False:
+            remaining = set(targets)
+        while len(heap):
+            d, cell = heappop(heap)
+            if cell in dist:
+                continue
+            dist[cell] = d
+            if remaining != False:
+                remaining.discard(cell)
+                if len(remaining) < 1:
+                    break
+            if reverse:
+                step = d + grid[cell]
+                for other in adjacent[cell]:
+                    if grid[other] is not None and other not in dist:
+                        heappush(heap, (step, other))
+            else:
+                for other in adjacent[cell]:
+                    cost = grid[other]
+                    if cost is not None and other not in dist:
+                        heappush(heap, (d + cost, other))
+        return dist
+
+    def localpath(self, chunkX, chunkY, start, goal):
+        """
+        Returns the list of grid indexes of the cheapest way from start to goal
+         (both included) without leaving chunk chunkX,chunkY, or None
+        """
+        grid = self.grid(chunkX, chunkY)
+        if grid[goal] is None:
+            return None
+        size = self.world.chunksize
+        mincost = self.mincost
+        adjacent = self.adjacent
+        goalX, goalY = divmod(goal, size)
+        came = {start: None}
+        best = {start: 0}
+        heap = [(0, 0, start)]
+        while len(heap):
+            f, d, cell = heapq.heappop(heap)
+            if cell == goal:
+                ret = []
+                while cell is not None:
+                    ret.append(cell)
+                    cell = came[cell]
+                ret.reverse()
+                return ret
+            if d > best[cell]:
+                continue
+            for other in adjacent[cell]:
+                cost = grid[other]
+                if cost is None:
+                    continue
+                cost += d
+                if cost < best.get(other, cost + 1):
+                    best[other] = cost
+                    came[other] = cell
+                    x, y = divmod(other, size)
+                    heapq.heappush(heap, (cost + (abs(x - goalX) + abs(y - goalY)) * mincost, cost, other))
+        return None
+
+    def graph(self, chunkX, chunkY):
+        """
+        Returns the graph of chunkX,chunkY as (links, edges): links is
+         {node: [(node, cost), ...]} for every transition on its borders, to
+         the transition across the border, edges is filled in by neighbors()
+        """
+        key = (chunkX, chunkY)
+        graph = self.recall(self.graphs, key)
+        if graph is not None:
+            return graph
+        links = {}
+        for nodeA, nodeB, costA, costB in self.border(chunkX, chunkY, 0) + self.border(chunkX, chunkY, 1):
+            links.setdefault(nodeA, []).append((nodeB, costB))
+        for nodeA, nodeB, costA, costB in self.border(chunkX - 1, chunkY, 0) + self.border(chunkX, chunkY - 1, 1):
+            links.setdefault(nodeB, []).append((nodeA, costA))
+        self.built += 1
+        return self.remember(self.graphs, key, (links, {}), self.maxchunks)
+
+    def neighbors(self, node):
+        """
+        Returns [(node, cost), ...] for transition node, to the transitions it
+         can reach inside its chunk and to the one across the border. Worked
+         out the first time a search gets to node, as most never do
+        """
+        links, edges = self.graph(node[0] // self.world.chunksize, node[1] // self.world.chunksize)
+        ret = edges.get(node)
+        if ret is None:
+            if node not in links:
+                return []
+            nodes = list(links)
+            indexes = [self.cellindex(other) for other in nodes]
+            index = self.cellindex(node)
+            dist = self.dijkstra(self.grid(node[0] // self.world.chunksize, node[1] // self.world.chunksize), [index], indexes)
+            ret = [(other, dist[i]) for other, i in zip(nodes, indexes) if i != index and i in dist] + links[node]
+            edges[node] = ret
+        return ret
+
+    def transitions(self, chunkX, chunkY, index, reverse=False):
+        """
+        Returns {node: cost} of the cheapest ways from grid index index of
+         chunkX,chunkY to the transitions of its graph it can reach, or from
+         the transitions to it with reverse == True
+        """
+        key = (chunkX, chunkY, index, reverse)
+        links = self.graph(chunkX, chunkY)[0]
+        entry = self.recall(self.tables, key)
+        # A table outlives its graph, once that is dropped (or evicted) it may be stale
+        if entry is None or entry[0] is not links:
+            nodes = list(links)
+            indexes = [self.cellindex(node) for node in nodes]
+            dist = self.dijkstra(self.grid(chunkX, chunkY), [index], indexes, reverse)
+            entry = (links, dict((node, dist[i]) for node, i in zip(nodes, indexes) if i in dist))
+            self.remember(self.tables, key, entry, self.maxtables)
+        return entry[1]
+
+    def clear(self):
+        "Forgets every cached cost grid, border, graph and transitions() table"
+        self.grids.clear()
+        self.borders.clear()
+        self.graphs.clear()
+        self.tables.clear()
+
+    def forget(self, chunkX, chunkY):
+        """
+        Drops the graph of chunkX,chunkY, and with it the transitions() tables
+         that came from it (they're only used with the graph they came from)
+        """
+        if self.graphs.pop((chunkX, chunkY), None) is not None:
+            self.dropped += 1
+
+    def chunkchanged(self, chunks):
+        """
+        Drops the cost grids, borders and graphs that depend on the TwoDimChunks
+         in chunks, see TwoDimCommon.chunkschanged(). A neighbor keeps its graph
+         if the transitions on the border it shares with the chunk are the same
+        """
+        for chunk in chunks:
+            key = (chunk.chunkX, chunk.chunkY)
+            self.forget(chunk.chunkX, chunk.chunkY)
+            # Only chunks that are in use are worth a new grid
+            if self.grids.pop(key, None) is not None:
+                self.remember(self.grids, key, self.makegrid(chunk.classes), self.maxchunks)
+        for chunk in chunks:
+            chunkX, chunkY = chunk.chunkX, chunk.chunkY
+            # Every border of the chunk, and the chunk on the other side of it
+            for key, other in (((chunkX, chunkY, 0), (chunkX + 1, chunkY)),
+                               ((chunkX, chunkY, 1), (chunkX, chunkY + 1)),
+                               ((chunkX - 1, chunkY, 0), (chunkX - 1, chunkY)),
+                               ((chunkX, chunkY - 1, 1), (chunkX, chunkY - 1))):
+                old = self.borders.pop(key, None)
+                if other not in self.graphs:
+                    continue
+                # Without the old border or both grids there's nothing to compare
+                grid = self.grids.get(key[:2])
+                nextgrid = self.grids.get((key[0] + 1, key[1]) if key[2] == 0 else (key[0], key[1] + 1))
+                if old is not None and grid is not None and nextgrid is not None:
+                    border = self.makeborder(key[0], key[1], key[2], grid, nextgrid)
+                    if border == old:
+                        self.remember(self.borders, key, border, self.maxchunks * 2)
+                        continue
+                self.forget(other[0], other[1])
+
+    def findpath(self, chunkX, chunkY, x, y, goalChunkX, goalChunkY, goalX, goalY):
+        """
+        Returns a TwoDimPath for the cheapest way (as far as the chunk graphs
+         can tell) from RELATIVE x,y of chunk chunkX,chunkY to RELATIVE
+         goalX,goalY of chunk goalChunkX,goalChunkY, or None if there is none
+         within margin chunks and maxnodes nodes
+        """
+        chunkX = self.validate_int(chunkX, 'chunkX')
+        chunkY = self.validate_int(chunkY, 'chunkY')
+        goalChunkX = self.validate_int(goalChunkX, 'goalChunkX')
+        goalChunkY = self.validate_int(goalChunkY, 'goalChunkY')
+        x, y = self.rel2abs(x, y)
+        goalX, goalY = self.rel2abs(goalX, goalY)
+        stats = self.world.stats
+        start = stats.begin()
+        ret = self.search(chunkX, chunkY, x, y, goalChunkX, goalChunkY, goalX, goalY)
+        stats.add('path', start)
+        return ret
+
+    def search(self, chunkX, chunkY, x, y, goalChunkX, goalChunkY, goalX, goalY):
+        "findpath() for ABSOLUTE coordinates that are already known to be valid"
+        size = self.world.chunksize
+        begin = (chunkX * size + x, chunkY * size + y)
+        goal = (goalChunkX * size + goalX, goalChunkY * size + goalY)
+        goalgrid = self.grid(goalChunkX, goalChunkY)
+        goalindex = goalX * size + goalY
+        if goalgrid[goalindex] is None:
+            return None
+        if begin == goal:
+            return TwoDimPath(self, [begin], 0)
+        # The ways from the start to the transitions of its chunk, and from
+        #  the transitions of the goal's chunk to the goal
+        startindex = x * size + y
+        startedges = list(self.transitions(chunkX, chunkY, startindex).items())
+        if begin in self.graph(chunkX, chunkY)[0]:
+            startedges.extend(self.neighbors(begin))
+        goaledges = self.transitions(goalChunkX, goalChunkY, goalindex, reverse=True)
+        if (chunkX, chunkY) == (goalChunkX, goalChunkY):
+            cells = self.localpath(chunkX, chunkY, startindex, goalindex)
+            if cells is not None:
+                startedges.append((goal, sum([goalgrid[cell] for cell in cells[1:]])))
+        minX = min(chunkX, goalChunkX) - self.margin
+        minY = min(chunkY, goalChunkY) - self.margin
+        maxX = max(chunkX, goalChunkX) + self.margin
+        maxY = max(chunkY, goalChunkY) + self.margin
+        mincost = self.mincost
+        came = {begin: None}
+        best = {begin: 0}
+        heap = [(0, 0, begin)]
+        expanded = 0
+        while len(heap):
+            f, d, node = heapq.heappop(heap)
+            if node == goal:
+                break
+            if d > best[node]:
+                continue
+            expanded += 1
+            if expanded > self.maxnodes:
+                return None
+            if node == begin:
+                edges = startedges
+            else:
+                nodeX, nodeY = node[0] // size, node[1] // size
+                if nodeX < minX or nodeX > maxX or nodeY < minY or nodeY > maxY:
+                    continue
+                edges = self.neighbors(node)
+                if node in goaledges:
+                    edges = edges + [(goal, goaledges[node])]
+            for other, cost in edges:
+                cost += d
+                if cost < best.get(other, cost + 1):
+                    best[other] = cost
+                    came[other] = node
+                    heapq.heappush(heap, (cost + (abs(other[0] - goal[0]) + abs(other[1] - goal[1])) * mincost, cost, other))
+        else:
+            return None
+        waypoints = []
+        node = goal
+        while node is not None:
+            waypoints.append(node)
+            node = came[node]
+        waypoints.reverse()
+        return TwoDimPath(self, waypoints, best[goal])
+
+    def refine(self, cell, other):
+        """
+        Returns the list of world cells after cell up to (and including) other,
+         which is in the same chunk or next to it, or None if there is no way
+        """
+        size = self.world.chunksize
+        chunkX, chunkY = self.cellchunk(cell)
+        if self.cellchunk(other) != (chunkX, chunkY):
+            otherX, otherY = self.cellchunk(other)
+            if self.grid(otherX, otherY)[self.cellindex(other)] is None:
+                return None
+            return [other]
+        cells = self.localpath(chunkX, chunkY, self.cellindex(cell), self.cellindex(other))
+        if cells is None:
+            return None
+        baseX = chunkX * size
+        baseY = chunkY * size
+        return [(baseX + index // size, baseY + index % size) for index in cells[1:]]
+
+class TwoDimPath(TwoDimCommon):
+    def __init__(self, pathfinder, waypoints, cost):
+        """
+        A way found by TwoDimPathfinder.findpath(). waypoints is the list of
+         world cells (x, y) it goes through, from the start to the goal, and
+         cost its total cost. The cells in between are worked out as step()
+         gets to them, so only the part near the start is ever refined
+        """
+        self.pathfinder = pathfinder
+        self.world = pathfinder.world
+        self.waypoints = waypoints
+        self.cost = cost
+        # The waypoint the cells in steps lead to
+        self.index = 0
+        self.steps = deque()
+        # Set when the terrain changed in the way of the path, see step()
+        self.blocked = False
+
+    def step(self):
+        """
+        Returns the next cell of the path as (chunkX, chunkY, x, y), x,y
+         RELATIVE, or None at the end of the path. Also None if the terrain
+         has changed so that the path is blocked (blocked == True), a new path
+         has to be found then
+        """
+        while len(self.steps) < 1:
+            if self.blocked or self.index >= len(self.waypoints) - 1:
+                return None
+            cells = self.pathfinder.refine(self.waypoints[self.index], self.waypoints[self.index + 1])
+            if cells is None:
+                self.blocked = True
+                return None
+            self.index += 1
+            self.steps.extend(cells)
+        return self.pathfinder.cell2rel(self.steps.popleft())
+
+    def done(self):
+        "Returns True once every cell of the path has been returned by step()"
+        return len(self.steps) < 1 and self.index >= len(self.waypoints) - 1
+
+class TwoDimResourceIndex(TwoDimCommon):
+    def __init__(self, world, maxchunks=256):
+        """
+        Per-chunk index of where each terrain class is (see
+         TwoDimDrawing.getval()), for questions like "where is the nearest
+         rock" or "how much water is in this area" that shouldn't have to look
+         at every cell
+        For every chunk it keeps the count of each class and a summed-area
+         table of each class, so the count in any rectangle takes four lookups,
+         and the cells of a class are listed the first time they are needed
+        A chunk is indexed when it is generated, or the first time a query
+         needs it, and up to maxchunks chunks are kept. Changed cells (see
+         TwoDimCommon.chunkschanged()) are applied to the tables in place
+        Queries work across chunk borders, in RELATIVE coordinates
+        world is the TwoDimWorld, for loading (or generating) chunks
+        """
+        self.worldobj = world
+        self.world = self.validate_worldset(world.world, 'world.world')
+        self.xoffset = int(self.world.chunksize / 2)
+        self.yoffset = int(self.world.chunksize / 2)
+        self.maxchunks = self.validate_int(maxchunks, 'maxchunks', minval=1)
+        self.nclasses = len(self.world.markermap) + 2
+        self.terrs = np.arange(self.nclasses, dtype=np.uint8).reshape(self.nclasses, 1, 1)
+        # (chunkX, chunkY) -> [classes, counts, table, cells], least recently used first
+        #  table[terr, x, y] is the count of terr in the cells before x,y, and
+        #  cells {terr: (xs, ys)} the cells of each class that has been asked for
+        self.entries = OrderedDict()
+        self.world.chunklisteners.append(self)
+
+    def build(self, classes):
+        "Returns the [classes, counts, table, cells] entry for an array of terrain classes"
+        size = self.world.chunksize
+        # Counts up to a whole chunk, which fit 16 bits unless chunks are huge
+        table = np.zeros((self.nclasses, size + 1, size + 1), dtype=np.uint16 if size * size < 65536 else np.int64)
+        np.cumsum(np.cumsum(classes[np.newaxis] == self.terrs, axis=1, dtype=table.dtype), axis=2, out=table[:, 1:, 1:])
+        return [classes, table[:, size, size].astype(np.int64), table, {}]
+
+    def put(self, chunkX, chunkY, entry):
+        "Caches the entry of chunkX,chunkY"
+        key = (chunkX, chunkY)
+        self.entries.pop(key, None)
+        self.entries[key] = entry
+        while len(self.entries) > self.maxchunks:
+            self.entries.popitem(last=False)
+        return entry
+
+    def getrect(self, minX, minY, maxX, maxY):
+        """
+        Returns {(chunkX, chunkY): entry} for every chunk from minX,minY to
+         maxX,maxY (inclusive), loading the ones that aren't indexed together
+        """
+        ret = {}
+        missing = []
+        for x in range(minX, maxX + 1):
+            for y in range(minY, maxY + 1):
+                entry = self.entries.pop((x, y), None)
+                if entry is None:
+                    missing.append((x, y))
+                else:
+                    self.entries[(x, y)] = entry
+                    ret[(x, y)] = entry
+        if len(missing):
+            xs = [key[0] for key in missing]
+            ys = [key[1] for key in missing]
+            datasets = self.worldobj.loadrect(min(xs), min(ys), max(xs), max(ys))
+            for x, y in missing:
+                chunk = self.world.cache.get(x, y)
+                if chunk is not None and chunk.dataset is datasets[(x, y)]:
+                    classes = chunk.classes
+                else:
+                    classes = self.terrainclasses(datasets[(x, y)])
+                ret[(x, y)] = self.put(x, y, self.build(classes))
+        return ret
+
+    def cells(self, entry, terr):
+        "Returns (xs, ys), arrays of the absolute coordinates of the cells of class terr of an entry"
+        ret = entry[3].get(terr)
+        if ret is None:
+            ret = np.nonzero(entry[0] == terr)
+            entry[3][terr] = ret
+        return ret
+
+    def chunkchanged(self, chunks):
+        """
+        Indexes the TwoDimChunks in chunks, see TwoDimCommon.chunkschanged()
+         When only a few cells of an indexed chunk changed, its tables are
+         updated rather than built again
+        """
+        size = self.world.chunksize
+        for chunk in chunks:
+            key = (chunk.chunkX, chunk.chunkY)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.put(chunk.chunkX, chunk.chunkY, self.build(chunk.classes))
+                continue
+            xs, ys = np.nonzero(entry[0] != chunk.classes)
+            if len(xs) > size:
+                self.put(chunk.chunkX, chunk.chunkY, self.build(chunk.classes))
+                continue
+            classes, counts, table, cells = entry
+            for x, y, old, new in zip(xs.tolist(), ys.tolist(), classes[xs, ys].tolist(), chunk.classes[xs, ys].tolist()):
+                table[old, x + 1:, y + 1:] -= 1
+                table[new, x + 1:, y + 1:] += 1
+                counts[old] -= 1
+                counts[new] += 1
+                cells.pop(old, None)
+                cells.pop(new, None)
+            entry[0] = chunk.classes
+            self.put(chunk.chunkX, chunk.chunkY, entry)
+
+    def validate_terr(self, terr):
+        "Returns terr if it is a terrain class, otherwise raises ValueError"
+        return self.validate_int(terr, 'terr', minval=0, maxval=self.nclasses - 1)
+
+    def count(self, terr, chunkX, chunkY):
+        "Returns the number of cells of terrain class terr in chunk chunkX,chunkY"
+        terr = self.validate_terr(terr)
+        chunkX = self.validate_int(chunkX, 'chunkX')
+        chunkY = self.validate_int(chunkY, 'chunkY')
+        return int(self.getrect(chunkX, chunkY, chunkX, chunkY)[(chunkX, chunkY)][1][terr])
+
+    def countrect(self, terr, chunkX, chunkY, x, y, sizeX, sizeY):
+        """
+        Returns the number of cells of terrain class terr in the sizeX x sizeY
+         cells starting at RELATIVE x,y of chunk chunkX,chunkY, which may
+         reach into other chunks
+        """
+        terr = self.validate_terr(terr)
+        chunkX = self.validate_int(chunkX, 'chunkX')
+        chunkY = self.validate_int(chunkY, 'chunkY')
+        x, y = self.rel2abs(x, y)
+        sizeX = self.validate_int(sizeX, 'sizeX', minval=1)
+        sizeY = self.validate_int(sizeY, 'sizeY', minval=1)
+        size = self.world.chunksize
+        # World coordinates of the rectangle, the end excluded
+        startX = chunkX * size + x
+        startY = chunkY * size + y
+        endX = startX + sizeX
+        endY = startY + sizeY
+        entries = self.getrect(startX // size, startY // size, (endX - 1) // size, (endY - 1) // size)
+        total = 0
+        for (cx, cy), entry in entries.items():
+            lowX = max(startX - cx * size, 0)
+            lowY = max(startY - cy * size, 0)
+            highX = min(endX - cx * size, size)
+            highY = min(endY - cy * size, size)
+            if lowX == 0 and lowY == 0 and highX == size and highY == size:
+                total += int(entry[1][terr])
+            else:
+                table = entry[2][terr]
+                total += int(table[highX, highY]) - int(table[lowX, highY]) - int(table[highX, lowY]) + int(table[lowX, lowY])
+        return total
+
+    def countradius(self, terr, chunkX, chunkY, x, y, radius):
+        """
+        Returns the number of cells of terrain class terr within radius cells
+         of RELATIVE x,y of chunk chunkX,chunkY, across chunk borders
+         The circle is counted a row at a time, two lookups per row and chunk
+        """
+        terr = self.validate_terr(terr)
+        chunkX = self.validate_int(chunkX, 'chunkX')
+        chunkY = self.validate_int(chunkY, 'chunkY')
+        x, y = self.rel2abs(x, y)
+        radius = self.validate_int(radius, 'radius', minval=0)
+        size = self.world.chunksize
+        centerX = chunkX * size + x
+        centerY = chunkY * size + y
+        limit = radius * radius
+        # The half width of every row of the circle, from centerX - radius
+        offsets = np.arange(-radius, radius + 1)
+        half = np.sqrt(limit - offsets * offsets).astype(np.int64)
+        first = centerX - radius
+        entries = self.getrect((centerX - radius) // size, (centerY - radius) // size,
+                               (centerX + radius) // size, (centerY + radius) // size)
+        total = 0
+        for (cx, cy), entry in entries.items():
+            lowX = cx * size
+            lowY = cy * size
+            # The nearest and furthest cells of the chunk
+            nearX = max(lowX - centerX, 0, centerX - (lowX + size - 1))
+            nearY = max(lowY - centerY, 0, centerY - (lowY + size - 1))
+            if nearX * nearX + nearY * nearY > limit:
+                continue
+            farX = max(abs(lowX - centerX), abs(lowX + size - 1 - centerX))
+            farY = max(abs(lowY - centerY), abs(lowY + size - 1 - centerY))
+            if farX * farX + farY * farY <= limit:
+                total += int(entry[1][terr])
+                continue
+            # The rows of the circle that are in the chunk
+            start = max(lowX - first, 0)
+            end = min(lowX + size - first, len(half))
+            rowX = np.arange(start + first - lowX, end + first - lowX)
+            # np.clip() is several times slower on arrays this small
+            lowest = np.minimum(np.maximum(centerY - half[start:end] - lowY, 0), size)
+            highest = np.minimum(np.maximum(centerY + half[start:end] + 1 - lowY, 0), size)
+            table = entry[2][terr]
+            total += int((table[rowX + 1, highest].astype(np.int64) - table[rowX, highest] - table[rowX + 1, lowest] + table[rowX, lowest]).sum())
+        return total
+
+    def nearest(self, terr, chunkX, chunkY, x, y, maxdist):
+        """
+        Returns the nearest cell of terrain class terr to RELATIVE x,y of
+         chunk chunkX,chunkY (straight line distance, x,y itself included) as
+         (chunkX, chunkY, x, y), x,y RELATIVE, or None if there is none within
+         maxdist cells
+        Chunks are searched in rings around x,y, skipping those without the
+         class, until no chunk further out can be closer
+        """
+        terr = self.validate_terr(terr)
+        chunkX = self.validate_int(chunkX, 'chunkX')
+        chunkY = self.validate_int(chunkY, 'chunkY')
+        x, y = self.rel2abs(x, y)
+        maxdist = self.validate_int(maxdist, 'maxdist', minval=0)
+        size = self.world.chunksize
+        centerX = chunkX * size + x
+        centerY = chunkY * size + y
+        # Squared distance of the best cell so far, anything at least this far is no better
+        best = maxdist * maxdist + 1
+        found = None
+        for ring in range(maxdist // size + 2):
+            # Every cell of a chunk in this ring is at least this far along x or y
+            if ring > 0 and ((ring - 1) * size + 1) ** 2 >= best:
+                break
+            entries = self.getrect(chunkX - ring, chunkY - ring, chunkX + ring, chunkY + ring)
+            candidates = []
+            for (cx, cy), entry in entries.items():
+                if max(abs(cx - chunkX), abs(cy - chunkY)) != ring or entry[1][terr] < 1:
+                    continue
+                dx = max(cx * size - centerX, 0, centerX - (cx * size + size - 1))
+                dy = max(cy * size - centerY, 0, centerY - (cy * size + size - 1))
+                if dx * dx + dy * dy < best:
+                    candidates.append((dx * dx + dy * dy, cx, cy, entry))
+            candidates.sort(key=lambda candidate: candidate[0])
+            for lower, cx, cy, entry in candidates:
+                if lower >= best:
+                    break
+                xs, ys = self.cells(entry, terr)
+                dist = (xs + (cx * size - centerX)) ** 2 + (ys + (cy * size - centerY)) ** 2
+                i = int(dist.argmin())
+                if dist[i] < best:
+                    best = int(dist[i])
+                    found = (cx, cy, int(xs[i]) - self.xoffset, int(ys[i]) - self.yoffset)
+        return found
+
+class TwoDimRenderTarget(InputValidation):
+    """
+    What a TwoDimRenderer draws onto, subclasses implement all of these
+     Coordinates are screen coordinates, line,col
+    """
+    def getmaxyx(self):
+        "Returns (lines, cols)"
+        raise NotImplementedError()
+
+    def addstr(self, line, col, text, attr=0):
+        "Writes text with attribute attr at line,col"
+        raise NotImplementedError()
+
+    def noutrefresh(self):
+        "Marks everything written so far as ready for the next doupdate()"
+        raise NotImplementedError()
+
+    def doupdate(self):
+        "Updates the output with everything marked by noutrefresh()"
+        raise NotImplementedError()
+
+    def colorattr(self, color):
+        "Returns the attribute value for an internal color value (see Colors)"
+        raise NotImplementedError()
+
+    def scroll(self, lines):
+        """
+        Scrolls the contents up by lines (down if negative), blanking the lines
+         scrolled in. Optional, returns False if the target can't scroll
+        """
+        return False
+
+class TwoDimCursesTarget(TwoDimRenderTarget):
+    def __init__(self, win):
+        "Render target for a curses window"
+        self.win = win
+
+    def getmaxyx(self):
+        return self.win.getmaxyx()
+
+    def addstr(self, line, col, text, attr=0):
+        try:
+            self.win.addstr(line, col, text, attr)
+        except curses.error:
+            # Writing the bottom-right cell fails when the cursor can't advance,
+            #  but the character has still been written
+            lines, cols = self.win.getmaxyx()
+            if line != lines - 1 or col + len(text) != cols:
+                raise
+
+    def noutrefresh(self):
+        self.win.noutrefresh()
+
+    def doupdate(self):
+        curses.doupdate()
+
+    def colorattr(self, color):
+        # Same as TwoDimCommon.color2attr()
+        ret = curses.color_pair(color % 8)
+        if color > 7:
+            ret = ret | curses.A_BOLD
+        return ret
+
+    def scroll(self, lines):
+        # Only allow scrolling for this, otherwise writing the bottom-right cell scrolls too
+        self.win.scrollok(True)
+        try:
+            self.win.scroll(lines)
+        finally:
+            self.win.scrollok(False)
+        return True
+
+class TwoDimMemoryTarget(TwoDimRenderTarget):
+    def __init__(self, lines, cols):
+        """
+        Render target that is just a grid of characters and attributes in
+         memory, for running without a terminal (servers, tests, profiling)
+         Attributes are the internal color values (see Colors)
+        """
+        self.lines = self.validate_int(lines, 'lines', minval=1)
+        self.cols = self.validate_int(cols, 'cols', minval=1)
+        self.chars = [[' '] * self.cols for line in range(self.lines)]
+        self.attrs = [[0] * self.cols for line in range(self.lines)]
+        # Number of doupdate() and scroll() calls
+        self.updates = 0
+        self.scrolls = 0
+
+    def getmaxyx(self):
+        return (self.lines, self.cols)
+
+    def addstr(self, line, col, text, attr=0):
+        if line < 0 or line >= self.lines or col < 0 or col + len(text) > self.cols:
+            raise ValueError("addstr() outside of " + str(self.lines) + "x" + str(self.cols) + " (" + str(line) + "," + str(col) + ")")
+        self.chars[line][col:col + len(text)] = list(text)
+        self.attrs[line][col:col + len(text)] = [attr] * len(text)
+
+    def noutrefresh(self):
+        pass
+
+    def doupdate(self):
+        self.updates += 1
+
+    def colorattr(self, color):
+        return color
+
+    def scroll(self, lines):
+        self.chars = shiftlines(self.chars, lines, [' '] * self.cols)
+        self.attrs = shiftlines(self.attrs, lines, [0] * self.cols)
+        self.scrolls += 1
+        return True
+
+    def snapshot(self):
+        "Returns an immutable copy of the grid, (lines of text, lines of attributes)"
+        return (tuple(''.join(chars) for chars in self.chars),
+                tuple(tuple(attrs) for attrs in self.attrs))
+
+    def compare(self, snapshot):
+        "Returns a list of the line,col of every cell that differs from snapshot"
+        ret = []
+        text, attrs = snapshot
+        for line in range(self.lines):
+            for col in range(self.cols):
+                if self.chars[line][col] != text[line][col] or self.attrs[line][col] != attrs[line][col]:
+                    ret.append((line, col))
+        return ret
+
+    def text(self):
+        "Returns the grid as a single string, one line per line"
+        return '\n'.join(''.join(chars) for chars in self.chars)
+
+class TwoDimRenderer(InputValidation):
+    def __init__(self, target, stats=False):
+        """
+        Double buffer for a TwoDimRenderTarget (or a curses window)
+         Drawing goes into a back buffer of (glyph, attribute) per screen cell,
+         present() then sends only the part of each line that differs from the
+         last presented frame to the target, in runs of the same attribute
+         present() is timed as 'refresh' by TwoDimStats stats, if given
+        """
+        if not isinstance(target, TwoDimRenderTarget):
+            target = TwoDimCursesTarget(target)
+        self.target = target
+        if stats == False:
+            stats = TwoDimStats()
+        self.stats = stats
+        self.lines, self.cols = target.getmaxyx()
+        # Attributes for TwoDimWorldSettings.colorlut, see getattrlut()
+        self.attrlut = False
+        self.chars = [[' '] * self.cols for line in range(self.lines)]
+        self.attrs = [[0] * self.cols for line in range(self.lines)]
+        # What the window is showing, None for cells we know nothing about
+        self.frontchars = [[None] * self.cols for line in range(self.lines)]
+        self.frontattrs = [[None] * self.cols for line in range(self.lines)]
+        # Lines of the back buffer changed since the last present()
+        self.dirty = set(range(self.lines))
+
+    def getattrlut(self, colors):
+        """
+        Returns the lookup table of target attributes for the list of colors
+         (TwoDimWorldSettings.colorlut). Built on first use, so that curses is
+         initialized by then
+        """
+        if self.attrlut == False:
+            self.attrlut = [self.target.colorattr(color) for color in colors]
+        return self.attrlut
+
+    def addstr(self, line, col, text, attr=0):
+        "Writes text with attribute attr into the back buffer at screen line,col"
+        if line < 0 or line >= self.lines:
+            return
+        chars = self.chars[line]
+        attrs = self.attrs[line]
+        for ch in text:
+            if col >= self.cols:
+                break
+            if col >= 0:
+                chars[col] = ch
+                attrs[col] = attr
+            col += 1
+        self.dirty.add(line)
+
+    def putrow(self, line, col, chars, attrs):
+        """
+        Copies the lists chars and attrs (one entry per screen column) into the
+         back buffer at screen line,col, clipping whatever doesn't fit
+        """
+        if line < 0 or line >= self.lines:
+            return
+        start = 0
+        if col < 0:
+            start = -col
+            col = 0
+        end = min(len(chars), start + self.cols - col)
+        if end <= start:
+            return
+        self.chars[line][col:col + end - start] = chars[start:end]
+        self.attrs[line][col:col + end - start] = attrs[start:end]
+        self.dirty.add(line)
+
+    def shift(self, lines, cols):
+        """
+        Moves the contents of the back buffer up by lines and left by cols
+         (down/right if negative), leaving blanks where nothing moved in
+        A purely vertical shift also scrolls the target, if it can, so that
+         present() only has to send the lines that were scrolled in
+        """
+        self.chars = shiftlines(self.chars, lines, [' '] * self.cols)
+        self.attrs = shiftlines(self.attrs, lines, [0] * self.cols)
+        if cols != 0:
+            self.chars = [shiftcols(chars, cols, ' ') for chars in self.chars]
+            self.attrs = [shiftcols(attrs, cols, 0) for attrs in self.attrs]
+        if lines != 0 and cols == 0 and abs(lines) < self.lines and self.target.scroll(lines):
+            # Whatever the target scrolled in is unknown until it's been drawn
+            self.frontchars = shiftlines(self.frontchars, lines, [None] * self.cols)
+            self.frontattrs = shiftlines(self.frontattrs, lines, [None] * self.cols)
+        self.dirty = set(range(self.lines))
+
+    def clear(self):
+        "Blanks the back buffer"
+        for line in range(self.lines):
+            self.chars[line] = [' '] * self.cols
+            self.attrs[line] = [0] * self.cols
+        self.dirty = set(range(self.lines))
+
+    def present(self, update=True):
+        """
+        Sends the changed cells to the target and marks it for refresh
+         (noutrefresh()). doupdate() is called if update == True, with several
+         curses windows to present pass False and call it once afterwards
+         Returns the number of cells that were sent
+        """
+        stats = self.stats
+        began = stats.begin()
+        sent = 0
+        for line in sorted(self.dirty):
+            chars = self.chars[line]
+            attrs = self.attrs[line]
+            frontchars = self.frontchars[line]
+            frontattrs = self.frontattrs[line]
+            if chars == frontchars and attrs == frontattrs:
+                continue
+            # Send everything from the first to the last changed cell, the
+            #  unchanged cells in between are cheaper to resend than to look for
+            start = 0
+            while chars[start] == frontchars[start] and attrs[start] == frontattrs[start]:
+                start += 1
+            end = self.cols
+            while chars[end - 1] == frontchars[end - 1] and attrs[end - 1] == frontattrs[end - 1]:
+                end -= 1
+            text = ''.join(chars)
+            col = start
+            while col < end:
+                # Extend the run while the attribute stays the same
+                attr = attrs[col]
+                nextcol = col + 1
+                while nextcol < end and attrs[nextcol] == attr:
+                    nextcol += 1
+                self.target.addstr(line, col, text[col:nextcol], attr)
+                col = nextcol
+            sent += end - start
+            self.frontchars[line] = list(chars)
+            self.frontattrs[line] = list(attrs)
+        self.dirty = set()
+        self.target.noutrefresh()
+        if update:
+            self.target.doupdate()
+        stats.add('refresh', began)
+        return sent
 
 class TwoDimDrawing(TwoDimCommon):
     def __init__(self, worldsettings):
-        "Handles drawing onto curses windows of two-dimensional chunks and objects"
+        "Handles drawing onto curses windows (or other TwoDimRenderTargets) of two-dimensional chunks and objects"
         self.world = worldsettings
         # TODO: Use superclass constructor instead to set xoffset/yoffset
         self.xoffset = int(worldsettings.chunksize / 2)
         self.yoffset = int(worldsettings.chunksize / 2)
+        # window (curses window or TwoDimRenderTarget) -> TwoDimRenderer, everything is drawn through these
+        self.renderers = {}
 
+    def getrenderer(self, win):
+        "Returns the TwoDimRenderer for window win"
+        renderer = self.renderers.get(win)
+        if renderer is None:
+            renderer = TwoDimRenderer(win, self.world.stats)
+            self.renderers[win] = renderer
+        return renderer
+
+    def present(self, win, update=True):
+        "Presents everything drawn onto window win since the last present(), see TwoDimRenderer.present()"
+        return self.getrenderer(win).present(update)
+
+    def moveables(self, records, win):
+        """
+        Yields a TwoDimMoveable, drawn by this TwoDimDrawing on win, for each
+         object record in records (e.g. objectsinrect()) as it is needed
+        """
+        for record in records:
+            yield self.db2moveable(record, self, win, record[3], record[4])
 
     def drawchunk(self, chunkX, chunkY, win, xoffset=0, yoffset=0, drawobjs=True):
         """
@@ -443,39 +3571,102 @@ class TwoDimDrawing(TwoDimCommon):
          Also draws objects located on same chunk, unless drawobjs == False
         """
         # Validate params
-        chunkX = self.validate_int(chunkX, 'chunkX')
-        chunkY = self.validate_int(chunkY, 'chunkY')
-        win = self.validate_win(win, 'win')
-        xoffset, yoffset = self.validate_rel(xoffset, yoffset)
-        self.world.c.execute("SELECT data FROM chunks WHERE x=" + str(chunkX) + " AND y=" + str(chunkY))
-        records = self.world.c.fetchall()
-        if len(records) < 1:
+        if not self.trusted:
+            chunkX = self.validate_int(chunkX, 'chunkX')
+            chunkY = self.validate_int(chunkY, 'chunkY')
+            win = self.validate_win(win, 'win')
+            xoffset, yoffset = self.validate_rel(xoffset, yoffset)
+        stats = self.world.stats
+        start = stats.begin()
+        chunk = self.fetchchunk(chunkX, chunkY)
+        if chunk is None:
             raise ValueError("Chunk " + str(chunkX) + "," + str(chunkY) + " not found in database")
-        dataset = pickle.loads(records[0][0])
-        win.clear()
-        for x in range(self.world.chunksize):
-            for y in range(self.world.chunksize):
-                self.drawmarker(dataset, win, x, y, xoffset, yoffset, refresh=False)
-        self.world.c.execute("SELECT rowid,* FROM objects")
-        records = self.world.c.fetchall()
+        # Make sure the whole chunk fits, so the cells themselves don't need checking
+        self.abs2screen(xoffset, yoffset)
+        self.abs2screen(self.world.chunksize - 1 + xoffset, self.world.chunksize - 1 + yoffset)
+        markers = self.world.markerlut
+        attrs = self.getattrlut(win)
+        height = self.world.height
+        width = self.world.width
+        renderer = self.getrenderer(win)
+        renderer.clear()
+        for x, row in enumerate(chunk.classes.tolist()):
+            scrx = (x + xoffset) * height
+            for y, terr in enumerate(row):
+                renderer.addstr(scrx, (y + yoffset) * width, markers[terr], attrs[terr])
+        records = self.world.registry.chunkobjects(chunkX, chunkY)
         if len(records) > 0:
             # self.debug("There are " + str(len(records)) + " objects to be displayed")
+            # The records come from the registry, and the chunk was checked to fit above
             for rec in records:
                 # self.debug("RECORD: " + str(rec))
-                self.drawobjectfromrecord(rec, chunkX, chunkY, win, xoffset, yoffset, refresh=False)
-        win.refresh()
+                self.drawrecord_unchecked(rec, renderer, xoffset, yoffset)
+        stats.add('draw', start)
+        renderer.present()
 
     def eraseobject(self,objid, dataset, win, x, y, chunkX=0, chunkY=0, xoffset=0, yoffset=0, refresh=True):
         # TODO: Data validation, documentation
         # REMOVE? Pretty sure we're not using this
         #  at least TEST it...
-        self.world.c.execute("SELECT rowid,* FROM objects WHERE rowid IS NOT " + str(objid) + " AND x=" + str(x) + " AND y=" + str(y))
-        records = self.world.c.fetchall()
+        records = [rec for rec in self.world.registry.cellobjects(chunkX, chunkY, x, y) if rec[0] != objid]
         if len(records):
             self.drawobjectfromrecord(records[-1], chunkX, chunkY, win, xoffset, yoffset, refresh)
         else:
             self.drawmarker(dataset, win, x, y, xoffset, yoffset, refresh)
 
+    def drawcells(self, win, cells, chunkX, chunkY, xoffset=0, yoffset=0, refresh=True):
+        """
+        Redraws the cells of chunk chunkX,chunkY in cells, rows of (chunkX,
+         chunkY, absolute x, absolute y) such as the cells returned by
+         TwoDimObjectArray.tick(), onto window win. Cells in other chunks are
+         skipped
+        """
+        win = self.validate_win(win, 'win')
+        xoffset, yoffset = self.validate_rel(xoffset, yoffset)
+        stats = self.world.stats
+        start = stats.begin()
+        cells = cells[(cells[:, 0] == chunkX) & (cells[:, 1] == chunkY)]
+        if len(cells) > 0:
+            chunk = self.fetchchunk(chunkX, chunkY)
+            if chunk is None:
+                raise ValueError("Chunk " + str(chunkX) + "," + str(chunkY) + " not found in database")
+            renderer = self.getrenderer(win)
+            cellobjects = self.world.registry.cellobjects
+            for x, y in cells[:, 2:].tolist():
+                relx, rely = self.abs2rel_unchecked(x, y)
+                records = cellobjects(chunkX, chunkY, relx, rely)
+                if len(records) > 0:
+                    for rec in records:
+                        self.drawrecord_unchecked(rec, renderer, xoffset, yoffset)
+                else:
+                    self.drawterrain_unchecked(chunk, renderer, x, y, xoffset, yoffset, refresh=False)
+        stats.add('draw', start)
+        if refresh:
+            self.present(win)
+
+    def drawoverview(self, win, overview, level, chunkX, chunkY, refresh=True):
+        """
+        Fills window win with the TwoDimOverview overview at level, starting
+         with chunk chunkX,chunkY at the top,left
+        """
+        win = self.validate_win(win, 'win')
+        renderer = self.getrenderer(win)
+        size = overview.sizes[level]
+        rows = renderer.lines // self.world.height
+        cols = renderer.cols // self.world.width
+        classes = overview.getrect(level, chunkX, chunkY, chunkX + (rows - 1) // size, chunkY + (cols - 1) // size)
+        markers = self.world.markerlut
+        attrs = renderer.getattrlut(self.world.colorlut)
+        width = self.world.width
+        renderer.clear()
+        for row, terrs in enumerate(classes[:rows, :cols].tolist()):
+            chars = []
+            for terr in terrs:
+                chars.extend(markers[terr])
+            renderer.putrow(row * self.world.height, 0, chars, [attrs[terr] for terr in terrs for i in range(width)])
+        if refresh:
+            renderer.present()
+
     def drawmarker(self, dataset, win, x, y, xoffset=0, yoffset=0, refresh=True):
         """
         Draws and colors the (terrain) marker from dataset onto window win
@@ -485,30 +3676,39 @@ class TwoDimDrawing(TwoDimCommon):
         """
         relx, rely = self.validate_rel(x + xoffset, y + yoffset)
         scrx, scry = self.abs2screen(relx, rely)
-        win.addstr(scrx, scry, self.getmarker(x,y,dataset)*self.world.width)
-        win.chgat(scrx, scry, self.world.width, self.getcolor(x,y,dataset))
+        renderer = self.getrenderer(win)
+        terr = min(self.getval(x, y, dataset), len(self.world.markerlut) - 1)
+        renderer.addstr(scrx, scry, self.world.markerlut[terr], renderer.getattrlut(self.world.colorlut)[terr])
         if refresh:
-            win.refresh
+            renderer.present()
 
     def drawobjectfromrecord(self, rec, chunkX, chunkY, win, xoffset=0, yoffset=0, refresh=True):
         """
         Draws an object from an (depickled) object record
-         chunkX,chunkY are a necessary evil at this moment as they are required
-         to construct a new TwoDimObject/TwoDimMoveable
+         chunkX,chunkY are kept for compatibility, the record has its own
         """
         # Validate the incoming record
         rec = self.validate_tup(rec, 'rec', mincount=9, maxcount=9)
-        # Convert it into a TwoDimObject
-        obj = self.db2object(rec, chunkX, chunkY)
-        # Determine our screen coordinates, taking into account any x/y offset prior to coversion
-        scrx, scry = self.rel2screen(obj.x + xoffset, obj.y + yoffset)
-        # Draw tbe icon on the screen, making it the appropriate width
-        win.addstr(scrx, scry, obj.icon*obj.width)
-        # Change the color of the icon on the screen
-        win.chgat(scrx, scry, obj.width, self.color2attr(obj.color))
-        # Regfresh the screen/window, but only if requested
+        if not self.trusted:
+            self.validate_str(rec[5], 'icon', blank=False)
+            self.validate_int(rec[6], 'width', minval=0, maxval=self.world.chunksize)
+            self.validate_int(rec[8], 'color')
+            # Determine our screen coordinates, taking into account any x/y offset prior to coversion
+            self.rel2screen(self.validate_int(rec[1], 'x') + xoffset, self.validate_int(rec[2], 'y') + yoffset)
+        # Draw the icon on the screen straight from the record, making it the appropriate width and color
+        renderer = self.getrenderer(win)
+        self.drawrecord_unchecked(rec, renderer, xoffset, yoffset)
+        # Present the changes on the screen/window, but only if requested
         if refresh:
-            win.refresh()
+            renderer.present()
+
+    def drawrecord_unchecked(self, rec, renderer, xoffset=0, yoffset=0):
+        """
+        Draws an object record straight onto renderer, without validating it or
+         constructing a TwoDimObject. The record must come from the registry
+        """
+        scrx, scry = self.rel2screen_unchecked(rec[1] + xoffset, rec[2] + yoffset)
+        renderer.addstr(scrx, scry, rec[5]*rec[6], renderer.target.colorattr(rec[8]))
 
     def drawlocation(self, win, chunkX, chunkY, x, y, xoffset=0, yoffset=0, refresh=True):
         """
@@ -518,30 +3718,62 @@ class TwoDimDrawing(TwoDimCommon):
         # TODO: Objects need chunkX and chunkY
         #        or do we just calculate it from x,y? That seems cleaner
         # self.debug("DRAWLOCATION(" + str(x) + "," + str(y) + ")")
-        x, y = self.validate_abs(x, y)
-        self.world.c.execute("SELECT data FROM chunks WHERE x=" + str(chunkX) + " AND y=" + str(chunkY))
-        records = self.world.c.fetchall()
-        if len(records) < 1:
+        if not self.trusted:
+            x, y = self.validate_abs(x, y)
+            xoffset, yoffset = self.validate_rel(xoffset, yoffset)
+            self.abs2screen(x + xoffset, y + yoffset)
+        self.drawlocation_unchecked(win, chunkX, chunkY, x, y, xoffset, yoffset, refresh)
+
+    def drawlocation_unchecked(self, win, chunkX, chunkY, x, y, xoffset=0, yoffset=0, refresh=True):
+        "drawlocation() for coordinates that are already known to be valid"
+        stats = self.world.stats
+        start = stats.begin()
+        chunk = self.fetchchunk(chunkX, chunkY)
+        if chunk is None:
             raise ValueError("Chunk " + str(chunkX) + "," + str(chunkY) + " not found in database")
-        dataset = pickle.loads(records[0][0])
-        relx, rely = self.abs2rel(x, y)
-        self.world.c.execute("SELECT rowid,* FROM objects WHERE x=" + str(relx) + " AND y=" + str(rely))
-        records = self.world.c.fetchall()
+        renderer = self.getrenderer(win)
+        relx, rely = self.abs2rel_unchecked(x, y)
+        records = self.world.registry.cellobjects(chunkX, chunkY, relx, rely)
         if len(records) > 0:
             # self.debug("There are " + str(len(records)) + " objects to be displayed (DRAWLOCATION)")
             for rec in records:
-                self.drawobjectfromrecord(rec, chunkX, chunkY, win, xoffset, yoffset, refresh=False)
-                if refresh:
-                    win.refresh()
+                self.drawrecord_unchecked(rec, renderer, xoffset, yoffset)
         else:
-            self.drawmarker(dataset, win, x, y, xoffset, yoffset, refresh=refresh)
+            self.drawterrain_unchecked(chunk, renderer, x, y, xoffset, yoffset, refresh=False)
+        stats.add('draw', start)
+        if refresh:
+            renderer.present()
+
+    def drawterrain(self, chunk, win, x, y, xoffset=0, yoffset=0, refresh=True):
+        """
+        Draws the (terrain) marker of TwoDimChunk chunk located at x,y onto
+         window win, using the precomputed terrain classes and lookup tables
+         xoffset,yoffset and refresh are the same as for drawmarker()
+        """
+        if not self.trusted:
+            x, y = self.validate_abs(x, y)
+            self.abs2screen(x + xoffset, y + yoffset)
+        self.drawterrain_unchecked(chunk, self.getrenderer(win), x, y, xoffset, yoffset, refresh)
+
+    def drawterrain_unchecked(self, chunk, renderer, x, y, xoffset=0, yoffset=0, refresh=True):
+        "drawterrain() onto renderer, for coordinates that are already known to be valid"
+        scrx, scry = self.abs2screen_unchecked(x + xoffset, y + yoffset)
+        terr = chunk.classes[x, y]
+        renderer.addstr(scrx, scry, self.world.markerlut[terr], renderer.getattrlut(self.world.colorlut)[terr])
+        if refresh:
+            renderer.present()
+
+    def getattrlut(self, win):
+        "Returns the lookup table of window win's attributes, indexed by terrain class"
+        return self.getrenderer(win).getattrlut(self.world.colorlut)
 
     def getval(self, x, y, dataset):
         "Returns the terrain value at the absolute x,y coordinates"
         x = self.validate_int(x, 'x', minval=0, maxval=self.world.chunksize)
         y = self.validate_int(y, 'y', minval=0, maxval=self.world.chunksize)
         # Adjust terrval to be ABOVE zero, and then scale to be between 0 and 1
-        terrval = dataset[x][y] + 1
+        #  this MUST match terrainclasses()
+        terrval = float(dataset[x][y]) + 1
         terrval *= .5
         # Calculate the size of the slices each type of terrain will be
         offset = 1.0 / len(self.world.markermap)
@@ -554,7 +3786,7 @@ class TwoDimDrawing(TwoDimCommon):
         x = self.validate_int(x, 'x', minval=0, maxval=self.world.chunksize)
         y = self.validate_int(y, 'y', minval=0, maxval=self.world.chunksize)
         terr = self.getval(x,y, dataset)
-        if not self.world.markermap.has_key(terr):
+        if terr not in self.world.markermap:
             return self.world.defmarker
         else:
             return self.world.markermap[terr]
@@ -564,7 +3796,7 @@ class TwoDimDrawing(TwoDimCommon):
         x = self.validate_int(x, 'x', minval=0, maxval=self.world.chunksize)
         y = self.validate_int(y, 'y', minval=0, maxval=self.world.chunksize)
         terr = self.getval(x, y, dataset)
-        if self.world.colormap.has_key(terr):
+        if terr in self.world.colormap:
             ret = self.world.colormap[terr]
         else:
             # Use default color
@@ -572,39 +3804,282 @@ class TwoDimDrawing(TwoDimCommon):
             #debug("Failed to find color for terrain value " + str(terr))
         return self.color2attr(ret)
 
+class TwoDimViewport(TwoDimCommon):
+    def __init__(self, world, painter, win, x=0, y=0, maxtiles=64):
+        """
+        A camera onto any rectangle of the world, across chunk borders
+         world is the TwoDimWorld (for loading/generating chunks), painter the
+         TwoDimDrawing whose renderer for window win is used
+         x,y is the WORLD cell shown at the top,left of the window, where world
+         cell (chunkX * chunksize + absolute x, chunkY * chunksize + absolute y)
+         is absolute cell x,y of chunk chunkX,chunkY
+        Each chunk is turned into a tile once (its rows of glyphs and attributes
+         per screen column), and views are stitched together from the tiles of
+         up to maxtiles chunks
+        """
+        self.worldobj = world
+        self.world = self.validate_worldset(world.world, 'world.world')
+        self.painter = painter
+        self.win = self.validate_win(win, 'win')
+        self.x = self.validate_int(x, 'x')
+        self.y = self.validate_int(y, 'y')
+        self.maxtiles = self.validate_int(maxtiles, 'maxtiles', minval=1)
+        self.xoffset = int(self.world.chunksize / 2)
+        self.yoffset = int(self.world.chunksize / 2)
+        self.renderer = painter.getrenderer(win)
+        # Size of the view in cells
+        self.rows = self.renderer.lines // self.world.height
+        self.cols = self.renderer.cols // self.world.width
+        # (chunkX, chunkY) -> (TwoDimChunk, rows of glyphs, rows of attributes), least recently used first
+        self.tiles = OrderedDict()
+        # Number of cells drawn, by draw() and the strips of moveto()
+        self.drawn = 0
+
+    def tile(self, chunkX, chunkY):
+        """
+        Returns the (chars, attrs) tile for chunkX,chunkY, a list of the
+         screen columns of each row of the chunk. Rebuilt whenever the chunk
+         is replaced
+        """
+        key = (chunkX, chunkY)
+        chunk = self.fetchchunk(chunkX, chunkY)
+        if chunk is None:
+            self.worldobj.loadchunk(chunkX, chunkY, loadneighbors=False)
+            chunk = self.fetchchunk(chunkX, chunkY)
+        tile = self.tiles.pop(key, None)
+        if tile is None or tile[0] is not chunk:
+            markers = self.world.markerlut
+            attrs = self.renderer.getattrlut(self.world.colorlut)
+            width = self.world.width
+            rowchars = []
+            rowattrs = []
+            for row in chunk.classes.tolist():
+                chars = []
+                for terr in row:
+                    chars.extend(markers[terr])
+                rowchars.append(chars)
+                rowattrs.append([attrs[terr] for terr in row for i in range(width)])
+            tile = (chunk, rowchars, rowattrs)
+        self.tiles[key] = tile
+        while len(self.tiles) > self.maxtiles:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def world2chunk(self, x, y):
+        "Returns (chunkX, chunkY, absolute x, absolute y) for world cell x,y"
+        chunkX, absx = divmod(x, self.world.chunksize)
+        chunkY, absy = divmod(y, self.world.chunksize)
+        return (chunkX, chunkY, absx, absy)
+
+    def chunk2world(self, chunkX, chunkY, x, y):
+        "Returns the world cell for absolute cell x,y of chunk chunkX,chunkY"
+        return (chunkX * self.world.chunksize + x, chunkY * self.world.chunksize + y)
+
+    def drawrect(self, top, left, rows, cols, objects=True):
+        """
+        Draws the cells of the view from row top, column left (view cells, not
+         screen coordinates) for rows x cols cells into the back buffer
+         Objects are drawn on top unless objects == False
+        """
+        if rows < 1 or cols < 1:
+            return
+        stats = self.world.stats
+        start = stats.begin()
+        size = self.world.chunksize
+        height = self.world.height
+        width = self.world.width
+        minX, minY, absx, absy = self.world2chunk(self.x + top, self.y + left)
+        maxX, maxY, absx, absy = self.world2chunk(self.x + top + rows - 1, self.y + left + cols - 1)
+        # Load (or generate) every chunk involved at once
+        self.worldobj.loadrect(minX, minY, maxX, maxY)
+        tiles = {}
+        for row in range(top, top + rows):
+            chunkX, absx = divmod(self.x + row, size)
+            col = left
+            while col < left + cols:
+                chunkY, absy = divmod(self.y + col, size)
+                count = min(size - absy, left + cols - col)
+                tile = tiles.get((chunkX, chunkY))
+                if tile is None:
+                    tile = tiles[(chunkX, chunkY)] = self.tile(chunkX, chunkY)
+                chunk, chars, attrs = tile
+                self.renderer.putrow(row * height, col * width, chars[absx][absy * width:(absy + count) * width],
+                                     attrs[absx][absy * width:(absy + count) * width])
+                col += count
+        # Objects on top of the terrain
+        if objects:
+            for chunkX in range(minX, maxX + 1):
+                for chunkY in range(minY, maxY + 1):
+                    for rec in self.world.registry.chunkobjects(chunkX, chunkY):
+                        self.drawrecord(rec, top, left, rows, cols)
+        self.drawn += rows * cols
+        stats.add('draw', start)
+
+    def drawrecord(self, rec, top=0, left=0, rows=False, cols=False):
+        "Draws the object record rec, if it's inside the given part of the view (by default all of it)"
+        if rows == False:
+            rows = self.rows
+        if cols == False:
+            cols = self.cols
+        absx, absy = self.rel2abs_unchecked(rec[1], rec[2])
+        x, y = self.chunk2world(rec[3], rec[4], absx, absy)
+        row = x - self.x
+        col = y - self.y
+        if row >= top and row < top + rows and col >= left and col < left + cols:
+            self.renderer.addstr(row * self.world.height, col * self.world.width, rec[5]*rec[6], self.renderer.target.colorattr(rec[8]))
+
+    def blankmargin(self):
+        "Blanks the part of the window that is too small to hold a cell, to the right and below the view"
+        left = self.cols * self.world.width
+        for line in range(self.renderer.lines):
+            if line >= self.rows * self.world.height:
+                self.renderer.putrow(line, 0, [' '] * self.renderer.cols, [0] * self.renderer.cols)
+            elif left < self.renderer.cols:
+                self.renderer.putrow(line, left, [' '] * (self.renderer.cols - left), [0] * (self.renderer.cols - left))
+
+    def draw(self, refresh=True):
+        "Draws the whole view"
+        self.renderer.clear()
+        self.drawrect(0, 0, self.rows, self.cols)
+        if refresh:
+            self.renderer.present()
+
+    def drawlocation(self, chunkX, chunkY, x, y, refresh=True):
+        "Redraws absolute cell x,y of chunk chunkX,chunkY, if it's in view (e.g. after an object moved)"
+        wx, wy = self.chunk2world(chunkX, chunkY, x, y)
+        row = wx - self.x
+        col = wy - self.y
+        if row >= 0 and row < self.rows and col >= 0 and col < self.cols:
+            self.drawrect(row, col, 1, 1, objects=False)
+            relx, rely = self.abs2rel_unchecked(x, y)
+            for rec in self.world.registry.cellobjects(chunkX, chunkY, relx, rely):
+                self.drawrecord(rec, row, col, 1, 1)
+            if refresh:
+                self.renderer.present()
+
+    def drawcells(self, cells, refresh=True):
+        """
+        Redraws every cell in cells, rows of (chunkX, chunkY, absolute x,
+         absolute y) such as the cells returned by TwoDimObjectArray.tick()
+        """
+        for chunkX, chunkY, x, y in cells.tolist():
+            self.drawlocation(chunkX, chunkY, x, y, refresh=False)
+        if refresh:
+            self.renderer.present()
+
+    def moveto(self, x, y, refresh=True):
+        """
+        Moves the top,left of the view to world cell x,y. The contents of the
+         window are scrolled along, and only the cells that come into view
+         are drawn
+        """
+        x = self.validate_int(x, 'x')
+        y = self.validate_int(y, 'y')
+        dx = x - self.x
+        dy = y - self.y
+        if dx == 0 and dy == 0:
+            return
+        self.x = x
+        self.y = y
+        if abs(dx) >= self.rows or abs(dy) >= self.cols:
+            # Nothing left on screen is still in view
+            self.draw(refresh)
+            return
+        self.renderer.shift(dx * self.world.height, dy * self.world.width)
+        self.blankmargin()
+        # The rows that came into view, then the columns, minus the corner they share
+        if dx > 0:
+            self.drawrect(self.rows - dx, 0, dx, self.cols)
+        elif dx < 0:
+            self.drawrect(0, 0, -dx, self.cols)
+        top = max(0, -dx)
+        rows = self.rows - abs(dx)
+        if dy > 0:
+            self.drawrect(top, self.cols - dy, rows, dy)
+        elif dy < 0:
+            self.drawrect(top, 0, rows, -dy)
+        if refresh:
+            self.renderer.present()
+
+    def scroll(self, dx, dy, refresh=True):
+        "Moves the view by dx rows and dy columns"
+        self.moveto(self.x + dx, self.y + dy, refresh)
+
+    def follow(self, obj, margin=2, refresh=True):
+        """
+        Scrolls the view (if needed) to keep TwoDimObject obj at least margin
+         cells away from its edges
+        """
+        absx, absy = obj.rel2abs_unchecked(obj.x, obj.y)
+        x, y = self.chunk2world(obj.chunkX, obj.chunkY, absx, absy)
+        margin = min(margin, (self.rows - 1) // 2, (self.cols - 1) // 2)
+        newx = min(max(self.x, x - self.rows + 1 + margin), x - margin)
+        newy = min(max(self.y, y - self.cols + 1 + margin), y - margin)
+        self.moveto(newx, newy, refresh)
+
 class TwoDimObject(TwoDimCommon):
     # RELATIVE COORDINATES
+    # Objects only store where they are, what they look like is an interned
+    #  (icon, width, height, color) appearance record, see getappearance()
+    __slots__ = ('world', 'objid', 'chunkX', 'chunkY', 'x', 'y', 'appearance')
+
     def __init__(self, worldset, chunkX=0, chunkY=0, objid=1, x=0, y=0, icon='@', width=0, height=0, color=Colors.BRIGHT_RED):
         # TODO: Validate
         self.world = worldset
         # self.debug("Creating object " + icon + " at " + str(x) + ", " + str(y))
         # Validate and set the object id (database record number)
         self.objid = self.validate_int(objid, 'objid', minval=1)
-        # Set the world settings
-        # Update the x/y offsets for the relative coordinates (within the chunk) to the new chunksize
-        self.xoffset = int(self.world.chunksize / 2)
-        self.yoffset = int(self.world.chunksize / 2)
         # Validate and set the coordinates of the chunk
         self.chunkX = self.validate_int(chunkX, "chunkX")
         self.chunkY = self.validate_int(chunkY, "chunkY")
         # Make sure x and y are integers
         self.x, self.y = self.validate_rel(x, y)
+        self.appearance = None
+        self.restyle(icon, width, height, color)
+
+    # The x/y offsets for the relative coordinates (within the chunk) are the
+    #  same for every object in the world
+    xoffset = property(lambda self: self.world.chunksize // 2)
+    yoffset = property(lambda self: self.world.chunksize // 2)
+
+    # Read from (and written through to) the appearance record
+    icon = property(lambda self: self.appearance[0], lambda self, icon: self.restyle(icon=icon))
+    width = property(lambda self: self.appearance[1], lambda self, width: self.restyle(width=width))
+    height = property(lambda self: self.appearance[2], lambda self, height: self.restyle(height=height))
+    color = property(lambda self: self.appearance[3], lambda self, color: self.restyle(color=color))
 
-        # Validate and set icon character
-        self.icon = self.validate_str(icon, 'icon', blank=False)
-        # Validate and set color value
-        self.color = self.validate_int(color, 'color', minval=0)
+    def restyle(self, icon=None, width=None, height=None, color=None):
+        """
+        Changes the appearance of the object, leaving anything that's None as
+         it is. A width or height of 0 is the default for the world
+        """
+        if self.appearance is not None:
+            oldicon, oldwidth, oldheight, oldcolor = self.appearance
+            icon = oldicon if icon is None else icon
+            width = oldwidth if width is None else width
+            height = oldheight if height is None else height
+            color = oldcolor if color is None else color
+        # Validate icon character and color value
+        icon = self.validate_str(icon, 'icon', blank=False)
+        color = self.validate_int(color, 'color', minval=0)
         # Check for default width and height
         if width == 0:
             width = self.world.width
         if height == 0:
             height = self.world.height
-        # Validate and set the width and height
-        self.width = self.validate_int(width, 'width', minval=1, maxval=self.world.chunksize)
-        self.height = self.validate_int(height, 'height', minval=1, maxval=self.world.chunksize)
+        # Validate the width and height
+        width = self.validate_int(width, 'width', minval=1, maxval=self.world.chunksize)
+        height = self.validate_int(height, 'height', minval=1, maxval=self.world.chunksize)
+        self.appearance = self.getappearance(icon, width, height, color)
+
+    def record(self):
+        "Returns the object as a database record, (objid, x, y, chunkX, chunkY, icon, width, height, color)"
+        return (self.objid, self.x, self.y, self.chunkX, self.chunkY) + self.appearance
 
 class TwoDimMoveable(TwoDimObject):
     # RELATIVE COORDINATES
+    __slots__ = ('painter', 'win')
+
     def __init__(self,
                  worldset,
                  painter,
@@ -625,49 +4100,265 @@ class TwoDimMoveable(TwoDimObject):
         self.win = self.validate_win(win, 'win')
 
     def write2db(self):
-        self.world.c.execute("SELECT rowid FROM objects WHERE rowid=" + str(self.objid))
-        records = self.world.c.fetchall()
-        if len(records) > 0:
-            self.world.c.execute("UPDATE objects SET x=" + str(self.x) + ", y=" + str(self.y) + ", chunkX=" + str(self.chunkX) + ", chunkY=" + str(self.chunkY) + ", icon=" + "'" + self.icon + "'" + ", width=" + str(self.width) + ", height=" + str(self.height) + ", color=" + str(self.color)  + " WHERE rowid=" + str(self.objid) )
+        if self.world.writebehind == False:
+            stats = self.world.stats
+            start = stats.begin()
+            self.world.storage.saveobject(self.record())
+            stats.add('commit', start)
         else:
-            self.world.c.execute("INSERT INTO objects (x, y, chunkX, chunkY, icon, width, height, color) VALUES (" + str(self.x) + ", " + str(self.y) + ", " + str(self.chunkX) + ", " + str(self.chunkY) + ", " + self.icon + ", " + str(self.width) + ", " + str(self.height) + ", " + str(self.color) + ")")
+            self.world.writebehind.mark(self.record())
+        self.world.registry.update(self.record())
         # self.debug("Wrote object " + self.icon + " at " + str(self.x) + ", " + str(self.y) + " to the database")
-        self.world.db.commit()
 
-    def move(self, newX, newY):
+    def move(self, newX, newY, refresh=True):
         "Pretty alias for moverelative()"
-        self.moverelative(newX, newY)
-
-    def moveabsolute(self, newX, newY):
-        "Move object to a new position using absolute coordinates x,y"
-        # Convert the absolute coordinates to relative
-        #  the reason we do this before the validation is so the debug displays regardless
-        relx, rely = self.abs2rel(newX, newY)
-        # self.debug("Moving object " + self.icon + " to absolute coordinates " + str(newX) + "," + str(newY) + " (" + str(relx) + "," + str(rely) + ")")
+        self.moverelative(newX, newY, refresh)
 
+    def moveabsolute(self, newX, newY, refresh=True):
+        """
+        Move object to a new position using absolute coordinates x,y
+         With refresh == False the move is drawn but not presented, so that
+         several moves can be presented at once with TwoDimDrawing.present()
+        """
         # Validate new X and Y values
-        newX, newY = self.validate_abs(newX, newY)
+        #  staying inside the chunk is game logic, so that is checked even when trusted
+        if not self.trusted or not self.inchunk(newX, newY):
+            newX, newY = self.validate_abs(newX, newY)
+        stats = self.world.stats
+        start = stats.begin()
+        relx, rely = self.abs2rel_unchecked(newX, newY)
+        # self.debug("Moving object " + self.icon + " to absolute coordinates " + str(newX) + "," + str(newY) + " (" + str(relx) + "," + str(rely) + ")")
 
         if  relx != self.x or rely != self.y:
             # Save the old x,y so we can redraw the screen in that location
-            oldabsx, oldabsy = self.rel2abs(self.x, self.y)
+            oldabsx, oldabsy = self.rel2abs_unchecked(self.x, self.y)
             # Update the x,y for the object
             self.x = relx
             self.y = rely
             # Update the database
             self.write2db()
             # Repaint the relevant portions of the screen
-            self.painter.drawlocation(self.win, self.chunkX, self.chunkY, oldabsx, oldabsy, refresh=True)
-            self.painter.drawlocation(self.win, self.chunkX, self.chunkY, newX, newY, refresh=True)
+            self.painter.drawlocation_unchecked(self.win, self.chunkX, self.chunkY, oldabsx, oldabsy, refresh=False)
+            self.painter.drawlocation_unchecked(self.win, self.chunkX, self.chunkY, newX, newY, refresh=False)
+            if refresh:
+                self.painter.present(self.win)
+            # Start loading the chunks this object is heading for
+            if self.world.prefetcher != False:
+                self.world.prefetcher.moved(self)
+        stats.add('move', start)
 
-    def moverelative(self, newX, newY):
+    def moverelative(self, newX, newY, refresh=True):
         "Move object to a new position using relative coordinates x,y"
-        absx, absy = self.rel2abs(newX, newY)
+        if not self.trusted:
+            newX, newY = self.validate_rel(newX, newY)
+        absx, absy = self.rel2abs_unchecked(newX, newY)
         # self.debug("Moving object " + self.icon + " to relative coordinates " + str(newX) + "," + str(newY) + " (" + str(absx) + "," + str(absy) + ")")
-        self.moveabsolute(absx, absy)
+        self.moveabsolute(absx, absy, refresh)
 
-    def moveoffset(self, offsetX, offsetY):
+    def moveoffset(self, offsetX, offsetY, refresh=True):
         "Move object to a new position using offset coordinates x,y"
-        absx, absy = self.rel2abs(self.x + offsetX, self.y + offsetY)
+        if not self.trusted:
+            offsetX = self.validate_int(offsetX, 'offsetX')
+            offsetY = self.validate_int(offsetY, 'offsetY')
+        absx, absy = self.rel2abs_unchecked(self.x + offsetX, self.y + offsetY)
         # self.debug("moveoffset(" + str(offsetX) + "," + str(offsetY) + ") = " + str(absx) + "," + str(absy))
-        self.moveabsolute(absx, absy)
+        self.moveabsolute(absx, absy, refresh)
+
+class TwoDimObjectArray(TwoDimCommon):
+    # The columns, in record order (with the icon as an index into self.icons)
+    COLUMNS = ('objid', 'x', 'y', 'chunkX', 'chunkY', 'iconid', 'width', 'height', 'color')
+
+    def __init__(self, worldsettings, capacity=1024, collide=True):
+        """
+        Column store of many objects (e.g. drones), one NumPy array per field
+         of the object record, rather than a TwoDimMoveable per object
+         Coordinates are RELATIVE, like TwoDimObject. Icons are stored as
+         indexes into self.icons, so each icon string is stored only once
+        tick() moves any number of them at once. With collide == True no two
+         objects of the array may end up in the same cell (objects that are
+         already stacked may stay that way)
+        """
+        self.world = self.validate_worldset(worldsettings, 'worldsettings')
+        self.xoffset = int(self.world.chunksize / 2)
+        self.yoffset = int(self.world.chunksize / 2)
+        self.collide = collide
+        self.count = 0
+        self.capacity = self.validate_int(capacity, 'capacity', minval=1)
+        self.objid = np.zeros(self.capacity, dtype=np.int64)
+        for name in self.COLUMNS[1:]:
+            setattr(self, name, np.zeros(self.capacity, dtype=np.int32))
+        # Icon strings, and icon -> iconid
+        self.icons = []
+        self.iconids = {}
+        # objid -> row
+        self.rows = {}
+
+    def __len__(self):
+        return self.count
+
+    def grow(self, capacity):
+        "Makes room for at least capacity objects"
+        if capacity <= self.capacity:
+            return
+        while self.capacity < capacity:
+            self.capacity *= 2
+        for name in self.COLUMNS:
+            old = getattr(self, name)
+            new = np.zeros(self.capacity, dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    def geticonid(self, icon):
+        "Returns the iconid of icon, adding it to self.icons if it's new"
+        iconid = self.iconids.get(icon)
+        if iconid is None:
+            iconid = len(self.icons)
+            self.icons.append(icon)
+            self.iconids[icon] = iconid
+        return iconid
+
+    def add(self, record):
+        """
+        Adds (or replaces) an object from its record, (objid, x, y, chunkX,
+         chunkY, icon, width, height, color). Returns its row
+        """
+        record = self.validate_tup(tuple(record), 'record', mincount=9, maxcount=9)
+        objid = self.validate_int(record[0], 'objid', minval=1)
+        row = self.rows.get(objid)
+        if row is None:
+            self.grow(self.count + 1)
+            row = self.count
+            self.count += 1
+            self.rows[objid] = row
+        self.objid[row] = objid
+        self.x[row], self.y[row] = self.validate_rel(record[1], record[2])
+        self.chunkX[row] = self.validate_int(record[3], 'chunkX')
+        self.chunkY[row] = self.validate_int(record[4], 'chunkY')
+        self.iconid[row] = self.geticonid(self.validate_str(record[5], 'icon', blank=False))
+        self.width[row] = self.validate_int(record[6], 'width', minval=1)
+        self.height[row] = self.validate_int(record[7], 'height', minval=1)
+        self.color[row] = self.validate_int(record[8], 'color', minval=0)
+        return row
+
+    def addrecords(self, records):
+        "Adds (or replaces) the objects of every record in records"
+        records = list(records)
+        self.grow(self.count + len(records))
+        for record in records:
+            self.add(record)
+
+    def remove(self, objid):
+        "Removes object objid, moving the last row into its place. Returns its old record (or None)"
+        row = self.rows.pop(objid, None)
+        if row is None:
+            return None
+        ret = self.record(row)
+        last = self.count - 1
+        if row != last:
+            for name in self.COLUMNS:
+                column = getattr(self, name)
+                column[row] = column[last]
+            self.rows[int(self.objid[row])] = row
+        self.count -= 1
+        return ret
+
+    def record(self, row):
+        "Returns the record of the object in row"
+        return self.records([row])[0]
+
+    def records(self, rows=False):
+        "Returns a list of the records of the objects in rows (all of them by default)"
+        if type(rows) == type(bool()):
+            rows = slice(0, self.count)
+        icons = self.icons
+        return [(objid, x, y, chunkX, chunkY, icons[iconid], width, height, color)
+                for objid, x, y, chunkX, chunkY, iconid, width, height, color
+                in zip(*[getattr(self, name)[rows].tolist() for name in self.COLUMNS])]
+
+    def cellkeys(self, chunkX, chunkY, x, y):
+        "Returns an int64 array with a unique key for every (chunkX, chunkY, RELATIVE x, RELATIVE y)"
+        key = (chunkX.astype(np.int64) & 0xFFFFF) << 20 | (chunkY.astype(np.int64) & 0xFFFFF)
+        key = key << 12 | ((x.astype(np.int64) + self.xoffset) & 0xFFF)
+        return key << 12 | ((y.astype(np.int64) + self.yoffset) & 0xFFF)
+
+    def tick(self, dx, dy, rows=False, persist=True):
+        """
+        Moves the objects in rows (all of them by default, each at most once)
+         by dx,dy, which are single numbers or arrays with a value per row
+        Moves that would leave the chunk are refused, as are (if self.collide)
+         moves into a cell taken by another object of the array. Moved objects
+         are written to the registry and (if persist) the database, through
+         the TwoDimWriteBehind if there is one
+        Returns (moved, cells): the array of moved rows, and an array of
+         (chunkX, chunkY, absolute x, absolute y) rows of every cell that
+         needs redrawing, see TwoDimDrawing.drawcells()
+        """
+        stats = self.world.stats
+        start = stats.begin()
+        count = self.count
+        if type(rows) == type(bool()):
+            rows = np.arange(count)
+        rows = np.asarray(rows, dtype=np.int64)
+        dx = np.broadcast_to(np.asarray(dx, dtype=np.int32), rows.shape)
+        dy = np.broadcast_to(np.asarray(dy, dtype=np.int32), rows.shape)
+        x = self.x[:count]
+        y = self.y[:count]
+        newx = x.copy()
+        newy = y.copy()
+        newx[rows] += dx
+        newy[rows] += dy
+        # Objects that want to move and would stay inside their chunk
+        size = self.world.chunksize
+        moving = (newx != x) | (newy != y)
+        moving &= (newx + self.xoffset >= 0) & (newx + self.xoffset < size)
+        moving &= (newy + self.yoffset >= 0) & (newy + self.yoffset < size)
+        if self.collide:
+            self.resolve(moving, newx, newy)
+        moved = np.nonzero(moving)[0]
+        chunkX = self.chunkX[moved]
+        chunkY = self.chunkY[moved]
+        cells = np.concatenate((np.column_stack((chunkX, chunkY, x[moved] + self.xoffset, y[moved] + self.yoffset)),
+                                np.column_stack((chunkX, chunkY, newx[moved] + self.xoffset, newy[moved] + self.yoffset))))
+        if len(cells):
+            cells = np.unique(cells, axis=0)
+        x[moved] = newx[moved]
+        y[moved] = newy[moved]
+        if len(moved):
+            self.commit(moved, persist)
+        stats.add('move', start)
+        return (moved, cells)
+
+    def resolve(self, moving, newx, newy):
+        """
+        Refuses (sets moving to False for) the moves that would put two objects
+         in the same cell. Objects that stay put keep their cell, otherwise the
+         lowest row gets it. Repeated until nothing changes, as every refused
+         move leaves another object where it was
+        """
+        count = self.count
+        chunkX = self.chunkX[:count]
+        chunkY = self.chunkY[:count]
+        x = self.x[:count]
+        y = self.y[:count]
+        order = np.arange(count)
+        while True:
+            keys = self.cellkeys(chunkX, chunkY, np.where(moving, newx, x), np.where(moving, newy, y))
+            # By cell, then the objects that stay put first, then by row
+            order = np.lexsort((np.arange(count), moving, keys))
+            keys = keys[order]
+            losers = order[1:][keys[1:] == keys[:-1]]
+            losers = losers[moving[losers]]
+            if len(losers) < 1:
+                return
+            moving[losers] = False
+
+    def commit(self, rows, persist=True):
+        "Writes the objects in rows to the registry and (if persist) the database"
+        records = self.records(rows)
+        for record in records:
+            self.world.registry.update(record)
+        if persist:
+            if self.world.writebehind == False:
+                self.world.storage.saveobjects(records)
+            else:
+                self.world.writebehind.markmany(records)